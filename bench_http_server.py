@@ -0,0 +1,54 @@
+import argparse
+import http.client
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+import http_server
+
+FILES = ['/index.html', '/index.js', '/player.js', '/twitch.js', '/races.js', '/rearrange.js', '/drift.js', '/favicon.ico']
+
+# Simulates a browser loading the app: fetch every static file, optionally revalidating with the ETags from a previous load.
+def load_app(port, duration, revalidate):
+  conn = http.client.HTTPConnection('localhost', port)
+  etags = {}
+  requests = 0
+  end = time.perf_counter() + duration
+  while time.perf_counter() < end:
+    for path in FILES:
+      headers = {'Accept-Encoding': 'br, gzip'}
+      if revalidate and path in etags:
+        headers['If-None-Match'] = etags[path]
+      conn.request('GET', path, headers=headers)
+      response = conn.getresponse()
+      response.read()
+      if response.getheader('ETag'):
+        etags[path] = response.getheader('ETag')
+      if response.will_close: # HTTP/1.0 servers close the connection after every request
+        conn.close()
+        conn = http.client.HTTPConnection('localhost', port)
+      requests += 1
+  conn.close()
+  return requests
+
+def benchmark(port, clients, duration, revalidate):
+  with ThreadPoolExecutor(clients) as pool:
+    results = pool.map(lambda _: load_app(port, duration, revalidate), range(clients))
+    return sum(results) / duration
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compare requests/sec of the http_server.py static file handlers')
+  parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients (e.g. parallel test browsers)')
+  parser.add_argument('--duration', type=float, default=5, help='Seconds to run each benchmark')
+  args = parser.parse_args()
+
+  servers = {'no-cache (default)': (3100, False), 'cached': (3101, True)}
+  for port, cached in servers.values():
+    Thread(target=http_server.main, kwargs={'port': port, 'cached': cached}, daemon=True).start()
+  time.sleep(1) # Let the servers start
+
+  for name, (port, cached) in servers.items():
+    for revalidate in [False, True]:
+      rps = benchmark(port, args.clients, args.duration, revalidate)
+      mode = 'revalidating' if revalidate else 'full fetch'
+      print(f'{name:20} {mode:14} {rps:8.0f} requests/sec')
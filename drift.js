@@ -0,0 +1,72 @@
+(() => {
+
+// Once the players are PLAYING, nothing else keeps them aligned: if one embed stalls to buffer, it falls behind until the user seeks.
+// So every so often, we compare each playing video against the average, and re-seek any player which has fallen too far behind.
+const DRIFT_SAMPLE_INTERVAL = 1000
+// Don't re-seek the same player more often than this. Real embeds need a while to buffer after a seek, and re-seeking them won't help.
+const DRIFT_RESYNC_COOLDOWN = 10000
+// Upper bounds (in ms) of the histogram buckets. Drift is measured in either direction, so these are absolute values.
+const DRIFT_BUCKETS = [100, 250, 500, 1000, 2000, 5000, 10000, Infinity]
+
+// How far (in ms) a player can fall behind before we re-seek it. Tests (and impatient users) can lower this.
+var DRIFT_THRESHOLD = 2000
+window.overrideDriftThreshold = function(driftThreshold) { DRIFT_THRESHOLD = driftThreshold }
+
+var driftHistograms = new Map() // player id -> {counts, samples, maxDrift, resyncs, lastResync}
+function getHistogram(playerId) {
+  var histogram = driftHistograms.get(playerId)
+  if (histogram == null) {
+    histogram = {'counts': DRIFT_BUCKETS.map(() => 0), 'samples': 0, 'maxDrift': 0, 'resyncs': 0, 'lastResync': null}
+    driftHistograms.set(playerId, histogram)
+  }
+  return histogram
+}
+
+window.startDriftMonitor = function() {
+  clock.setInterval(() => sampleDrift(), DRIFT_SAMPLE_INTERVAL)
+}
+
+function sampleDrift() {
+  // Drift is only meaningful while everything is supposed to be playing together.
+  if (pendingSeekTimestamp > 0) return // The players are deliberately moving, so they'll disagree for a bit.
+  if (isRearrangeMode()) return
+  var playingPlayers = []
+  for (var player of players.values()) {
+    if (player.state === ASYNC) return
+    if (player.state === PLAYING) playingPlayers.push(player)
+  }
+  if (playingPlayers.length < 2) return
+
+  var averageTimestamp = getAveragePlayerTimestamp()
+  var now = clock.now()
+  for (var player of playingPlayers) {
+    var drift = player.getCurrentTimestamp() - averageTimestamp
+    var histogram = getHistogram(player.id)
+    histogram.counts[DRIFT_BUCKETS.findIndex(bound => Math.abs(drift) <= bound)]++
+    histogram.samples++
+    if (Math.abs(drift) > Math.abs(histogram.maxDrift)) histogram.maxDrift = drift
+
+    if (drift > -DRIFT_THRESHOLD) continue // Only the players which are behind need fixing; the rest are what we sync to.
+    if (histogram.lastResync != null && now - histogram.lastResync < DRIFT_RESYNC_COOLDOWN) continue
+
+    // This player's lag drags the average down, so sync it to where the other players are.
+    var otherTimestamps = playingPlayers.filter(p => p !== player).map(p => p.getCurrentTimestamp())
+    var targetTimestamp = otherTimestamps.reduce((a, b) => a + b) / otherTimestamps.length
+    console.log(player.id, 'has drifted', Math.round(-drift), 'ms behind the other players, re-seeking it to', targetTimestamp)
+    histogram.resyncs++
+    histogram.lastResync = now
+    seekPlayer(player, targetTimestamp, PLAYING)
+  }
+}
+
+// Per-player drift histograms, so that tests can measure how well the players stay in sync (rather than only checking at fixed points).
+window.getDriftHistograms = function() {
+  var result = {'buckets': DRIFT_BUCKETS.map(bound => bound === Infinity ? null : bound), 'threshold': DRIFT_THRESHOLD, 'players': {}}
+  for (var [playerId, histogram] of driftHistograms) {
+    result.players[playerId] = {'counts': histogram.counts.slice(), 'samples': histogram.samples, 'maxDrift': histogram.maxDrift, 'resyncs': histogram.resyncs}
+  }
+  return result
+}
+window.clearDriftHistograms = function() { driftHistograms.clear() }
+
+})()
@@ -0,0 +1,213 @@
+(() => {
+
+// A scriptable stand-in for the Twitch embed API (https://dev.twitch.tv/docs/embed/video-and-clips/), which http_server.py --fake-embed
+// serves in place of https://player.twitch.tv/js/embed/v1.js. It sends the same event sequences as the real embed, quirks included,
+// but runs on the app's clock, so that a test with a manual clock (see useManualClock) can play through a whole VOD in milliseconds.
+//
+// The defaults below are overridden by window.FAKE_TWITCH_EMBED (which the server fills in with the fixture videos' durations),
+// then by the 'fake_embed' hash parameter (JSON, e.g. #fake_embed={"seekDelay":1000}), and finally by configureFakeTwitchEmbed().
+var config = {
+  'readyDelay': 500,            // From creating the embed to its 'ready' event
+  'initialSeekDelay': 100,      // From 'ready' (or setVideo) to the seek to the 'last watched' position
+  'seekDelay': 200,             // From seek() to the 'seek' event
+  'playDelay': 100,             // From play() to the 'play' event
+  'pauseDelay': 50,             // From pause() to the 'pause' event
+  'bufferDelay': 0,             // How long the video buffers (without advancing) after every play and seek, before 'playing'
+  'bufferAbove': null,          // Report Buffering while playing above this height (e.g. 720), like a bandwidth limit
+  'spuriousSeekInterval': 0,    // If set, send a seek to 0.01 this often (in ms) once loaded, which twitch does for no clear reason
+  'pauseInsteadOfEnded': false, // Send 'pause' instead of 'ended' when the video ends, which twitch has started doing some times
+  'liveDurationExtra': 0,       // Seconds which getDuration() grows by once the video plays, like a VOD which was still live
+  'endOverrun': 0.5,            // Seconds the video plays past getDuration(), since twitch's durations are rounded down
+  'durations': {},              // Video id -> seconds
+  'defaultDuration': 3600,
+  'lastWatched': {},            // Video id -> seconds, where the initial seek goes. Otherwise, it's a seek to 0.01.
+}
+Object.assign(config, window.FAKE_TWITCH_EMBED)
+if (window.location.hash.length > 1) {
+  var params = new URLSearchParams(window.location.hash.substring(1))
+  if (params.has('fake_embed')) Object.assign(config, JSON.parse(params.get('fake_embed')))
+}
+window.configureFakeTwitchEmbed = function(overrides) { Object.assign(config, overrides) }
+
+const QUALITIES = [
+  {'group': 'chunked', 'name': 'Source', 'height': 1080},
+  {'group': '720p60', 'name': '720p60', 'height': 720},
+  {'group': '480p30', 'name': '480p', 'height': 480},
+  {'group': '360p30', 'name': '360p', 'height': 360},
+  {'group': '160p30', 'name': '160p', 'height': 160},
+]
+
+// Enough of the embed's UI for the tests, which click the play button and look for the controls to tell if the embed loaded.
+const FRAME_HTML = `
+  <div data-a-target="player-controls" style="position: absolute; bottom: 0">
+    <button data-a-target="player-overlay-play-button" onclick="frameElement.fakePlayer.play()">Play</button>
+  </div>`
+
+class FakePlayer {
+  constructor(divId, options) {
+    this._listeners = new Map()
+    this._quality = QUALITIES[0]
+    this._loadVideo(options.video)
+
+    var frame = document.createElement('iframe')
+    frame.setAttribute('width', options.width)
+    frame.setAttribute('height', options.height)
+    frame.setAttribute('srcdoc', FRAME_HTML)
+    frame.fakePlayer = this
+    document.getElementById(divId).appendChild(frame)
+    this._frame = frame
+
+    clock.setTimeout(() => {
+      this._emit('ready')
+      this._sendInitialSeek()
+      this._startSpuriousSeeks()
+    }, config.readyDelay)
+  }
+
+  addEventListener(event, callback) {
+    if (!this._listeners.has(event)) this._listeners.set(event, [])
+    this._listeners.get(event).push(callback)
+  }
+
+  // Calls take effect immediately, but (like the real embed) their events arrive a little later.
+  play() {
+    if (!this._paused) return
+    this._settle()
+    if (this._ended) {
+      // Playing an ended video restarts it, so we get a seek back to the start before the play.
+      this._ended = false
+      this._position = 0
+      this._sendLater(config.playDelay, 'seek', {'position': 0})
+    }
+    this._paused = false
+    this._played = true
+    this._sendLater(config.playDelay, 'play')
+    this._buffer(config.playDelay)
+    this._resume()
+  }
+
+  pause() {
+    if (this._paused) return
+    this._settle()
+    this._paused = true
+    this._sendLater(config.pauseDelay, 'pause')
+  }
+
+  seek(seconds) {
+    this._settle()
+    this._position = Math.max(0, Math.min(seconds, this._length()))
+    this._ended = false
+    this._sendLater(config.seekDelay, 'seek', {'position': this._position})
+    if (!this._paused) this._buffer(config.seekDelay)
+    this._resume()
+  }
+
+  // Switching videos doesn't send another 'ready', only the initial seek.
+  setVideo(videoId) {
+    this._settle()
+    this._loadVideo(videoId)
+    clock.setTimeout(() => {
+      this._sendInitialSeek()
+      this._startSpuriousSeeks()
+    }, config.readyDelay)
+  }
+
+  getCurrentTime() {
+    if (this._playingSince == null) return this._position
+    return Math.min(this._position + (clock.now() - this._playingSince) / 1000, this._length())
+  }
+  getDuration() { return this._duration + (this._played ? config.liveDurationExtra : 0) }
+  isPaused() { return this._paused }
+  getEnded() { return this._ended }
+  getQuality() { return this._quality.group }
+  getQualities() { return QUALITIES.map(quality => ({'group': quality.group, 'name': quality.name})) }
+  setQuality(group) { this._quality = QUALITIES.find(quality => quality.group === group) ?? this._quality }
+  getPlayerState() {
+    var playback = 'Playing'
+    if (this._ended) playback = 'Ended'
+    else if (this._paused) playback = 'Paused'
+    else if (this._buffering) playback = 'Buffering'
+    else if (config.bufferAbove != null && this._quality.height > config.bufferAbove) playback = 'Buffering'
+    return {'playback': playback, 'videoID': this._videoId}
+  }
+
+  _loadVideo(videoId) {
+    this._videoId = videoId
+    this._duration = config.durations[videoId] ?? config.defaultDuration
+    this._position = 0
+    this._paused = true
+    this._played = false
+    this._ended = false
+    this._playingSince = null
+    this._buffering = false
+    clock.clearTimeout(this._endTimeout)
+    clock.clearTimeout(this._bufferTimeout)
+    clock.clearInterval(this._spuriousSeekInterval)
+  }
+
+  _sendInitialSeek() {
+    this._position = config.lastWatched[this._videoId] ?? 0.01
+    this._sendLater(config.initialSeekDelay, 'seek', {'position': this._position})
+  }
+
+  _startSpuriousSeeks() {
+    if (config.spuriousSeekInterval <= 0) return
+    clock.clearInterval(this._spuriousSeekInterval)
+    this._spuriousSeekInterval = clock.setInterval(() => {
+      // Once the embed is gone (e.g. its player was removed, or it was swapped out in a handoff), so are its events.
+      if (!this._frame.isConnected) clock.clearInterval(this._spuriousSeekInterval)
+      else this._emit('seek', {'position': 0.01})
+    }, config.spuriousSeekInterval)
+  }
+
+  // How far the video actually plays, which is a bit past what getDuration() says
+  _length() { return this.getDuration() + config.endOverrun }
+
+  // Stops the playback clock, folding the time played so far into _position. _resume starts it again.
+  _settle() {
+    this._position = this.getCurrentTime()
+    this._playingSince = null
+    clock.clearTimeout(this._endTimeout)
+  }
+
+  _resume() {
+    if (this._paused || this._buffering) return
+    this._playingSince = clock.now()
+    this._endTimeout = clock.setTimeout(() => this._end(), (this._length() - this._position) * 1000)
+  }
+
+  // 'playing' comes once the video has buffered, and never before the event which caused the buffering.
+  _buffer(eventDelay) {
+    clock.clearTimeout(this._bufferTimeout)
+    this._buffering = config.bufferDelay > 0
+    if (this._buffering) {
+      this._bufferTimeout = clock.setTimeout(() => {
+        this._buffering = false
+        this._resume()
+      }, config.bufferDelay)
+    }
+    this._sendLater(Math.max(eventDelay, config.bufferDelay), 'playing')
+  }
+
+  _end() {
+    this._settle()
+    this._position = this._length()
+    this._paused = true
+    this._ended = true
+    this._emit(config.pauseInsteadOfEnded ? 'pause' : 'ended')
+  }
+
+  _sendLater(delay, event, data) { clock.setTimeout(() => this._emit(event, data), delay) }
+
+  _emit(event, data) {
+    for (var callback of this._listeners.get(event) ?? []) callback(data)
+  }
+}
+
+// The real embed also exposes its event names as constants.
+Object.assign(FakePlayer, {
+  'READY': 'ready', 'PLAY': 'play', 'PLAYING': 'playing', 'PAUSE': 'pause', 'ENDED': 'ended', 'SEEK': 'seek',
+})
+window.Twitch = {'Player': FakePlayer}
+
+})()
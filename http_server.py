@@ -1,4 +1,26 @@
+import argparse
+import gzip
+import hashlib
 import http.server
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+try:
+  import brotli
+except ImportError:
+  brotli = None # Optional, we still serve gzip without it
+
+FIXTURES = Path(__file__).with_name('fixtures')
+INDEX_HTML = Path(__file__).with_name('index.html')
+COMPRESSIBLE_TYPES = ['application/javascript', 'application/json', 'image/svg+xml', 'image/vnd.microsoft.icon']
 
 class NoCacheHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
   def send_response_only(self, code, message=None):
@@ -6,8 +28,324 @@ class NoCacheHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     self.send_header('Cache-Control', 'no-store, must-revalidate')
     self.send_header('Expires', '0')
 
-def main():
-  http.server.test(HandlerClass=NoCacheHTTPRequestHandler, port=3000)
+class CachedFile:
+  def __init__(self, path, stat, content_type):
+    self.mtime = stat.st_mtime_ns
+    self.size = stat.st_size
+    self.content_type = content_type
+    data = path.read_bytes()
+    self.etag = hashlib.sha1(data).hexdigest()[:16]
+    self.encodings = {'identity': data}
+    # Compressing tiny or already-compressed files just wastes CPU on the client.
+    if len(data) > 256 and (content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES):
+      self.encodings['gzip'] = gzip.compress(data, 9, mtime=0)
+      if brotli is not None:
+        self.encodings['br'] = brotli.compress(data)
+
+# Serves static files from memory, with precompressed variants, ETags, and HTTP/1.1 keep-alive.
+# Files are re-read whenever their mtime or size changes, and clients are told to revalidate every request,
+# so edits still show up immediately -- they just cost a 304 instead of a full download when nothing changed.
+class CachedStaticHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+  disable_nagle_algorithm = True # Otherwise, a kept-alive connection stalls between sending headers and body
+  cache = {} # Shared between all requests (and threads)
+  cache_lock = threading.Lock()
+
+  def do_GET(self):
+    self.send_cached(include_body=True)
+
+  def do_HEAD(self):
+    self.send_cached(include_body=False)
+
+  def get_cached_file(self, path):
+    stat = path.stat()
+    with self.cache_lock:
+      cached = self.cache.get(path)
+      if cached is None or cached.mtime != stat.st_mtime_ns or cached.size != stat.st_size:
+        cached = CachedFile(path, stat, self.guess_type(str(path)))
+        self.cache[path] = cached
+      return cached
+
+  def send_cached(self, include_body):
+    path = Path(self.translate_path(self.path))
+    if path.is_dir():
+      path = path / 'index.html'
+    if not path.is_file():
+      # Directory listings and 404s are rare enough to leave to the default handler.
+      return super().do_GET() if include_body else super().do_HEAD()
+
+    cached = self.get_cached_file(path)
+    accepted = [encoding.split(';')[0].strip() for encoding in self.headers.get('Accept-Encoding', '').split(',')]
+    encoding = next((e for e in ['br', 'gzip'] if e in accepted and e in cached.encodings), 'identity')
+    # Each encoding is a different byte stream, so needs its own (strong) ETag.
+    etag = f'"{cached.etag}-{encoding}"'
+
+    if_none_match = [tag.strip().removeprefix('W/') for tag in self.headers.get('If-None-Match', '').split(',')]
+    if etag in if_none_match or '*' in if_none_match:
+      self.send_response(304)
+      self.send_cache_headers(etag)
+      self.end_headers()
+      return
+
+    body = cached.encodings[encoding]
+    self.send_response(200)
+    self.send_cache_headers(etag)
+    self.send_header('Content-Type', cached.content_type)
+    self.send_header('Content-Length', str(len(body)))
+    if encoding != 'identity':
+      self.send_header('Content-Encoding', encoding)
+    self.end_headers()
+    if include_body:
+      self.wfile.write(body)
+
+  def send_cache_headers(self, etag):
+    self.send_header('ETag', etag)
+    self.send_header('Cache-Control', 'no-cache') # Always revalidate, so that local edits are picked up on the next load
+    self.send_header('Vary', 'Accept-Encoding')
+
+  def log_message(self, format, *args):
+    pass # With keep-alive and revalidation, per-request logging is mostly noise (and slows down the server).
+
+# Stands in for the Twitch Helix + OAuth APIs and the racetime.gg race data API, so that tests can run offline.
+# The page is pointed at this server via the 'api_base' hash parameter (see index.js).
+# Any path which is not one of the APIs falls through to the static file handler it's combined with (see make_handler).
+class StubAPIMixin:
+  fixtures = FIXTURES
+  latency_ms = 0
+
+  def do_GET(self):
+    url = urlsplit(self.path)
+    params = parse_qs(url.query)
+    parts = url.path.strip('/').split('/')
+
+    if url.path == '/helix/users':
+      self.send_helix(self.get_users(params))
+    elif url.path == '/helix/videos':
+      if not all(video_id.isdigit() for video_id in params.get('id', [])):
+        # Like twitch, a malformed id fails the whole request.
+        self.send_stub_response(400, b'{"error": "Bad Request", "status": 400, "message": "Invalid video id"}')
+      else:
+        self.send_helix(*self.get_videos(params))
+    elif url.path == '/oauth2/authorize':
+      # Twitch would show a login page here, which the tests never interact with.
+      self.send_stub_response(302, headers={'Location': '/login'})
+    elif url.path == '/login':
+      self.send_stub_response(200, b'<html><body>Stub twitch login</body></html>', 'text/html')
+    elif len(parts) == 3 and parts[2] == 'data':
+      # e.g. /ootr/races/data or /ootr/wonderful-krossbones-7951/data
+      path = self.fixtures / 'racetime' / parts[0] / (parts[1] + '.json')
+      if path.exists():
+        self.send_stub_response(200, path.read_bytes())
+      else:
+        self.send_stub_response(404, b'{"error": "Not found"}')
+    else:
+      super().do_GET()
+
+  def do_POST(self):
+    url = urlsplit(self.path)
+    if url.path == '/oauth2/token':
+      self.send_stub_response(200, (self.fixtures / 'oauth2' / 'token.json').read_bytes())
+    else:
+      self.send_stub_response(404, b'{"error": "Not found"}')
+
+  def do_OPTIONS(self):
+    # CORS preflight for the Authorization and Client-ID headers
+    self.send_stub_response(204, headers={
+      'Access-Control-Allow-Methods': 'GET, POST',
+      'Access-Control-Allow-Headers': 'Authorization, Client-ID',
+    })
+
+  def load_fixture(self, name):
+    return json.loads((self.fixtures / 'helix' / name).read_text(encoding='utf-8'))
+
+  def get_users(self, params):
+    users = self.load_fixture('users.json')
+    logins = [login.lower() for login in params.get('login', [])]
+    ids = params.get('id', [])
+    return [user for user in users if user['login'] in logins or user['id'] in ids]
+
+  def get_videos(self, params):
+    videos = self.load_fixture('videos.json')
+    if 'id' in params:
+      return [video for video in videos if video['id'] in params['id']], None
+    user_ids = params.get('user_id', [])
+    video_type = params.get('type', ['all'])[0]
+    videos = [video for video in videos if video['user_id'] in user_ids]
+    if video_type != 'all':
+      videos = [video for video in videos if video['type'] == video_type]
+    videos.sort(key=lambda video: video['created_at'], reverse=True)
+
+    # Our cursors are just offsets into the list, which is enough to exercise the app's paging.
+    start = int(params.get('after', ['0'])[0])
+    end = start + int(params.get('first', ['20'])[0])
+    return videos[start:end], (str(end) if end < len(videos) else None)
+
+  def is_authorized(self):
+    token = json.loads((self.fixtures / 'oauth2' / 'token.json').read_text(encoding='utf-8'))['access_token']
+    return self.headers.get('Authorization') == 'Bearer ' + token
+
+  def send_unauthorized(self):
+    self.send_stub_response(401, b'{"error": "Unauthorized", "status": 401, "message": "Invalid OAuth token"}')
+
+  def send_helix(self, data, cursor=None):
+    if not self.is_authorized():
+      self.send_unauthorized()
+    else:
+      pagination = {'cursor': cursor} if cursor else {}
+      self.send_stub_response(200, json.dumps({'data': data, 'pagination': pagination}).encode('utf-8'))
+
+  def send_stub_response(self, code, body=b'', content_type='application/json', headers=None):
+    if self.latency_ms > 0:
+      time.sleep(self.latency_ms / 1000)
+    self.send_response(code)
+    self.send_header('Access-Control-Allow-Origin', '*')
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+# API responses recorded from a real run, keyed by method, path, and (sorted) query params.
+# Saved as indented JSON, so that changes in the upstream APIs show up as readable diffs.
+class Cassette:
+  def __init__(self, path, record=False):
+    self.path = Path(path)
+    self.lock = threading.Lock()
+    self.responses = {}
+    if not record: # Each recording starts from scratch, so that it doesn't keep responses which the tests no longer make.
+      if not self.path.exists():
+        raise FileNotFoundError(f'No cassette to replay at {self.path} (make one with --record)')
+      self.responses = json.loads(self.path.read_text(encoding='utf-8'))
+
+  @staticmethod
+  def key(method, path):
+    url = urlsplit(path)
+    # The app doesn't always list ids in the same order (e.g. when batching requests), but they're equivalent.
+    params = sorted((name, sorted(values)) for name, values in parse_qs(url.query).items())
+    query = urlencode(params, doseq=True)
+    return f'{method} {url.path}?{query}' if query else f'{method} {url.path}'
+
+  def get(self, key):
+    with self.lock:
+      return self.responses.get(key)
+
+  def record(self, key, status, content_type, body):
+    with self.lock:
+      self.responses[key] = {'status': status, 'content_type': content_type, 'body': body.decode('utf-8')}
+      # Saved after every response, since the server is usually stopped by killing it.
+      tmp_path = self.path.with_suffix('.tmp')
+      tmp_path.write_text(json.dumps(self.responses, indent=1, sort_keys=True), encoding='utf-8')
+      tmp_path.replace(self.path)
+
+# Records the Twitch Helix and racetime.gg API traffic of a real run into a cassette, or replays it from one, at local-disk speed.
+# In record mode, API requests are forwarded upstream (with the caller's auth headers) and their responses saved.
+# In replay mode, only the cassette is used, and Helix requests need the stub token, just like in stub mode.
+# Auth (the token and login flow) and static files are handled the same as in stub mode.
+class CassetteMixin(StubAPIMixin):
+  cassette = None
+  record = False
+  upstreams = {'helix': 'https://api.twitch.tv', 'racetime': 'https://racetime.gg'}
+
+  def do_GET(self):
+    parts = urlsplit(self.path).path.strip('/').split('/')
+    if parts[0] == 'helix':
+      api = 'helix'
+    elif len(parts) == 3 and parts[2] == 'data':
+      api = 'racetime'
+    else:
+      return super().do_GET()
+
+    key = Cassette.key('GET', self.path)
+    if self.record:
+      self.forward(key, self.upstreams[api] + self.path)
+    elif api == 'helix' and not self.is_authorized():
+      self.send_unauthorized()
+    else:
+      response = self.cassette.get(key)
+      if response is None:
+        print('Cassette has no response for', key, file=sys.stderr)
+        self.send_stub_response(404, json.dumps({'error': 'Not recorded', 'key': key}).encode('utf-8'))
+      else:
+        self.send_stub_response(response['status'], response['body'].encode('utf-8'), response['content_type'])
+
+  def forward(self, key, url):
+    headers = {name: self.headers[name] for name in ['Authorization', 'Client-ID'] if name in self.headers}
+    headers['User-Agent'] = 'twitch-vod-sync tests'
+    try:
+      with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30) as response:
+        status, content_type, body = response.status, response.headers.get('Content-Type'), response.read()
+    except urllib.error.HTTPError as e:
+      status, content_type, body = e.code, e.headers.get('Content-Type'), e.read()
+    content_type = content_type or 'application/json'
+
+    # Auth failures depend on the token rather than the request, so they can't be replayed. (Replay checks the token itself.)
+    if status != 401:
+      self.cassette.record(key, status, content_type, body)
+    self.send_stub_response(status, body, content_type)
+
+# Serves the app with the Twitch embed script swapped for fixtures/twitch_embed.js, a scriptable fake of the embed API,
+# so that TwitchPlayer can be tested offline (and, on a manual clock, much faster than real time).
+# The fake is told the duration of every fixture video, so that it agrees with the stubbed Helix API.
+class FakeEmbedMixin:
+  embed_script = '<script defer src="https://player.twitch.tv/js/embed/v1.js"></script>'
+
+  def do_GET(self):
+    if urlsplit(self.path).path in ('/', '/index.html'):
+      self.send_fake_embed_index()
+    else:
+      super().do_GET()
+
+  def send_fake_embed_index(self):
+    videos = json.loads((FIXTURES / 'helix' / 'videos.json').read_text(encoding='utf-8'))
+    config = {'durations': {video['id']: parse_duration(video['duration']) for video in videos}}
+    html = INDEX_HTML.read_text(encoding='utf-8')
+    assert self.embed_script in html, 'index.html no longer loads the Twitch embed script'
+    html = html.replace(self.embed_script, f'<script>window.FAKE_TWITCH_EMBED = {json.dumps(config)}</script>'
+                                           '<script defer src="./fixtures/twitch_embed.js"></script>')
+    body = html.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# Twitch durations look like 1h2m3s *or* 4m5s *or* 6s (see twitch.js)
+def parse_duration(duration):
+  m = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?', duration)
+  hours, minutes, seconds = (int(part or 0) for part in m.groups())
+  return hours * 3600 + minutes * 60 + seconds
+
+def make_handler(stub=False, latency_ms=0, cached=False, cassette=None, record=False, fake_embed=False):
+  handler = CachedStaticHTTPRequestHandler if cached else NoCacheHTTPRequestHandler
+  if cassette is not None:
+    handler = type('CassetteHTTPRequestHandler', (CassetteMixin, handler), {
+      'latency_ms': latency_ms,
+      'cassette': Cassette(cassette, record),
+      'record': record,
+    })
+  elif stub:
+    handler = type('StubHTTPRequestHandler', (StubAPIMixin, handler), {'latency_ms': latency_ms})
+  if fake_embed:
+    handler = type('FakeEmbedHTTPRequestHandler', (FakeEmbedMixin, handler), {})
+  return handler
+
+def main(port=3000, stub=False, latency_ms=0, cached=False, cassette=None, record=False, fake_embed=False):
+  handler = make_handler(stub, latency_ms, cached, cassette, record, fake_embed)
+  # Keep-alive requires HTTP/1.1, which in turn requires that every response has a Content-Length.
+  protocol = 'HTTP/1.1' if cached else 'HTTP/1.0'
+  http.server.test(HandlerClass=handler, ServerClass=http.server.ThreadingHTTPServer, protocol=protocol, port=port)
 
 if __name__ == '__main__':
-  main()
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--port', type=int, default=3000)
+  parser.add_argument('--stub', action='store_true', help='Serve the Twitch and racetime.gg APIs from the fixtures folder')
+  parser.add_argument('--latency', type=int, default=0, help='Milliseconds of latency to add to each stubbed API response')
+  parser.add_argument('--cached', action='store_true', help='Serve static files from memory, compressed, with ETags and keep-alive')
+  parser.add_argument('--record', type=Path, metavar='CASSETTE', help='Forward the Twitch and racetime.gg APIs upstream, saving their responses')
+  parser.add_argument('--replay', type=Path, metavar='CASSETTE', help='Serve the Twitch and racetime.gg APIs from a recording')
+  parser.add_argument('--fake-embed', action='store_true', help='Serve the app with a local fake of the Twitch embed (see fixtures/twitch_embed.js)')
+  args = parser.parse_args()
+  if args.replay and not args.replay.exists():
+    parser.error(f'No cassette to replay at {args.replay} (make one with --record)')
+  main(port=args.port, stub=args.stub, latency_ms=args.latency, cached=args.cached,
+       cassette=args.record or args.replay, record=args.record is not None, fake_embed=args.fake_embed)
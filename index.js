@@ -18,9 +18,66 @@ var SYNC_THRESHOLD = 60000
 // Will be nonzero after a seek, returns to zero once all videos have finished seeking
 var pendingSeekTimestamp = 0
 var pendingSeekSource = null // Will be the ID of the player ('player0') if the seek originated from a player. Will be 'keyboard' if from larr/rarr.
-var pendingSeekTimeout = null
 var currentQuality = null // Keep track of the current requested video quality, so that we can downcycle if the user needs it.
 
+// All of the app's timers go through this clock, so that tests can switch to a manual clock and step time forward with advanceClock.
+var clock = {
+  now: () => Date.now(),
+  setTimeout: (callback, delay) => window.setTimeout(callback, delay),
+  clearTimeout: (id) => window.clearTimeout(id),
+  setInterval: (callback, delay) => window.setInterval(callback, delay),
+  clearInterval: (id) => window.clearInterval(id),
+}
+
+function useManualClock() {
+  console.log('Switching to a manual clock, time will only advance via advanceClock()')
+  var now = Date.now()
+  var nextId = 1
+  var timers = new Map()
+  clock.now = () => now
+  clock.setTimeout = (callback, delay) => {
+    timers.set(nextId, {'callback': callback, 'due': now + (delay || 0), 'interval': null})
+    return nextId++
+  }
+  clock.setInterval = (callback, delay) => {
+    timers.set(nextId, {'callback': callback, 'due': now + delay, 'interval': Math.max(delay, 1)})
+    return nextId++
+  }
+  clock.clearTimeout = clock.clearInterval = (id) => timers.delete(id)
+
+  // Runs every timer which comes due in the next 'millis', in order, as if that much time had passed.
+  window.advanceClock = function(millis) {
+    var target = now + millis
+    while (true) {
+      var nextTimer = null
+      for (var timer of timers.entries()) {
+        if (timer[1].due > target) continue
+        if (nextTimer == null || timer[1].due < nextTimer[1].due) nextTimer = timer
+      }
+      if (nextTimer == null) break
+
+      var [id, timer] = nextTimer
+      now = timer.due
+      if (timer.interval != null) timer.due += timer.interval
+      else timers.delete(id)
+      timer.callback()
+    }
+    now = target
+  }
+}
+
+// The api_base override (see window.onload) redirects the auth token and the login page, so it's only for local pages and servers.
+const LOOPBACK_HOSTS = ['localhost', '127.0.0.1']
+function isLoopbackHost(hostname) { return LOOPBACK_HOSTS.includes(hostname) }
+function isLoopbackOrigin(url) {
+  try {
+    var parsed = new URL(url)
+  } catch (ex) {
+    return false
+  }
+  return (parsed.protocol === 'http:' || parsed.protocol === 'https:') && isLoopbackHost(parsed.hostname) && url === parsed.origin
+}
+
 window.onload = function() {
   // There's a small chance we didn't get a 'page closing' event fired, so if this setting is still set and we have a token,
   // delete the localstorage so we show the prompt again.
@@ -44,6 +101,8 @@ window.onload = function() {
   // Check to see if the app is starting with a token (from a Twitch/Youtube redirect). If so, capture it and remove it from the URL.
   if (window.location.hash != null && window.location.hash.length > 1) {
     var params = new URLSearchParams(window.location.hash.substring(1))
+    // Used by tests which want to control time (this has to happen before we start any timers).
+    if (params.get('clock') == 'manual') useManualClock()
     var scope = params.get('scope')
     if (scope == 'https://www.googleapis.com/auth/youtube.readonly') {
       window.localStorage.setItem('youtubeAuthToken', params.get('access_token'))
@@ -55,6 +114,12 @@ window.onload = function() {
       // Additional param (which won't ever come from twitch) that is used to override the client_id in tests.
       // The tests need a confidential client (to do auth server-side) but the product needs a native client (to have a localhost redirect).
       if (params.has('client_id')) window.overrideTwitchClientId(params.get('client_id'))
+      // Similarly, tests can redirect all Twitch and racetime.gg API calls to a local stub server.
+      // This is only honored on a local page, and only for a local server, since it also redirects the auth token and the login page.
+      if (params.has('api_base') && isLoopbackHost(window.location.hostname) && isLoopbackOrigin(params.get('api_base'))) {
+        window.overrideTwitchApiBase(params.get('api_base'))
+        window.overrideRacetimeBase(params.get('api_base'))
+      }
     }
     window.location.hash = ''
   }
@@ -98,6 +163,8 @@ window.onload = function() {
     return
   }
 
+  startSeekScheduler()
+
   // Start with two players by default
   window.addPlayer()
   window.addPlayer()
@@ -133,9 +200,13 @@ window.onload = function() {
 
   window.addEventListener('resize', resizePlayers)
 
-  // This function updates the timeline cursor and label so they stay up to date with the current videos
-  // It also runs any of our "live" checks, i.e. anything which needs to be updated without user action
-  window.setInterval(() => refreshTimeline(), 100)
+  // This keeps the timeline cursor and label up to date with the current videos, and runs any of our "live" checks,
+  // i.e. anything which needs to happen without user action (see refreshTimeline).
+  startTimelineScheduler()
+  // Similarly, this re-seeks any player which falls behind the others while they're all playing (e.g. because it stalled to buffer).
+  startDriftMonitor()
+  // And this lowers the video quality if the players are buffering too much (and raises it again once they stop).
+  startQualityGovernor()
 
   // Handle space, left, and right as global listeners, in case you don't actually have a stream selected
   // Each of these just calls an event (play, pause, seek) on one of the players, so it'll fall through into the default handler.
@@ -145,6 +216,7 @@ window.onload = function() {
     var firstPlayingVideo = null
     var firstPausedVideo = null
     var anyVideoInAsync = false
+    var seekingPlayTarget = null // Where the other videos are headed, if they're seeking to play
     for (var player of players.values()) {
       if (player.state === PLAYING || player.state === SEEKING_PLAY) {
         if (firstPlayingVideo == null) firstPlayingVideo = player
@@ -176,6 +248,7 @@ window.onload = function() {
 
       currentIndex = (currentIndex + qualities.length + (event.shiftKey ? -1 : 1)) % qualities.length
       currentQuality = qualities[currentIndex]
+      resetQualityGovernor()
       for (var player of players.values()) player.setQuality(currentQuality)
 
     } else if (event.key == 'a') {
@@ -290,7 +363,7 @@ function addPlayer() {
   helpText.className = 'body-text'
 
   // If the form is still visible after 10 seconds, show a "help" hint about how to interact with this app.
-  setTimeout(() => {
+  clock.setTimeout(() => {
     if (helpText.style.display != 'none') return // Other info text is displaying
     helpText.style = 'padding: 10px'
     helpText.innerText = 'Enter a Twitch video url to watch in sync with the others. More details in '
@@ -337,6 +410,7 @@ function removePlayer() {
   // Untrack the player and update the timeline
   players.delete(playerToRemove.id)
   reloadTimeline()
+  requestTimelineRefresh()
 
   // Remove the div (which also unloads the embed), then sync the URL.
   playerToRemove.remove()
@@ -429,15 +503,16 @@ function searchVideo(event) {
     }
 
     showText(playerId, 'Loading channel videos...')
-    getTwitchChannelVideos(m[1])
-    .then(videos => {
-      var bestVideo = getBestVideo(videos, getAveragePlayerTimestamp())
+    // Only fetch as far back as the timeline goes, since older videos can't overlap it.
+    getTwitchChannelVideos(m[1], {'coverTime': getTimelineBounds()[0]})
+    .then(videoIndex => {
+      var bestVideo = getBestVideo(videoIndex, getAveragePlayerTimestamp())
       if (bestVideo == null) {
         console.log('No video found, showing picker')
-        showVideoPicker(playerId, videos)
+        showVideoPicker(playerId, videoIndex.newestFirst())
       } else {
         console.log('Found best video for', playerId, bestVideo.id)
-        loadVideos(playerId, [bestVideo], TWITCH)
+        loadVideos(playerId, getPlaylist(videoIndex, bestVideo), TWITCH)
       }
     })
     .catch(r => showText(playerId, 'Could not process channel "' + m[1] + '":\n' + r, /*isError*/true))
@@ -447,38 +522,43 @@ function searchVideo(event) {
   showText(playerId, 'Could not parse input "' + formText + '"', /*isError*/true)
 }
 
-function getBestVideo(videos, currentTimestamp) {
+function getBestVideo(videoIndex, currentTimestamp) {
   var [timelineStart, timelineEnd] = getTimelineBounds()
-  var overlappingVideos = []
-  for (var video of videos) {
-    // We are looking to see if our video overlaps the timeline.
-    // First, check to see if the timeline surrounds our video's start time.
-    // Second, check to see if our video surrounds the timeline's start time.
-    if (timelineStart <= video.startTime && video.startTime <= timelineEnd) {
-      overlappingVideos.push(video)
-    } else if (video.startTime <= timelineStart && timelineStart <= video.endTime) {
-      overlappingVideos.push(video)
-    }
-  }
+  var videos = videoIndex.videos // Sorted earliest -> latest
+
+  // We are looking for videos which overlap the timeline. Since the videos are sorted, these are a contiguous run:
+  // First, any videos which surround the timeline's start time.
+  // Second, any videos whose start time is within the timeline.
+  var first = videoIndex.bisect(timelineStart)
+  while (first > 0 && videos[first - 1].endTime >= timelineStart) first--
+  var last = videoIndex.bisect(timelineEnd, /*inclusive*/true)
 
   // If we have no timeline (or there was no overlap), error so the caller can take a smart action
   // (e.g. showing a picker so the user can select what they want)
-  if (overlappingVideos.length === 0) return null
-
-  // Twitch APIs do not actually return videos in any particular order. Sort earliest -> latest.
-  overlappingVideos.sort((a, b) => a.startTime - b.startTime)
+  if (first >= last) return null
 
   // Now that we've filtered the videos, pick the one that best suits the user's intention.
   // First, check to see if there's a video which overlaps the current timestamp (there can only be one of these)
-  var overlapsPlayhead = overlappingVideos.find(video => (video.startTime < currentTimestamp && currentTimestamp < video.endTime))
-  if (overlapsPlayhead != null) return overlapsPlayhead
+  var i = Math.min(last - 1, Math.max(first, videoIndex.bisect(currentTimestamp) - 1))
+  if (videos[i].startTime < currentTimestamp && currentTimestamp < videos[i].endTime) return videos[i]
 
   // If there's no video which matches the current playhead, then find the next video after the playhead
-  var upcomingVideo = overlappingVideos.find(video => (video.startTime > currentTimestamp))
-  if (upcomingVideo != null) return upcomingVideo
+  i = Math.max(first, videoIndex.bisect(currentTimestamp, /*inclusive*/true))
+  if (i < last) return videos[i]
 
   // Finally, use the first (earliest) video in the list.
-  return overlappingVideos[0]
+  return videos[first]
+}
+
+// If the stream went down and came back, the channel has several consecutive videos which overlap the timeline.
+// The player plays them in order, starting from the best one.
+function getPlaylist(videoIndex, firstVideo) {
+  var timelineEnd = getTimelineBounds()[1]
+  var playlist = [firstVideo]
+  for (var video = videoIndex.nextAfter(firstVideo.endTime); video != null && video.startTime <= timelineEnd; video = videoIndex.nextAfter(video.endTime)) {
+    playlist.push(video)
+  }
+  return playlist
 }
 
 function showVideoPicker(playerId, videos) {
@@ -516,7 +596,7 @@ function loadVideos(playerId, videos, playerType) {
   players.set(div.id, player)
   syncPlayerParamsToURL()
 
-  player.onready = (thisPlayer, initialTimestamp) => {
+  var onready = (thisPlayer, initialTimestamp) => {
     initialTimestamp = initialTimestamp || 0
     console.log(thisPlayer.id, 'has loaded')
     reloadTimeline() // Note: This will get called several times in a row if we're loading multiple videos from query params. Whatever.
@@ -529,6 +609,7 @@ function loadVideos(playerId, videos, playerType) {
     var anyVideoIsPlaying = false
     var anyVideoIsPaused = false
     var anyVideoInAsync = false
+    var seekingPlayTarget = null // Where the other videos are headed, if they're seeking to play
     for (var player of players.values()) {
       if (player.startTime > earliestSync) earliestSync = player.startTime
       if (player == thisPlayer) continue
@@ -536,6 +617,10 @@ function loadVideos(playerId, videos, playerType) {
       if (player.state === PLAYING || player.state === SEEKING_PLAY)  anyVideoIsPlaying = true
       if (player.state === PAUSED  || player.state === SEEKING_PAUSE) anyVideoIsPaused = true
       if (player.state === ASYNC) anyVideoInAsync = true
+      if (player.state === SEEKING_PLAY && seekingPlayTarget == null) {
+        seekingPlayTarget = getSeekTarget(player)
+        if (seekingPlayTarget == null) seekingPlayTarget = player.getCurrentTimestamp() // Not seeked by us, so this is our best guess
+      }
       // If there is a video BEFORE_START (or AFTER_END) at this point, treat it like READY,
       // so that we resync all videos to a shared, valid startpoint
     }
@@ -543,19 +628,24 @@ function loadVideos(playerId, videos, playerType) {
     console.log('Found earliest sync time', earliestSync)
     var averageTimestamp = getAveragePlayerTimestamp()
     console.log('Found average timestamp', averageTimestamp)
+    // Note that this is null if none of the other videos have settled (e.g. they're all still seeking), so we can't sync to it.
 
     if (anyVideoInAsync) {
       console.log(thisPlayer.id, 'loaded while another video was async, putting it into async too')
       thisPlayer.state = ASYNC
-    } else if (anyVideoIsPlaying) {
+    } else if (anyVideoIsPlaying && averageTimestamp != null) {
       console.log(thisPlayer.id, 'loaded while another video was playing, syncing to others and starting')
       thisPlayer.seekTo(averageTimestamp, PLAYING)
+    } else if (anyVideoIsPlaying) {
+      // The others are all still seeking, so there's no average yet. Rather than pausing (and rewinding) them, join them where they're going.
+      console.log(thisPlayer.id, 'loaded while the other videos were seeking to play, joining them at', seekingPlayTarget)
+      thisPlayer.seekTo(seekingPlayTarget, PLAYING)
     } else if (anyVideoStillLoading && averageTimestamp == null) {
       console.log(thisPlayer.id, 'loaded with all other videos in READY, deferring seek until all videos have loaded')
     } else if (anyVideoStillLoading) {
       console.log(thisPlayer.id, 'loaded while another video is still loading, syncing to others but staying paused')
       thisPlayer.seekTo(averageTimestamp, PAUSED)
-    } else if (anyVideoIsPaused && averageTimestamp + SYNC_THRESHOLD < thisPlayer.startTime) {
+    } else if (anyVideoIsPaused && averageTimestamp != null && averageTimestamp + SYNC_THRESHOLD < thisPlayer.startTime) {
       // If this video loaded notably past the current average timestamp, don't try to reseek the players.
       // Instead, pull this player to the average timestamp, where it will be BEFORE_START.
       console.log(thisPlayer.id, 'was last to load while others were paused at an earlier position, syncing to', averageTimestamp)
@@ -577,6 +667,7 @@ function loadVideos(playerId, videos, playerType) {
       seekPlayersTo(earliestSync, PAUSED)
     }
   }
+  player.onready = (thisPlayer, initialTimestamp) => traceSpan(thisPlayer.id, 'onready', () => onready(thisPlayer, initialTimestamp))
 
   return player
 }
@@ -597,6 +688,7 @@ function getStubVideosDetails(videoIds) {
 var raceStartTime = null
 function loadRace(raceDetails) {
   raceStartTime = raceDetails.startTime
+  var loadStart = Date.now()
 
   // Add the race URL to the query params in case we haven't done twitch auth yet;
   // we might get redirected to twitch while loading videos and lose the race details.
@@ -632,48 +724,261 @@ function loadRace(raceDetails) {
         .map(({ value }) => value)
     }
 
+    var racePlayers = new Set()
     var i = 0
     while (videos.length > 0) {
       var playerId = 'player' + i
       if (!players.has(playerId)) {
         while (document.getElementById(playerId) == null) window.addPlayer()
         loadVideos(playerId, [videos.shift()], TWITCH)
+        racePlayers.add(playerId)
       }
       i++
     }
+    logRaceLoadTimes(racePlayers, loadStart)
   })
 }
 
+// Records how long it took (from when we started loading the race) for the first, and then all, of the race's players to be ready.
+function logRaceLoadTimes(playerIds, loadStart) {
+  var waiting = new Set(playerIds)
+  function onStateChange(event) {
+    if (event.detail.to !== READY || !waiting.delete(event.detail.player)) return
+    if (waiting.size === playerIds.size - 1) logEvent(null, 'race', null, ['time to first player', Date.now() - loadStart])
+    if (waiting.size === 0) {
+      logEvent(null, 'race', null, ['time to all players', Date.now() - loadStart, playerIds.size])
+      playerEvents.removeEventListener('statechange', onStateChange)
+    }
+  }
+  playerEvents.addEventListener('statechange', onStateChange)
+}
+
 // TODO: make some kind of github report out of the event log, like Presently does
 // I should also include the URL (which contains the videos) + all video positions at time of submission.
 // https://github.com/jbzdarkid/Presently/blob/master/settings.js#L79
 // I mean I could do that, but it's also totally reasonable to just use this for my tests. I'd rather have really stable code than a bug tracker.
-var eventLog = []
+
+// The log is a fixed-size ring buffer of structured records, so that a multi-hour session doesn't grow it without bound.
+// Records are {time, player, event, state, details}, and are only converted to strings when exported (see exportEventLog).
+const EVENT_LOG_SIZE = 10000
+const PLAYER_ID_MATCH = /^player[0-9]+$/
+var eventLog = new Array(EVENT_LOG_SIZE)
+var eventLogCount = 0 // Total number of records ever logged; the next record goes at eventLogCount % EVENT_LOG_SIZE.
+function logEvent(playerId, event, state, details) {
+  eventLog[eventLogCount % EVENT_LOG_SIZE] = {'time': Date.now(), 'player': playerId, 'event': event, 'state': state, 'details': details}
+  eventLogCount++
+}
+
+// Spans (and instants) which tests export as a Chrome trace (see exportTrace). They happen on every state change and seek, and the
+// timeline refresh can run 10 times a second, so each name keeps only its most recent entries in a ring buffer (like the event log).
+// The player they're about (if any) goes in the entry's detail, so that each player gets its own track in the trace viewer.
+const TRACE_PREFIX = 'tvs:'
+const TRACE_ENTRIES_PER_NAME = 1000
+var traceEntries = new Map() // name -> {entries, count}, where count is the total number of entries ever recorded
+function recordTrace(entry) {
+  var ring = traceEntries.get(entry.name)
+  if (ring == null) {
+    ring = {'entries': [], 'count': 0}
+    traceEntries.set(entry.name, ring)
+  }
+  ring.entries[ring.count % TRACE_ENTRIES_PER_NAME] = entry
+  ring.count++
+}
+
+function traceSpan(playerId, name, func) {
+  var start = performance.now()
+  try {
+    return func()
+  } finally {
+    recordTrace({'name': TRACE_PREFIX + name, 'entryType': 'measure', 'startTime': start, 'duration': performance.now() - start, 'detail': {'player': playerId, 'category': 'app'}})
+  }
+}
+
+function traceMark(playerId, name, details) {
+  recordTrace({'name': TRACE_PREFIX + name, 'entryType': 'mark', 'startTime': performance.now(), 'duration': 0, 'detail': {'player': playerId, 'category': 'app', ...details}})
+}
+
+window.getTraceCount = function(name) {
+  var ring = traceEntries.get(TRACE_PREFIX + name)
+  return ring != null ? ring.count : 0
+}
+
+// Returns our spans, plus the page's network requests, in a JSON-friendly form. Times are relative to timeOrigin.
+window.exportTrace = function() {
+  var entries = []
+  for (var entry of performance.getEntriesByType('resource')) {
+    entries.push({'name': entry.name, 'entryType': 'measure', 'startTime': entry.startTime, 'duration': entry.duration, 'detail': {'player': null, 'category': 'network'}})
+  }
+  for (var ring of traceEntries.values()) entries.push(...ring.entries)
+  // Each player's current state hasn't ended yet, so it doesn't have a span. Add one up to now.
+  var now = performance.now()
+  for (var player of players.values()) {
+    var detail = {'player': player.id, 'category': 'state'}
+    entries.push({'name': TRACE_PREFIX + String(player.state), 'entryType': 'measure', 'startTime': player._stateChangedAt, 'duration': now - player._stateChangedAt, 'detail': detail})
+  }
+  return {'timeOrigin': performance.timeOrigin, 'entries': entries}
+}
+
+// Returns the state of every player in one call (mostly so that tests can make assertions without a round trip per player).
+window.getSyncSnapshot = function() {
+  var snapshot = {'time': Date.now(), 'players': []}
+  for (var player of players.values()) {
+    var playback = null
+    try {
+      playback = player.getPlaybackState()
+    } catch (ex) {
+      // The twitch embed's getters can throw before it has loaded.
+    }
+    snapshot.players.push({
+      'id': player.id,
+      'state': String(player.state),
+      'videoId': player.videoId,
+      'offset': player.offset,
+      'startTime': player.startTime,
+      'endTime': player.endTime,
+      'currentTimestamp': playback != null ? player.getCurrentTimestamp() : null,
+      'playback': playback,
+    })
+  }
+  return snapshot
+}
+
+// Returns the retained records, oldest first, in a JSON-friendly form.
+window.exportEventLog = function() {
+  var records = []
+  for (var i = Math.max(0, eventLogCount - EVENT_LOG_SIZE); i < eventLogCount; i++) {
+    var record = eventLog[i % EVENT_LOG_SIZE]
+    records.push({
+      'time': record.time,
+      'player': record.player,
+      'event': record.event,
+      'state': record.state == null ? null : String(record.state),
+      'details': record.details.map(detail => String(detail)),
+    })
+  }
+  return records
+}
+
+// Fires a 'log' event for every logged line, so that tests can wait for a message without each of them wrapping console.log.
+var logEvents = new EventTarget()
 var console_log = console.log
 console.log = function(...args) {
-  var logEvent = [new Date().toISOString(), ...args]
-  eventLog.push(logEvent.join('\t'))
-  if (location.hostname == 'localhost') console_log(logEvent.join(' ')) // Also emit to console in local testing for easier debugging
+  // Most of our log lines are about a specific player, so tag the record with it (and its current state).
+  var playerId = args.find(arg => typeof arg === 'string' && PLAYER_ID_MATCH.test(arg)) || null
+  var player = playerId != null ? players.get(playerId) : null
+  logEvent(playerId, 'log', player != null ? player.state : null, args)
+  if (location.hostname == 'localhost') console_log(new Date().toISOString(), ...args) // Also emit to console in local testing for easier debugging
+  logEvents.dispatchEvent(new CustomEvent('log', {detail: args}))
 }
 
+// Seeks go through a scheduler, which tracks each player's in-flight seek. A player which is asked to seek again while it's still
+// seeking remembers only the latest target, and seeks there once the current seek lands (so a burst of seeks costs each embed two seeks,
+// not one per request). Players which are already where they need to be aren't seeked at all, and stuck seeks are retried with backoff.
+const SEEK_TOLERANCE = 500 // ms. Players closer than this to the target (and in the target state) are left alone.
+const SEEK_RETRY_DELAY = 2000 // Doubles after every retry
+const SEEK_MAX_RETRIES = 5
+var inflightSeeks = new Map() // player id -> {player, timestamp, targetState, retries, timeout, pending: {timestamp, targetState}}
+var seekCounters = {'issued': 0, 'coalesced': 0, 'skipped': 0, 'retried': 0, 'abandoned': 0}
+
 function seekPlayersTo(timestamp, targetState) {
   console.log('Seeking all players to', timestamp, 'and state', targetState)
   for (var player of players.values()) {
     if (player.state === LOADING) continue // We cannot seek a video that hasn't loaded yet.
-    player.seekTo(timestamp, targetState)
+    seekPlayer(player, timestamp, targetState)
   }
+}
 
-  // Give up on the seek after 10 seconds (e.g. the network dies).
-  clearTimeout(pendingSeekTimeout)
-  pendingSeekTimeout = setTimeout(() => {
-    for (var player of players.values()) {
-      if ([SEEKING_PAUSE, SEEKING_PLAY, SEEKING_START, SEEKING_END].includes(player.state)) {
-        console.log(player.id, 'seek timed out in state', player.state, 'retrying seek')
-        // This should only re-seek this player, and won't set another timeout, so it shouldn't loop forever.
-        player.seekTo(timestamp, targetState)
-      }
+// Where this player's seek (or the one queued up behind it) is headed, or null if we don't have one in flight.
+function getSeekTarget(player) {
+  var inflight = inflightSeeks.get(player.id)
+  if (inflight == null || inflight.player !== player) return null
+  return (inflight.pending != null ? inflight.pending : inflight).timestamp
+}
+
+function seekPlayer(player, timestamp, targetState) {
+  var inflight = inflightSeeks.get(player.id)
+  if (inflight != null && inflight.player === player) {
+    inflight.pending = {'timestamp': timestamp, 'targetState': targetState}
+    seekCounters.coalesced++
+    return
+  }
+
+  if (player.state === targetState && Math.abs(player.getCurrentTimestamp() - timestamp) <= SEEK_TOLERANCE) {
+    seekCounters.skipped++
+    return
+  }
+
+  seekCounters.issued++
+  player.seekTo(timestamp, targetState)
+  // Not every seek needs to wait for the embed (e.g. mock players, or a player ignoring seeks because it started them).
+  if (SEEKING_STATES.includes(player.state)) {
+    inflight = {'player': player, 'timestamp': timestamp, 'targetState': targetState, 'retries': 0, 'timeout': null, 'pending': null}
+    inflightSeeks.set(player.id, inflight)
+    scheduleSeekRetry(inflight)
+  }
+}
+
+// If the seek hasn't landed in time (e.g. the network dies), seek again, waiting twice as long each time.
+function scheduleSeekRetry(inflight) {
+  var delay = SEEK_RETRY_DELAY * Math.pow(2, inflight.retries)
+  inflight.timeout = clock.setTimeout(() => {
+    var player = inflight.player
+    if (inflightSeeks.get(player.id) !== inflight) return
+    if (players.get(player.id) !== player) { // Removed while seeking
+      inflightSeeks.delete(player.id)
+      return
     }
-  }, 10000)
+    if (inflight.retries >= SEEK_MAX_RETRIES) {
+      console.log(player.id, 'seek timed out in state', player.state, 'after', inflight.retries, 'retries, giving up')
+      seekCounters.abandoned++
+      inflightSeeks.delete(player.id)
+      return
+    }
+
+    // Retry with the latest target, in case another seek came in while we were waiting.
+    if (inflight.pending != null) {
+      inflight.timestamp = inflight.pending.timestamp
+      inflight.targetState = inflight.pending.targetState
+      inflight.pending = null
+    }
+    console.log(player.id, 'seek timed out in state', player.state, 'retrying seek')
+    seekCounters.retried++
+    inflight.retries++
+    player.seekTo(inflight.timestamp, inflight.targetState)
+    scheduleSeekRetry(inflight)
+  }, delay)
+}
+
+function startSeekScheduler() {
+  // Once a player's seek lands, send it to the latest target (if another seek came in meanwhile).
+  playerEvents.addEventListener('statechange', (event) => {
+    var inflight = inflightSeeks.get(event.detail.player)
+    if (inflight == null || SEEKING_STATES.includes(event.detail.to)) return
+    clock.clearTimeout(inflight.timeout)
+    if (inflight.pending == null) {
+      inflightSeeks.delete(event.detail.player)
+      return
+    }
+    // Seeking now would change state again in the middle of this event, so listeners after us would see the transitions out of order.
+    // Instead, seek as soon as it's been delivered. Until then, the seek stays in flight, so any newer target still replaces the pending one.
+    // (Not on a timer, since another player's timer could run first, and see this one stopped at the old target.)
+    inflight.timeout = null
+    afterStateChange(() => {
+      if (inflightSeeks.get(inflight.player.id) !== inflight) return
+      inflightSeeks.delete(inflight.player.id)
+      if (players.get(inflight.player.id) === inflight.player) {
+        seekPlayer(inflight.player, inflight.pending.timestamp, inflight.pending.targetState)
+      }
+    })
+  })
+}
+
+window.getSeekCounters = function() { return {...seekCounters, 'inflight': inflightSeeks.size} }
+
+function resetSeekScheduler() {
+  for (var inflight of inflightSeeks.values()) clock.clearTimeout(inflight.timeout)
+  inflightSeeks.clear()
+  for (var counter in seekCounters) seekCounters[counter] = 0
 }
 
 function getTimelineBounds() {
@@ -705,37 +1010,28 @@ function getAveragePlayerTimestamp() {
 
 const TIMELINE_COLORS = ['#aaf', '#faa', '#afa', '#aff', '#faf', '#ffa']
 const TIMELINE_DATE_FORMAT = new Intl.DateTimeFormat({}, {'dateStyle': 'short', 'timeStyle': 'short'})
-function reloadTimeline() {
-  var timeline = document.getElementById('timeline')
-  if (timeline != null) timeline.remove()
-  if (players.size === 0) {
-    document.title = 'Twitch VOD Sync'
-    return // If there are no active videos, there's no need to show a timeline
-  }
-
-  var channels = []
-  for (var player of players.values()) {
-    if (player.channel != null) channels.push(player.channel)
-  }
-  document.title = 'TVS: ' + channels.join(' vs ')
 
-  timeline = document.createElement('div')
-  document.getElementById('app').appendChild(timeline)
-  timeline.id = 'timeline'
-  timeline.style = 'position: relative; display: flex'
+// The timeline DOM is only built once (and removed when there are no videos). After that, reloadTimeline only touches the rows
+// and labels which actually changed, and refreshTimeline batches its cursor and label updates into an animation frame.
+var timeline = null // See createTimeline
+function createTimeline() {
+  var root = document.createElement('div')
+  document.getElementById('app').appendChild(root)
+  root.id = 'timeline'
+  root.style = 'position: relative; display: flex'
 
   var remove = document.createElement('button')
-  timeline.appendChild(remove)
+  root.appendChild(remove)
   remove.style = 'width: 1.5em; height: 1.5em; border: 0'
   remove.innerText = '-'
   remove.addEventListener('pointerdown', () => removePlayer())
 
   var labels = document.createElement('div')
-  timeline.appendChild(labels)
+  root.appendChild(labels)
   labels.style = 'position: relative; display: flex; width: 100%; justify-content: space-between; margin: 0px 1px 0px 1px'
 
   var add = document.createElement('button')
-  timeline.appendChild(add)
+  root.appendChild(add)
   add.style = 'width: 1.5em; height: 1.5em; border: 0'
   add.innerText = '+'
   add.addEventListener('pointerdown', () => window.addPlayer())
@@ -745,28 +1041,7 @@ function reloadTimeline() {
   graphic.setAttribute('class', 'timeline-bg')
   graphic.style = 'position: absolute; width: 100%; height: 100%; z-index: -1'
 
-  var [timelineStart, timelineEnd] = getTimelineBounds()
-  var rowHeight = 100.0 / players.size
-  var i = 0
-  // Draw timeline rows in the same visual order as the player tiles, so rearranging the players also rearranges the timeline.
-  for (var playerDiv of getPlayerDivsInVisualOrder()) {
-    var player = players.get(playerDiv.id)
-    if (player == null) continue // Skip empty players in the timeline
-    var rect = document.createElementNS('http://www.w3.org/2000/svg', 'rect')
-    graphic.appendChild(rect)
-    rect.setAttribute('fill', player.color)
-    rect.setAttribute('height', rowHeight + '%')
-    rect.setAttribute('y', i * rowHeight + '%')
-
-    var start = 100.0 * (player.startTime - timelineStart) / (timelineEnd - timelineStart)
-    var end = 100.0 * (player.endTime - timelineStart) / (timelineEnd - timelineStart)
-    if (FEATURES.HIDE_ENDING_TIMES) end = 100.0 // Hide who won by right-justifying all video endings
-    rect.setAttribute('x', start + '%')
-    rect.setAttribute('width', (end - start) + '%')
-
-    i++
-  }
-
+  // Player rows are inserted before the cursor, so that it's always drawn on top.
   var cursor = document.createElementNS('http://www.w3.org/2000/svg', 'rect')
   graphic.appendChild(cursor)
   cursor.id = 'timelineCursor'
@@ -777,7 +1052,6 @@ function reloadTimeline() {
   var startLabel = document.createElement('div')
   labels.appendChild(startLabel)
   startLabel.style = 'margin-left: 3px; user-select: none'
-  startLabel.innerText = new Date(timelineStart).toLocaleString(TIMELINE_DATE_FORMAT)
 
   var currentLabel = document.createElement('div')
   currentLabel.id = 'timelineCurrent'
@@ -788,19 +1062,134 @@ function reloadTimeline() {
   labels.appendChild(endLabel)
   endLabel.id = 'timelineEnd'
   endLabel.style = 'margin-right: 3px; user-select: none'
-  endLabel.innerText = new Date(timelineEnd).toLocaleString(TIMELINE_DATE_FORMAT)
+
+  return {
+    'root': root,
+    'graphic': graphic,
+    'cursor': cursor,
+    'cursorX': null,
+    'startLabel': {'element': startLabel, 'text': null, 'minute': null},
+    'currentLabel': {'element': currentLabel, 'text': null, 'minute': null},
+    'endLabel': {'element': endLabel, 'text': null, 'minute': null},
+    'rows': new Map(), // player id -> {rect, attributes}
+    'pendingFrame': null, // What refreshTimeline wants drawn on the next animation frame
+  }
 }
 
-function refreshTimeline() {
-  var currentLabel = document.getElementById('timelineCurrent')
+function setAttributes(element, cache, attributes) {
+  for (var [name, value] of Object.entries(attributes)) {
+    if (cache[name] === value) continue
+    cache[name] = value
+    element.setAttribute(name, value)
+  }
+}
+
+function setLabelText(label, text) {
+  if (label.text === text) return
+  label.text = text
+  label.minute = null
+  label.element.innerText = text
+}
+
+// The labels only show minutes, so only reformat the date when the minute changes.
+function setLabelDate(label, timestamp) {
+  var minute = Math.floor(timestamp / 60000)
+  if (label.minute === minute) return
+  setLabelText(label, new Date(timestamp).toLocaleString(TIMELINE_DATE_FORMAT))
+  label.minute = minute
+}
+
+function reloadTimeline() {
+  if (players.size === 0) {
+    document.title = 'Twitch VOD Sync'
+    if (timeline != null) timeline.root.remove()
+    timeline = null
+    return // If there are no active videos, there's no need to show a timeline
+  }
+
+  var channels = []
+  for (var player of players.values()) {
+    if (player.channel != null) channels.push(player.channel)
+  }
+  var title = 'TVS: ' + channels.join(' vs ')
+  if (document.title != title) document.title = title
+
+  if (timeline == null) timeline = createTimeline()
+
+  var [timelineStart, timelineEnd] = getTimelineBounds()
+  var rowHeight = 100.0 / players.size
+  var i = 0
+  var staleRows = new Set(timeline.rows.keys())
+  // Draw timeline rows in the same visual order as the player tiles, so rearranging the players also rearranges the timeline.
+  for (var playerDiv of getPlayerDivsInVisualOrder()) {
+    var player = players.get(playerDiv.id)
+    if (player == null) continue // Skip empty players in the timeline
+    staleRows.delete(player.id)
+    var row = timeline.rows.get(player.id)
+    if (row == null) {
+      row = {'rect': document.createElementNS('http://www.w3.org/2000/svg', 'rect'), 'attributes': {}}
+      timeline.graphic.insertBefore(row.rect, timeline.cursor)
+      timeline.rows.set(player.id, row)
+    }
+
+    var start = 100.0 * (player.startTime - timelineStart) / (timelineEnd - timelineStart)
+    var end = 100.0 * (player.endTime - timelineStart) / (timelineEnd - timelineStart)
+    if (FEATURES.HIDE_ENDING_TIMES) end = 100.0 // Hide who won by right-justifying all video endings
+    setAttributes(row.rect, row.attributes, {
+      'fill': player.color,
+      'height': rowHeight + '%',
+      'y': i * rowHeight + '%',
+      'x': start + '%',
+      'width': (end - start) + '%',
+    })
+
+    i++
+  }
+
+  for (var playerId of staleRows) {
+    timeline.rows.get(playerId).rect.remove()
+    timeline.rows.delete(playerId)
+  }
+
+  setLabelDate(timeline.startLabel, timelineStart)
+  setLabelDate(timeline.endLabel, timelineEnd)
+}
+
+// Applies the latest cursor position and labels from refreshTimeline, at most once per frame.
+function drawTimelineFrame() {
+  if (timeline == null || timeline.pendingFrame == null) return // e.g. the timeline was removed (and rebuilt) since we asked for the frame
+  var frame = timeline.pendingFrame
+  timeline.pendingFrame = null
+  if (frame.mode != null) {
+    setLabelText(timeline.currentLabel, frame.mode)
+    return
+  }
+
+  var cursorX = frame.cursorPercent + '%'
+  if (timeline.cursorX !== cursorX) {
+    timeline.cursorX = cursorX
+    timeline.cursor.setAttribute('x', cursorX)
+  }
+  setLabelDate(timeline.currentLabel, frame.timestamp)
+  // In some cases, the video end times might be updated when we load the player(s), in which case the end timestamp will be wrong.
+  setLabelDate(timeline.endLabel, frame.timelineEnd)
+}
 
+function scheduleTimelineFrame(frame) {
+  if (timeline == null) return
+  var needsFrame = (timeline.pendingFrame == null) // Otherwise, a frame is already coming, and will draw this instead
+  timeline.pendingFrame = frame
+  if (needsFrame) requestAnimationFrame(drawTimelineFrame)
+}
+
+function refreshTimeline() {
   var anyVideoInAsync = Array.from(players.values()).some(p => p.state === ASYNC)
   if (anyVideoInAsync) {
-    if (currentLabel != null) currentLabel.innerText = 'ASYNC MODE'
+    scheduleTimelineFrame({'mode': 'ASYNC MODE'})
     return
   }
   if (isRearrangeMode()) {
-    if (currentLabel != null) currentLabel.innerText = 'REARRANGE MODE'
+    scheduleTimelineFrame({'mode': 'REARRANGE MODE'})
     return
   }
 
@@ -809,18 +1198,12 @@ function refreshTimeline() {
   if (timestamp == null) return // No videos are ready, leave the cursor where it is
 
   var [timelineStart, timelineEnd] = getTimelineBounds()
-
-  var cursor = document.getElementById('timelineCursor')
-  var perc = 100.0 * (timestamp - timelineStart) / (timelineEnd - timelineStart)
-  if (cursor != null) cursor.setAttribute('x', perc + '%')
-
-  if (currentLabel != null) {
-    currentLabel.innerText = new Date(timestamp).toLocaleString(TIMELINE_DATE_FORMAT)
-  }
-
-  // In some cases, the video end times might be updated when we load the player(s), in which case the end timestamp will be wrong.
-  var endLabel = document.getElementById('timelineEnd')
-  if (endLabel != null) endLabel.innerText = new Date(timelineEnd).toLocaleString(TIMELINE_DATE_FORMAT)
+  scheduleTimelineFrame({
+    'mode': null,
+    'timestamp': timestamp,
+    'cursorPercent': 100.0 * (timestamp - timelineStart) / (timelineEnd - timelineStart),
+    'timelineEnd': timelineEnd,
+  })
 
   // This is also a convenient moment to check if any players are waiting to start because we seeked before their starttime.
   for (var player of players.values()) {
@@ -844,27 +1227,97 @@ function refreshTimeline() {
       if (player.nextVideoDetails != null) continue // Already found a next video.
       if (timestamp < player.endTime - 60000) continue // Only search when we're 1 minute from the end of the video (or less)
 
+      // If we already know the channel's next video (see getPlaylist), there's no need to ask twitch.
+      if (player.playlist.length > 0) {
+        player.nextVideoDetails = player.playlist.shift()
+        continue
+      }
+
       player.nextVideoDetails = {'id': 0} // Add a placeholder object so we only make this call once.
 
-      getTwitchChannelVideos(player.channel)
-      .then(videos => {
+      // A live VOD may have grown since the channel was last fetched, so only trust a very recent video list.
+      getTwitchChannelVideos(player.channel, {'maxAge': 10000, 'coverTime': player._startTime})
+      .then(videoIndex => {
         // Case 1: Check if the current video's end time has shifted significantly.
-        var current = videos.find(video => video.id == player.videoId)
+        var current = videoIndex.find(player.videoId)
         if (current != null && Math.abs(current.endTime - player._endTime) > 1000) {
           player.nextVideoDetails = current
           return
         }
 
         // Case 2: Check if there's another video after this one but before the end timestamp.
-        // Twitch returns videos newest-first, so reverse to find the earliest match.
-        for (var video of videos.toReversed()) {
-          if (video.startTime > player._endTime && video.startTime <= timelineEnd) {
-            player.nextVideoDetails = video
-            return
-          }
+        var video = videoIndex.nextAfter(player._endTime)
+        if (video != null && video.startTime <= timelineEnd) {
+          player.nextVideoDetails = video
+          requestTimelineRefresh() // So that we preload it in time
         }
       })
     }
   }
+
+  // Shortly before a video ends, start loading the next one, so that the player doesn't stall when it switches over.
+  for (var player of players.values()) {
+    var nextVideo = player.nextVideoDetails
+    if (nextVideo == null || nextVideo.id == 0 || nextVideo.id == player.videoId) continue // Nothing to load, or just the same (live) VOD again
+    if (timestamp >= player.endTime - NEXT_VIDEO_PREWARM) player.prewarm(nextVideo)
+  }
+}
+
+// refreshTimeline doesn't need to run on a fixed poll. The cursor only moves while the videos are playing (and only needs drawing while
+// the page is visible), and the live checks above only fire at times we can compute: when the timeline reaches a waiting player's start,
+// or gets close to a player's end. So refreshTimeline runs whenever a player changes state (which includes every seek), and then
+// arms a single timer for whichever comes first: the next cursor update, or the next of those deadlines.
+const TIMELINE_REFRESH_INTERVAL = 100 // How often the cursor moves while the videos are playing
+var timelineRefresh = {'timeout': null, 'due': null}
+
+function startTimelineScheduler() {
+  playerEvents.addEventListener('statechange', () => requestTimelineRefresh())
+  document.addEventListener('visibilitychange', () => requestTimelineRefresh())
+  requestTimelineRefresh()
+}
+
+// Refreshes the timeline as soon as possible. Several requests in a row (e.g. from a burst of state changes) only refresh it once.
+function requestTimelineRefresh() { armTimelineRefresh(0) }
+
+function armTimelineRefresh(delay) {
+  if (delay == null) return // Nothing to wait for
+  var due = clock.now() + delay
+  if (timelineRefresh.timeout != null) {
+    if (timelineRefresh.due <= due) return // Already coming sooner
+    clock.clearTimeout(timelineRefresh.timeout)
+  }
+  timelineRefresh.due = due
+  timelineRefresh.timeout = clock.setTimeout(() => {
+    timelineRefresh.timeout = null
+    traceSpan(null, 'refreshTimeline', refreshTimeline)
+    armTimelineRefresh(getNextTimelineDeadline())
+  }, delay)
+}
+
+// How long (in ms) until refreshTimeline next has something to do, or null if it doesn't (until something changes).
+function getNextTimelineDeadline() {
+  var deadlines = []
+  var anyPlayerMoving = pendingSeekTimestamp > 0
+  var anyPlayerPlaying = false
+  for (var player of players.values()) {
+    if (player.state === PLAYING) anyPlayerPlaying = true
+    if (player.state === PLAYING || SEEKING_STATES.includes(player.state)) anyPlayerMoving = true
+  }
+  if (anyPlayerMoving && document.visibilityState === 'visible') deadlines.push(TIMELINE_REFRESH_INTERVAL)
+
+  // The timeline only advances while something is playing. Until then, nothing can reach its deadline.
+  var timestamp = getAveragePlayerTimestamp()
+  if (anyPlayerPlaying && timestamp != null) {
+    for (var player of players.values()) {
+      if (player.state === BEFORE_START) deadlines.push(player.startTime - timestamp)
+      if (FEATURES.DO_TWITCH_AUTH && player.nextVideoDetails == null) deadlines.push(player.endTime - 60000 - timestamp)
+      if (player.nextVideoDetails != null && player.nextVideoDetails.id != 0) deadlines.push(player.endTime - NEXT_VIDEO_PREWARM - timestamp)
+    }
+  }
+
+  // Deadlines in the past were handled by the refresh which just ran. (Players play at about 1x, so a deadline may come slightly early,
+  // e.g. if a player stalled. In that case refreshTimeline doesn't act yet, and we just compute the deadline again.)
+  deadlines = deadlines.filter(deadline => deadline > 0)
+  return deadlines.length > 0 ? Math.min(...deadlines) : null
 }
 
@@ -18,6 +18,7 @@ const RESTARTING    = enumValue('RESTARTING')
 const SEEKING_END   = enumValue('SEEKING_END')
 const AFTER_END     = enumValue('AFTER_END')
 const ASYNC         = enumValue('ASYNC')
+const SEEKING_STATES = [SEEKING_PLAY, SEEKING_PAUSE, SEEKING_START, SEEKING_END]
 
 // If you seek (manually or automatically) to a timestamp within the last 10 seconds, twitch ends the video and starts auto-playing the next one.
 // When a video ends, I want to leave it paused somewhere near the end screen -- so this value represents a safe point to seek to which avoids autoplay.
@@ -46,15 +47,35 @@ const QUALITY_TABLE = new Map(Object.entries({
 
 window.newPlayer = function(divId, videos, playerType) {
   if (videos == null || videos.length === 0) throw new Exception('Invalid videos: ' + videos.toString())
-  var videoDetails = videos[0] // TODO: Support multiple videos here?
+  var videoDetails = videos[0]
+
+  var player = null
+  if (playerType === TWITCH)  player = new TwitchPlayer(divId, videoDetails)
+  if (playerType === MOCK)    player = new MockPlayer(divId, videoDetails)
+  if (player == null) throw new Exception('Unknown player type: ' + playerType.toString())
+  // Any other videos are consecutive VODs from the same channel, which play after the first one (see refreshTimeline)
+  player.playlist = videos.slice(1)
+  return player
+}
 
-  if (playerType === TWITCH)  return new TwitchPlayer(divId, videoDetails)
-  if (playerType === MOCK)    return new MockPlayer(divId, videoDetails)
-  throw new Exception('Unknown player type: ' + playerType.toString())
+// Fires a 'statechange' event whenever any player changes state, so that callers (mostly tests) can react to transitions without polling.
+// The event detail is {player, from, to, duration}, where duration is how long (in ms) the player spent in the previous state.
+window.playerEvents = new EventTarget()
+var stateChangeDepth = 0 // How many statechange events are being delivered right now (listeners can change state too)
+var afterStateChangeQueue = []
+
+// Runs the callback once the current statechange has reached every listener (or right away, if there isn't one).
+// Listeners which want to change a player's state should use this, so that later listeners still see the transitions in order.
+function afterStateChange(callback) {
+  if (stateChangeDepth === 0) callback()
+  else afterStateChangeQueue.push(callback)
 }
 
 class Player {
   constructor(divId, videoDetails) {
+    this.id = divId
+    this._state = null
+    this._stateChangedAt = performance.now()
     this.state = LOADING
 
     this.channel = videoDetails.channel
@@ -62,34 +83,316 @@ class Player {
     this._endTime = videoDetails.endTime
     this.videoId = videoDetails.id
     this.offset = 0
-    this.id = divId
     this.nextVideoDetails = null
+    this.playlist = []
+  }
+
+  get state() { return this._state }
+  set state(newState) {
+    var now = performance.now()
+    var detail = {player: this.id, from: this._state, to: newState, duration: now - this._stateChangedAt}
+    if (this._state != null) {
+      // One span per state, so that the trace shows each player's state machine on its own track.
+      recordTrace({'name': TRACE_PREFIX + String(this._state), 'entryType': 'measure', 'startTime': this._stateChangedAt, 'duration': now - this._stateChangedAt, 'detail': {'player': this.id, 'category': 'state'}})
+    }
+    this._state = newState
+    this._stateChangedAt = now
+    logEvent(this.id, 'state', newState, [])
+    stateChangeDepth++
+    try {
+      playerEvents.dispatchEvent(new CustomEvent('statechange', {detail: detail}))
+    } finally {
+      stateChangeDepth--
+    }
+    while (stateChangeDepth === 0 && afterStateChangeQueue.length > 0) afterStateChangeQueue.shift()()
   }
 
   get startTime() { return this._startTime + this.offset }
   get endTime() { return this._endTime + this.offset }
 
   seekToEnd() { this.seekTo(this.endTime) }
+
+  // Start loading the next video in the background, if that's slow enough to be worth it (see TwitchPlayer)
+  prewarm(videoDetails) {}
+}
+
+// Each Twitch embed is an iframe which loads the whole Twitch player (and then the video), so loading a URL with many players
+// at once has them all fighting over CPU and bandwidth. Instead, embeds are created a few at a time, visible tiles first.
+// Players wait in the LOADING state until they get a slot, and give it up once they leave LOADING (or time out).
+// Preloading the next video (see TwitchPlayer.prewarm) takes a slot too, which it gives up once the standby embed is loaded.
+const EMBED_LOAD_CONCURRENCY = 3
+const EMBED_LOAD_TIMEOUT = 15000
+var embedQueue = [] // {player, standby} waiting for a slot, where standby is null for the player's own embed
+var embedsLoading = new Map() // player id -> {player, standby, timeout}
+var embedLoadTimings = new Map() // player id -> {queued, started, embedReady, ready}, from performance.now()
+
+function queueEmbed(player, standby=null) {
+  embedQueue.push({'player': player, 'standby': standby})
+  if (standby == null) embedLoadTimings.set(player.id, {'queued': performance.now(), 'started': null, 'embedReady': null, 'ready': null})
+  // Wait for the current batch of players (e.g. everything from the URL) to be queued, so that we can pick the best ones to start.
+  clock.setTimeout(startQueuedEmbeds, 0)
+}
+
+function isTileVisible(div) {
+  var rect = div.getBoundingClientRect()
+  return rect.width > 0 && rect.height > 0 && rect.bottom > 0 && rect.right > 0 && rect.top < window.innerHeight && rect.left < window.innerWidth
+}
+
+function startQueuedEmbeds() {
+  // Players which were removed while waiting (or loading) don't need a slot anymore, and neither do discarded standbys.
+  embedQueue = embedQueue.filter(entry => players.get(entry.player.id) === entry.player && (entry.standby == null || entry.player._standby === entry.standby))
+  for (var [playerId, loading] of embedsLoading) {
+    if (players.get(playerId) !== loading.player) finishEmbed(playerId, /*start*/false)
+  }
+  if (embedQueue.length === 0 || embedsLoading.size >= EMBED_LOAD_CONCURRENCY) return
+
+  var visualOrder = getPlayerDivsInVisualOrder().map(div => div.id)
+  // Preloads can wait, since their player already has a video to watch.
+  var priority = (entry) => {
+    var div = document.getElementById(entry.player.id)
+    return (entry.standby != null ? 2 * visualOrder.length : 0) + (isTileVisible(div) ? 0 : visualOrder.length) + visualOrder.indexOf(entry.player.id)
+  }
+  embedQueue.sort((a, b) => priority(a) - priority(b))
+
+  while (embedQueue.length > 0 && embedsLoading.size < EMBED_LOAD_CONCURRENCY) {
+    let {player, standby} = embedQueue.shift()
+    var timeout = clock.setTimeout(() => {
+      console.log(player.id, 'is taking a long time to load, letting another player start loading')
+      finishEmbed(player.id)
+    }, EMBED_LOAD_TIMEOUT)
+    embedsLoading.set(player.id, {'player': player, 'standby': standby, 'timeout': timeout})
+    if (standby != null) {
+      logEvent(player.id, 'load', player.state, ['standby embed started', embedsLoading.size, embedQueue.length])
+      player.createStandbyEmbed(standby)
+      continue
+    }
+    embedLoadTimings.get(player.id).started = performance.now()
+    logEvent(player.id, 'load', player.state, ['embed started', embedsLoading.size, embedQueue.length])
+    player.createEmbed()
+  }
+}
+
+function finishEmbed(playerId, start=true) {
+  var loading = embedsLoading.get(playerId)
+  if (loading == null) return
+  clock.clearTimeout(loading.timeout)
+  embedsLoading.delete(playerId)
+  if (start) startQueuedEmbeds()
+}
+
+playerEvents.addEventListener('statechange', (event) => {
+  if (event.detail.from !== LOADING) return
+  var timings = embedLoadTimings.get(event.detail.player)
+  if (timings != null && timings.ready == null) {
+    timings.ready = performance.now()
+    logEvent(event.detail.player, 'load', event.detail.to, ['ready after', timings.ready - timings.queued])
+  }
+  finishEmbed(event.detail.player)
+})
+
+// How long each player spent in each load phase, in ms: waiting for a slot, creating the embed, and loading the video.
+window.getEmbedLoadTimings = function() {
+  var result = {}
+  for (var [playerId, timings] of embedLoadTimings) {
+    var phase = (from, to) => (timings[from] != null && timings[to] != null) ? timings[to] - timings[from] : null
+    result[playerId] = {
+      'queued': phase('queued', 'started'),
+      'embed': phase('started', 'embedReady'),
+      'video': phase('embedReady', 'ready'),
+      'total': phase('queued', 'ready'),
+    }
+  }
+  return result
+}
+
+// When a video ends and the player moves on to the next one (see refreshTimeline), we record how long it took to get going again.
+// If the next video was preloaded (see TwitchPlayer.prewarm), that's about one seek, otherwise the embed has to load the new video first.
+const NEXT_VIDEO_PREWARM = 30000 // How long before the end of a video we start preloading the next one
+var handoffs = [] // {player, from, to, prewarmed, started, finished}, from clock.now()
+var pendingHandoffs = new Map() // player id -> its unfinished entry in handoffs
+
+function startHandoff(player, videoDetails, prewarmed) {
+  var handoff = {'player': player.id, 'from': player.videoId, 'to': videoDetails.id, 'prewarmed': prewarmed, 'started': clock.now(), 'finished': null}
+  handoffs.push(handoff)
+  pendingHandoffs.set(player.id, handoff)
+}
+
+playerEvents.addEventListener('statechange', (event) => {
+  var handoff = pendingHandoffs.get(event.detail.player)
+  if (handoff == null || [LOADING, READY, ...SEEKING_STATES].includes(event.detail.to)) return
+  handoff.finished = clock.now()
+  pendingHandoffs.delete(event.detail.player)
+  logEvent(handoff.player, 'handoff', event.detail.to, ['switched to', handoff.to, 'after', handoff.finished - handoff.started, handoff.prewarmed ? 'preloaded' : 'not preloaded'])
+})
+
+window.getHandoffTimings = function() {
+  return handoffs.map(handoff => ({...handoff, 'latency': handoff.finished != null ? handoff.finished - handoff.started : null}))
+}
+
+function resetHandoffs() {
+  handoffs = []
+  pendingHandoffs.clear()
+}
+
+// With many embeds at high quality, the players compete for bandwidth and keep stalling to buffer (which also knocks them out of sync).
+// So we track how often, and for how long, each player buffers. If they buffer too much between them, every player steps down one
+// quality (along QUALITY_TABLE), and once playback has been stable for a while, they step back up. We never go above the user's choice ('q').
+const QUALITY_SAMPLE_INTERVAL = 1000
+const BUFFERING_WINDOW = 30000
+const BUFFERING_BUDGET = 3000 // Total ms that all the players can spend buffering, per BUFFERING_WINDOW
+const BUFFERING_EPISODE_BUDGET = 5 // Total number of times that the players can start buffering, per BUFFERING_WINDOW
+const QUALITY_CHANGE_COOLDOWN = 10000 // Give the players time to settle at a new quality before judging it
+const QUALITY_STABLE_TIME = 60000 // How long without any buffering before we try a higher quality again
+const BUFFERING_GRACE = 3000 // Players always buffer for a bit after they start playing (e.g. after a seek), which isn't a bandwidth problem
+var bufferingStats = new Map() // player id -> {since, episodes: [{start, end}], appliedCap, needsReapply, playingSince}
+var qualityCap = null // Rank (see qualityRank) of the best quality we currently allow, or null for no limit
+var lastQualityChange = 0
+
+function qualityRank(quality) {
+  var [height, fps] = QUALITY_TABLE.get(quality)
+  return height * 1000 + fps
+}
+
+window.startQualityGovernor = function() {
+  lastQualityChange = clock.now()
+  clock.setInterval(() => sampleBuffering(), QUALITY_SAMPLE_INTERVAL)
+}
+
+// Called when the user picks a quality manually, which takes priority over whatever we had decided.
+window.resetQualityGovernor = function() {
+  qualityCap = null
+  lastQualityChange = clock.now()
+  for (var stats of bufferingStats.values()) stats.appliedCap = null
+}
+
+function getBufferingStats(playerId) {
+  var stats = bufferingStats.get(playerId)
+  if (stats == null) {
+    stats = {'since': null, 'episodes': [], 'appliedCap': null, 'needsReapply': false, 'playingSince': null}
+    bufferingStats.set(playerId, stats)
+  }
+  return stats
+}
+
+// Called when a player's embed changes (e.g. a handoff), since the new one starts at twitch's default quality.
+// We apply our cap (and the user's choice) right away, and again once it's playing, in case the embed didn't have its qualities yet.
+function resetAppliedCap(player) {
+  var quality = getBestQuality(player)
+  if (quality != null) player.setQuality(quality)
+  getBufferingStats(player.id).needsReapply = true
+}
+
+playerEvents.addEventListener('statechange', (event) => {
+  if (event.detail.to === PLAYING) getBufferingStats(event.detail.player).playingSince = clock.now()
+})
+
+function sampleBuffering() {
+  var now = clock.now()
+  var totalBuffering = 0
+  var totalEpisodes = 0
+  for (var player of players.values()) {
+    var stats = getBufferingStats(player.id)
+    var settled = (stats.playingSince == null || now - stats.playingSince >= BUFFERING_GRACE)
+    var buffering = (player.state === PLAYING && settled && player.isBuffering())
+    if (buffering && stats.since == null) {
+      stats.since = now
+      stats.episodes.push({'start': now, 'end': null})
+    } else if (!buffering && stats.since != null) {
+      stats.since = null
+      stats.episodes.at(-1).end = now
+    }
+    stats.episodes = stats.episodes.filter(episode => episode.end == null || episode.end > now - BUFFERING_WINDOW)
+    for (var episode of stats.episodes) {
+      totalBuffering += (episode.end != null ? episode.end : now) - Math.max(episode.start, now - BUFFERING_WINDOW)
+      totalEpisodes++
+    }
+
+    // Players which loaded (or started playing) after our last decision still need to be told about it.
+    if (player.state === PLAYING && (stats.needsReapply || stats.appliedCap !== qualityCap)) {
+      stats.appliedCap = qualityCap
+      stats.needsReapply = false
+      var quality = getBestQuality(player)
+      if (quality != null) player.setQuality(quality)
+    }
+  }
+
+  if (now - lastQualityChange < QUALITY_CHANGE_COOLDOWN) return
+  if (totalBuffering > BUFFERING_BUDGET || totalEpisodes > BUFFERING_EPISODE_BUDGET) {
+    stepQuality(/*down*/true, ['after', totalBuffering, 'ms of buffering in', totalEpisodes, 'episodes'])
+  } else if (qualityCap != null && totalEpisodes === 0 && now - lastQualityChange >= QUALITY_STABLE_TIME) {
+    stepQuality(/*down*/false, ['after', now - lastQualityChange, 'ms without buffering'])
+  }
+}
+
+// The best quality this player offers, within our cap (and the user's choice).
+function getBestQuality(player) {
+  var maxRank = Math.min(qualityCap != null ? qualityCap : Infinity, currentQuality != null ? qualityRank(currentQuality) : Infinity)
+  var qualities = Array.from(player.getQualities()).filter(quality => qualityRank(quality) <= maxRank)
+  if (qualities.length === 0) return null
+  return qualities.reduce((a, b) => qualityRank(a) >= qualityRank(b) ? a : b)
+}
+
+function stepQuality(down, reason) {
+  // Every distinct quality any player offers, best first (and no better than what the user picked)
+  var ranks = new Set()
+  for (var player of players.values()) {
+    for (var quality of player.getQualities()) ranks.add(qualityRank(quality))
+  }
+  var userRank = currentQuality != null ? qualityRank(currentQuality) : Infinity
+  ranks = Array.from(ranks).filter(rank => rank <= userRank).sort((a, b) => b - a)
+  if (ranks.length === 0) return
+
+  var index = (qualityCap == null) ? 0 : ranks.findIndex(rank => rank <= qualityCap)
+  if (index === -1) index = ranks.length - 1
+  var newIndex = index + (down ? 1 : -1)
+  if (newIndex < 0 || newIndex >= ranks.length) return // Already as high (or low) as we can go
+
+  var describe = (rank) => (rank == null) ? 'no limit' : Math.floor(rank / 1000) + 'p' + (rank % 1000)
+  var newCap = (newIndex === 0) ? null : ranks[newIndex]
+  logEvent(null, 'quality', null, [down ? 'stepped down' : 'stepped up', 'from', describe(qualityCap), 'to', describe(newCap), ...reason])
+  qualityCap = newCap
+  lastQualityChange = clock.now()
+  // Start judging the new quality from scratch (keeping track of any players which are still buffering).
+  for (var stats of bufferingStats.values()) {
+    stats.episodes = (stats.since != null) ? [{'start': lastQualityChange, 'end': null}] : []
+    if (stats.since != null) stats.since = lastQualityChange
+  }
 }
 
 class TwitchPlayer extends Player {
   constructor(divId, videoDetails) {
     super(divId, videoDetails)
+    this._player = null // Created once the loader gives us a slot (see queueEmbed)
+    queueEmbed(this)
+  }
 
+  createEmbed() {
     var options = {
       width: '100%',
       height: '100%',
-      video: videoDetails.id,
+      video: this.videoId,
       autoplay: false,
       muted: true,
     }
-    this._player = new Twitch.Player(divId, options)
-    this._player.addEventListener('ready', () => this.onPlayerReady())
+    this._player = new Twitch.Player(this.id, options)
+    this._player.addEventListener('ready', () => {
+      embedLoadTimings.get(this.id).embedReady = performance.now()
+      this.onPlayerReady()
+    })
   }
 
   onPlayerReady() {
     // Only hook events once the player has loaded, so we don't have to worry about events in the LOADING state.
-    this._player.addEventListener('seek', (eventData) => {
+    this.hookEvents(this._player)
+  }
+
+  hookEvents(embed) {
+    // We can have a second embed preloading the next video (see prewarm), so only listen to whichever embed is currently ours.
+    var on = (event, callback) => embed.addEventListener(event, (eventData) => {
+      if (embed === this._player) callback(eventData)
+    })
+
+    on('seek', (eventData) => {
       // Twitch sends a seek event after the video is ready, to jump to your 'last watched' timestamp.
       if (this.state === LOADING) {
         var initialTimestamp = this.startTime + Math.floor(eventData.position * 1000)
@@ -111,23 +414,108 @@ class TwitchPlayer extends Player {
       var seekMillis = Math.floor(eventData.position * 1000)
       this.eventSink('seek', seekMillis)
     })
-    this._player.addEventListener('play',  () => {
+    on('play',  () => {
       // Twitch loads the "true" video duration once it starts playing. We use that to update our end time,
       // since there's a chance that the video is a live VOD, and its duration doesn't match what the API returned.
       var durationMillis = Math.floor(this._player.getDuration() * 1000)
       this._endTime = this._startTime + durationMillis
       this.eventSink('play')
     })
-    this._player.addEventListener('pause', () => {
+    on('pause', () => {
       // Twitch has started sending 'paused' instead of 'ended' some times.
       if (this.getCurrentTimestamp() > this.endTime) this.eventSink('ended')
       else this.eventSink('pause')
     })
-    this._player.addEventListener('ended', () => this.eventSink('ended'))
+    on('ended', () => this.eventSink('ended'))
 
     // I did not end up using the 'playing' event -- for the most part, twitch pauses videos when the buffer runs out,
     // which is a sufficient signal to sync up the videos again (although they don't start playing automatically again).
-    this._player.addEventListener('playing', () => this.eventSink('test_playing'))
+    on('playing', () => this.eventSink('test_playing'))
+  }
+
+  // Creating an embed and loading a video takes a few seconds, which would leave this player stalled (and out of sync) at the end
+  // of each video. So shortly before the end, we load the next video into a hidden embed, and seek it to where it'll pick up.
+  // The embed waits for a loader slot like any other (see queueEmbed).
+  prewarm(videoDetails) {
+    if (this._player == null || this.state === LOADING || this._standby != null) return
+    console.log(this.id, 'is queueing a preload of the next video', videoDetails.id)
+    this._standby = {'video': videoDetails, 'embed': null, 'frame': null, 'warm': false}
+    queueEmbed(this, this._standby)
+  }
+
+  createStandbyEmbed(standby) {
+    var videoDetails = standby.video
+    var div = document.getElementById(this.id)
+    var embed = new Twitch.Player(this.id, {
+      width: '100%',
+      height: '100%',
+      video: videoDetails.id,
+      autoplay: false,
+      muted: true,
+    })
+    // Not display: none, since the embed still needs a size to load into. Note that moving an iframe would reload it, so it stays here.
+    var frame = div.lastElementChild
+    frame.style.position = 'absolute'
+    frame.style.top = '0'
+    frame.style.left = '0'
+    frame.style.visibility = 'hidden'
+
+    standby.embed = embed
+    standby.frame = frame
+    embed.addEventListener('ready', () => {
+      this.hookEvents(embed)
+      // Like any embed, it's loaded once twitch sends the initial seek.
+      embed.addEventListener('seek', () => {
+        if (standby.warm) return
+        standby.warm = true
+        this.finishStandbyEmbed(standby)
+        var durationSeconds = Math.max(this._endTime - videoDetails.startTime, 1) / 1000.0 // I think seek(0) does something wrong, so.
+        logEvent(this.id, 'handoff', this.state, ['preloaded', videoDetails.id, 'seeking it to', durationSeconds])
+        embed.seek(durationSeconds)
+      })
+    })
+  }
+
+  // Gives up the loader slot, if this standby still has it.
+  finishStandbyEmbed(standby) {
+    var loading = embedsLoading.get(this.id)
+    if (loading != null && loading.standby === standby) finishEmbed(this.id)
+  }
+
+  discardStandby() {
+    if (this._standby == null) return
+    this.finishStandbyEmbed(this._standby)
+    if (this._standby.frame != null) this._standby.frame.remove()
+    this._standby = null
+  }
+
+  // Swaps in the preloaded embed, and starts it from where the timeline is now.
+  handoff() {
+    var standby = this._standby
+    this._standby = null
+    startHandoff(this, standby.video, /*prewarmed*/true)
+
+    // The players we're synced with kept going while this video ended, so pick up wherever they are.
+    var otherPlayers = Array.from(players.values()).filter(player => player !== this && player.state === PLAYING)
+    var timestamp = this.endTime
+    if (otherPlayers.length > 0) timestamp = otherPlayers.reduce((sum, player) => sum + player.getCurrentTimestamp(), 0) / otherPlayers.length
+
+    for (var frame of document.getElementById(this.id).querySelectorAll(':scope > iframe')) {
+      if (frame !== standby.frame) frame.remove()
+    }
+    standby.frame.style.position = standby.frame.style.top = standby.frame.style.left = standby.frame.style.visibility = ''
+    this._player = standby.embed
+    this._startTime = standby.video.startTime
+    this._endTime = standby.video.endTime
+    this.videoId = standby.video.id
+    this.nextVideoDetails = null
+    reloadTimeline()
+
+    resetAppliedCap(this)
+
+    // The new embed is loaded and paused, so it's READY. If the next video hasn't started yet, this leaves it BEFORE_START.
+    this.state = READY
+    seekPlayer(this, timestamp, PLAYING)
   }
 
   getCurrentTimestamp() {
@@ -135,8 +523,20 @@ class TwitchPlayer extends Player {
     return this._startTime + this.offset + durationMillis
   }
 
+  // What the embed itself reports, which may disagree with our state (e.g. if an event was dropped)
+  getPlaybackState() {
+    return {
+      'currentTime': this._player.getCurrentTime(),
+      'duration': this._player.getDuration(),
+      'paused': this._player.isPaused(),
+      'ended': this._player.getEnded(),
+      'quality': this._player.getQuality(),
+    }
+  }
+
   getQualities() {
     var qualities = new Set()
+    if (this._player == null) return qualities // Still waiting for the loader
     for (var quality of this._player.getQualities()) {
       if (!QUALITY_TABLE.has(quality.group)) continue
       qualities.add(quality.group)
@@ -145,7 +545,12 @@ class TwitchPlayer extends Player {
     return qualities
   }
 
+  isBuffering() {
+    return this._player != null && this._player.getPlayerState().playback === 'Buffering'
+  }
+
   setQuality(qualityName) {
+    if (this._player == null) return
     for (var quality of this._player.getQualities()) {
       if (!QUALITY_TABLE.has(quality.group)) continue
       if (quality.group == qualityName) {
@@ -155,9 +560,10 @@ class TwitchPlayer extends Player {
     }
   }
 
-  play() { this._player.play() }
-  pause() { this._player.pause() }
+  play() { if (this._player != null) this._player.play() }
+  pause() { if (this._player != null) this._player.pause() }
   seekTo(timestamp, targetState) {
+    traceMark(this.id, 'seekTo', {'timestamp': timestamp, 'targetState': String(targetState)})
     // If there is a seek pending FROM US, ignore all 'seekTo' instructions, since they're almost certainly noise.
     if (pendingSeekTimestamp > 0 && pendingSeekSource == this.id) return
 
@@ -194,6 +600,10 @@ class TwitchPlayer extends Player {
   }
 
   eventSink(event, seekMillis) {
+    traceSpan(this.id, 'eventSink ' + event, () => this.handleEvent(event, seekMillis))
+  }
+
+  handleEvent(event, seekMillis) {
     console.log(this.id, 'received event', event, 'while in state', this.state, seekMillis)
 
     if (event == 'seek') {
@@ -331,6 +741,10 @@ class TwitchPlayer extends Player {
         case RESTARTING:    // which means our video's start and end times would be wrong for future sync actions.
         case SEEKING_END:
         case AFTER_END:
+          if (this._standby != null && (this.nextVideoDetails == null || this._standby.video.id != this.nextVideoDetails.id)) {
+            this.discardStandby() // We preloaded a video which isn't next anymore
+          }
+
           if (this.nextVideoDetails == null || this.nextVideoDetails.id == 0) {
             // Once a video as ended, 'play' is the only way to interact with it automatically.
             // To bring it back into an interactable state, we play() the video and wait for it to restart from the beginning.
@@ -338,9 +752,16 @@ class TwitchPlayer extends Player {
             this.state = RESTARTING
             this.play() // This play command will trigger a seek to the beginning first, then a play.
             break
+          } else if (this._standby != null && this._standby.warm && this.state === PLAYING) {
+            // The usual case: the video played out, and we've already loaded the next one, so we can switch to it straight away.
+            console.log(this.id, 'reached the end of the timeline with the next video preloaded, switching to', this.nextVideoDetails.id)
+            this.handoff()
+            break
           } else {
             // In some cases, we already have the next video queued up, and want to load that up to play instead of going through the restart loop.
             console.log(this.id, 'reached the end of the timeline with another video queued, starting', this.nextVideoDetails.id)
+            this.discardStandby()
+            startHandoff(this, this.nextVideoDetails, /*prewarmed*/false)
             this.state = LOADING
             // We need to return control to the main loop for Twitch to unload properly.
             this._startTime = this.nextVideoDetails.startTime
@@ -365,14 +786,13 @@ class TwitchPlayer extends Player {
     if (pendingSeekTimestamp > 0) {
       var anyPlayerStillSeeking = false
       for (var player of players.values()) {
-        if ([SEEKING_PLAY, SEEKING_PAUSE, SEEKING_START, SEEKING_END].includes(player.state)) anyPlayerStillSeeking = true
+        if (SEEKING_STATES.includes(player.state)) anyPlayerStillSeeking = true
       }
 
       if (!anyPlayerStillSeeking) {
         console.log(this.id, 'was last to finish seeking to', pendingSeekTimestamp, 'setting pendingSeekTimestamp to 0')
-        clearTimeout(pendingSeekTimeout)
         // Defer the completion by 100ms in case the seek finishes before a 'play' event arrives.
-        setTimeout(() => {
+        clock.setTimeout(() => {
           pendingSeekTimestamp = 0
           pendingSeekSource = null
         }, 100)
@@ -389,15 +809,56 @@ class MockPlayer extends Player {
     document.getElementById(divId).appendChild(document.createElement('iframe'))
     
     this.currentTimestamp = videoDetails['initial'] || 0
-
-    // Mock players are ready after exactly 1 second
-    setTimeout(() => this.onready(this, this.currentTimestamp), 1000)
+    // By default, mock players seek instantly. Benchmarks can add latency to make them behave more like real embeds.
+    this.seekLatency = videoDetails['seekLatency'] || 0
+    this.pendingSeek = null
+    this.qualities = videoDetails['qualities'] || ['1080p60', '720p60', '480p30', '160p30']
+    this.quality = this.qualities[0]
+    // Simulates a bandwidth limit: the player buffers whenever it's playing above this height (e.g. 720). Tests can change it at any time.
+    this.bufferAbove = videoDetails['bufferAbove'] || null
+    // Like a real embed, the player can also buffer for a while after each seek (in ms), regardless of quality.
+    this.seekBuffering = videoDetails['seekBuffering'] || 0
+    this.bufferingUntil = 0
+
+    // Mock players are ready after exactly 1 second (unless otherwise specified)
+    clock.setTimeout(() => this.onready(this, this.currentTimestamp), videoDetails['readyDelay'] || 1000)
   }
   
   getCurrentTimestamp() { return this.currentTimestamp }
+
+  // Mock videos don't actually play, so there's nothing to start or stop. (Callers set the state themselves.)
+  play() {}
+  pause() {}
+
+  getPlaybackState() {
+    return {
+      'currentTime': (this.currentTimestamp - this.startTime) / 1000,
+      'duration': (this._endTime - this._startTime) / 1000,
+      'paused': this.state !== PLAYING,
+      'ended': this.state === AFTER_END,
+      'quality': this.quality,
+    }
+  }
+
+  getQualities() { return new Set(this.qualities) }
+  setQuality(qualityName) { if (this.qualities.includes(qualityName)) this.quality = qualityName }
+  isBuffering() {
+    if (clock.now() < this.bufferingUntil) return true
+    return this.bufferAbove != null && QUALITY_TABLE.get(this.quality)[0] > this.bufferAbove
+  }
   
   seekTo(timestamp, targetState) {
+    traceMark(this.id, 'seekTo', {'timestamp': timestamp, 'targetState': String(targetState)})
     this.currentTimestamp = timestamp
-    this.state = targetState
+    this.bufferingUntil = clock.now() + this.seekLatency + this.seekBuffering
+    if (this.seekLatency === 0) {
+      this.state = targetState
+      return
+    }
+
+    // Like a real embed, stay in a SEEKING state until the seek 'completes'. A newer seek replaces any pending one.
+    this.state = (targetState === PLAYING) ? SEEKING_PLAY : SEEKING_PAUSE
+    clock.clearTimeout(this.pendingSeek)
+    this.pendingSeek = clock.setTimeout(() => { this.state = targetState }, this.seekLatency)
   }
 }
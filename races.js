@@ -1,9 +1,13 @@
 (() => {
 
 // For now, I have just integrated with racetime.gg. If we need more integration, we might need auth.
+// Tests can point this at a local stand-in (see http_server.py) so that they don't depend on the real API.
+var RACETIME_BASE = 'https://racetime.gg'
+window.overrideRacetimeBase = function(racetimeBase) { RACETIME_BASE = racetimeBase }
+
 window.getRacetimeRaceDetails = function(raceId) {
   // e.g. 'https://racetime.gg/dk64r/wonderful-krossbones-7951/data'
-  return fetch('https://racetime.gg/' + raceId + '/data')
+  return fetch(RACETIME_BASE + '/' + raceId + '/data')
   .then(r => {
     if (r.status != 200) return Promise.reject('HTTP request failed: ' + r.status)
     return r.json()
@@ -17,30 +21,65 @@ window.getRacetimeRaceDetails = function(raceId) {
   })
 }
 
+// Entrants' videos are looked up a few at a time. Browsers only allow ~6 connections per host anyway.
+const RACE_LOOKUP_CONCURRENCY = 4
+
 window.loadRaceVideos = async function(race, count, skipChannels) {
-  var raceVideos = []
-  for (var channel of race.channels) {
-    if (skipChannels.has(channel)) continue
+  // Entrants are in finishing order, and we keep that order: the first `count` entrants with a video overlapping the race start win.
+  var channels = race.channels.filter(channel => channel != null && !skipChannels.has(channel))
+
+  // Look up all of the entrants at once, rather than making a users request for each one.
+  try {
+    var userIds = await getTwitchUserIds(channels)
+  } catch (ex) {
+    console.warn(ex)
+    return []
+  }
+
+  var results = new Array(channels.length).fill(undefined) // Each entry becomes a video, or null once we know the entrant has none
+  var controller = new AbortController()
+  function foundEnough() {
+    var found = 0
+    for (var result of results) {
+      if (result === undefined) return false // Still waiting on an earlier finisher, who might take this spot
+      if (result !== null) found++
+      if (found >= count) return true
+    }
+    return true // Every entrant has been checked
+  }
+
+  async function findRaceVideo(channel) {
+    if (!userIds.has(channel.toLowerCase())) {
+      console.warn('Could not load twitch channel', channel)
+      return null
+    }
     try {
-      var channelVideos = await getTwitchChannelVideos(channel)
+      // Older races need older pages of videos, so fetch back to the race start.
+      var videoIndex = await getTwitchChannelVideos(channel, {'coverTime': race.startTime, 'signal': controller.signal})
     } catch (ex) {
       // This can fail (e.g. if a channel doesn't save VODs). If that happens, just continue to the next entrant.
-      console.warn(ex)
-      continue
+      if (!controller.signal.aborted) console.warn(ex)
+      return null
     }
 
-    console.log('Loaded', channelVideos.length, 'race videos for channel', channel)
+    console.log('Loaded', videoIndex.videos.length, 'race videos for channel', channel)
+    // There should not be multiple videos overlapping the start point.
+    return videoIndex.overlapping(race.startTime)
+  }
 
-    for (var video of channelVideos) {
-      if (video.startTime <= race.startTime && race.startTime <= video.endTime) {
-        raceVideos.push(video)
-        break // There should not be multiple videos overlapping the start point.
-      }
+  var nextChannel = 0
+  async function lookupWorker() {
+    while (nextChannel < channels.length && !controller.signal.aborted) {
+      var i = nextChannel++
+      results[i] = await findRaceVideo(channels[i])
+      if (foundEnough()) controller.abort() // Found enough videos to fill the display, cancel any other lookups
     }
-    
-    if (raceVideos.length >= count) break // Found enough videos to fill the display, we can stop iterating
   }
-  
-  return raceVideos
+
+  var workers = []
+  for (var i = 0; i < RACE_LOOKUP_CONCURRENCY; i++) workers.push(lookupWorker())
+  await Promise.all(workers)
+
+  return results.filter(video => video != null).slice(0, count)
 }
-})();
\ No newline at end of file
+})();
\ No newline at end of file
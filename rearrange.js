@@ -19,6 +19,7 @@ function setRearrangeMode(enabled) {
     syncPlayerParamsToURL()
     reloadTimeline()
   }
+  requestTimelineRefresh() // To show (or clear) the mode on the timeline
 }
 
 window.toggleRearrangeMode = function() { setRearrangeMode(!rearrangeMode) }
@@ -1,15 +1,25 @@
+import argparse
 import importlib
 import inspect
+import io
 import json
 import math
+import multiprocessing
+import multiprocessing.util
 import os
+import random
+import socket
+import subprocess
 import sys
 import time
 import traceback
-from contextlib import contextmanager
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
 from datetime import datetime, timezone
 from pathlib import Path
 from threading import Thread
+from urllib.parse import quote
 
 import requests
 from selenium import webdriver
@@ -21,32 +31,91 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
 import http_server
+import trace_analysis
+
+# Screenshots, logs and reports all go here (and are uploaded as artifacts in CI)
+TMP_FOLDER = Path(os.environ.get('RUNNER_TEMP', Path.home() / 'AppData/Local/Temp'))
 
 class TwitchEmbedFailedToLoadException(Exception):
   def __init__(self, player):
     self.player = player
 
 class UITests:
-  def __init__(self):
-    client_secret = os.environ.get('TWITCH_TOKEN', None)
-    if not client_secret:
-      # Download from https://dev.twitch.tv/console/apps/hc34d86ir24j38431rkwlekw8wgesp
-      client_secret = Path('client_secret.txt').open('r').read().strip() # Local testing
+  def __init__(self, port=3000, stub=False, artifact_prefix='', max_driver_uses=1, cassette_mode=None, save_traces=False):
+    self.base_url = f'http://localhost:{port}'
+    self.stub = stub
+    self.cassette_mode = cassette_mode # 'record' or 'replay', see CassetteMixin
+    # Whether the app's API calls go to http_server.py (which stands in for, or forwards to, the real APIs)
+    self.local_api = stub or cassette_mode is not None
+    # Whether http_server.py also issues our access token. Recording needs a real one, since requests are forwarded upstream.
+    self.local_auth = stub or cassette_mode == 'replay'
+    if self.local_api:
+      self.twitch_login_url = self.base_url + '/login'
+      self.racetime_base = self.base_url
+    else:
+      self.twitch_login_url = 'https://www.twitch.tv/login'
+      self.racetime_base = 'https://racetime.gg'
+    self.twitch_id_base = self.base_url if self.local_auth else 'https://id.twitch.tv'
     self.client_id = 'hc34d86ir24j38431rkwlekw8wgesp' # Confidential client
-    r = requests.post('https://id.twitch.tv/oauth2/token', params={
-      'grant_type': 'client_credentials',
-      'client_id': self.client_id,
-      'client_secret': client_secret,
-    })
-    if not r.ok:
-      print(r.status_code, r.text)
-    self.access_token = r.json()['access_token']
+    self._access_token = None
 
     self.screenshot_no = 0
-    self.tmp_folder = Path(os.environ.get('RUNNER_TEMP', Path.home() / 'AppData/Local/Temp'))
+    self.artifact_prefix = artifact_prefix # Keeps screenshots and logs from parallel workers from overwriting each other
+    self.save_traces = save_traces # Save a trace for passing attempts too (failures always save one)
+    self.tmp_folder = TMP_FOLDER
+
+    # Launching the browser is the largest fixed cost of each attempt, so we can optionally keep it warm between attempts.
+    self.driver = None
+    self.driver_uses = 0
+    self.max_driver_uses = max_driver_uses
+    self.launch_durations = []
+    self.setup_time_saved = 0
+    self.last_snapshot = None
+    # Set by run_attempt, for the timing history and the JUnit report
+    self.attempt_duration = None
+    self.attempt_error = None
+
+    # See fuzzLoadSeek
+    self.fuzz_count = 1000
+    self.fuzz_seed = None
+
+  # Fetched on first use, so that mock tests and benchmarks don't need Twitch credentials.
+  @property
+  def access_token(self):
+    if self._access_token is None:
+      client_secret = 'stub'
+      if not self.local_auth:
+        client_secret = os.environ.get('TWITCH_TOKEN', None)
+        if not client_secret:
+          # Download from https://dev.twitch.tv/console/apps/hc34d86ir24j38431rkwlekw8wgesp
+          client_secret = Path('client_secret.txt').open('r').read().strip() # Local testing
+      r = requests.post(f'{self.twitch_id_base}/oauth2/token', params={
+        'grant_type': 'client_credentials',
+        'client_id': self.client_id,
+        'client_secret': client_secret,
+      })
+      if not r.ok:
+        print(r.status_code, r.text)
+      self._access_token = r.json()['access_token']
+    return self._access_token
 
   def setup(self):
     self.print_log = []
+    self.last_snapshot = None
+    self.setup_time_saved = 0
+    if self.driver is not None:
+      start = time.time()
+      try:
+        self.reset_driver()
+        self.driver_uses += 1
+        average_launch = sum(self.launch_durations) / len(self.launch_durations)
+        self.setup_time_saved = average_launch - (time.time() - start)
+        return
+      except WebDriverException:
+        print('Failed to reset the browser, relaunching it')
+        self.quit_driver()
+
+    start = time.time()
     if 'CI' in os.environ:
       options = webdriver.chrome.options.Options()
       options.add_argument('headless=new')
@@ -62,6 +131,29 @@ class UITests:
         executable_path=Path(__file__).with_name('geckodriver.exe'),
       )
       self.driver = webdriver.Firefox(options=options, service=service)
+    self.launch_durations.append(time.time() - start)
+    self.driver_uses = 1
+
+  # Clear out anything a previous test could have left behind, so that a reused browser behaves like a fresh one.
+  def reset_driver(self):
+    # localStorage is per-origin, so we need to be on our origin to clear it. Load something cheap which isn't the app.
+    self.driver.get(self.base_url + '/favicon.ico')
+    self.driver.execute_script('window.localStorage.clear(); window.sessionStorage.clear()')
+    self.driver.get('about:blank')
+    if isinstance(self.driver, webdriver.Chrome):
+      # Twitch remembers the 'last watched' position of each video, which would change how the next test loads.
+      for origin in ['https://player.twitch.tv', 'https://www.twitch.tv']:
+        self.driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+      self.driver.get_log('performance') # Drain the network log so a later dump only contains this test's requests
+
+  def quit_driver(self):
+    if self.driver is None:
+      return
+    try:
+      self.driver.quit()
+    except WebDriverException:
+      pass # The browser is likely already gone, which is why we're quitting.
+    self.driver = None
 
   @contextmanager
   def find_element_in_frame(self, selector, player):
@@ -73,18 +165,58 @@ class UITests:
     finally:
       self.driver.switch_to.default_content()
 
-  def teardown(self):
-    event_log = self.driver.execute_script('return window.eventLog')
-    if event_log is None:
-      event_log = []
+  def teardown(self, passed=False):
+    event_log = self.driver.execute_script('return window.exportEventLog != null ? exportEventLog() : []')
     event_log += self.print_log
-    event_log.sort(key = lambda line: line.split('\t')[0])
-    print('\n'.join(event_log))
-    self.driver.close()
+    event_log.sort(key=lambda record: record['time'])
+    if not passed:
+      # The full log is usually too long to read in the console, so summarize it as per-player timings and save the rest.
+      print(trace_analysis.format_spans(trace_analysis.compute_spans(event_log)))
+      path = self.tmp_folder / f'{self.artifact_prefix}event_log_{self.screenshot_no:03}.json'
+      with open(path, 'w') as f:
+        json.dump(event_log, f, indent=1)
+      print('Saved event log to', path)
+      self.report_snapshots()
+    if not passed or self.save_traces:
+      self.save_trace()
+
+    # Never reuse a browser which was around for a failure, in case the browser itself was the problem.
+    if not passed or self.driver_uses >= self.max_driver_uses:
+      self.quit_driver()
+
+  def save_trace(self):
+    trace = self.driver.execute_script('return window.exportTrace != null ? exportTrace() : null')
+    if trace is None:
+      return
+    path = self.tmp_folder / f'{self.artifact_prefix}trace_{self.screenshot_no:03}.json'
+    with open(path, 'w') as f:
+      json.dump(trace_analysis.to_chrome_trace(trace), f)
+    print('Saved trace to', path, '(open it in chrome://tracing or https://ui.perfetto.dev)')
+
+  # Shows how the players ended up, next to the last snapshot an assertion was made on.
+  def report_snapshots(self):
+    try:
+      final_snapshot = self.driver.execute_script('return window.getSyncSnapshot != null ? getSyncSnapshot() : null')
+    except WebDriverException:
+      final_snapshot = None
+    snapshots = {'asserted': self.last_snapshot, 'final': final_snapshot}
+    for name, snapshot in snapshots.items():
+      if snapshot is None:
+        continue
+      print(f'Player snapshot ({name}):')
+      print(f'{"player":10} {"state":14} {"video":12} {"offset":>10} {"current":>26}  embed')
+      for player in snapshot['players']:
+        current = datetime.fromtimestamp(player['currentTimestamp'] / 1000).isoformat() if player['currentTimestamp'] else ''
+        print(f'{player["id"]:10} {player["state"]:14} {player["videoId"]:12} {player["offset"]:>10} {current:>26}  {player["playback"]}')
+
+    path = self.tmp_folder / f'{self.artifact_prefix}snapshot_{self.screenshot_no:03}.json'
+    with open(path, 'w') as f:
+      json.dump(snapshots, f, indent=1)
+    print('Saved player snapshots to', path)
 
   def screenshot(self):
     self.screenshot_no += 1
-    path = Path(self.tmp_folder / f'{self.screenshot_no:03}.png')
+    path = Path(self.tmp_folder / f'{self.artifact_prefix}{self.screenshot_no:03}.png')
     self.driver.save_screenshot(path)
     self.print('Saved screenshot', path)
     return path
@@ -92,77 +224,112 @@ class UITests:
   def dump_network_logs(self):
     try:
       logs = self.driver.get_log('performance')
-      path = self.tmp_folder / f'network_log_{self.screenshot_no:03}.json'
+      path = self.tmp_folder / f'{self.artifact_prefix}network_log_{self.screenshot_no:03}.json'
       with open(path, 'w') as f:
         json.dump(logs, f)
       print('Saved network log to', path)
     except Exception as exc:
       print('Network logs unavailable', exc)
 
+  # These waits listen on the app's logEvents (see index.js), so several of them can be pending at once.
   def wait_for_last_log(self, message, timeout_sec=10):
     self.driver.set_script_timeout(timeout_sec)
     return self.driver.execute_async_script('''
       var [search, callback] = arguments
-      _console_log = console.log
-      _timeout = null
-      console.log = (...args) => {
-        _console_log(...args)
-        if (args.join(' ').includes(search)) {
-          clearTimeout(_timeout)
-          _timeout = setTimeout(() => {
-            console.log = _console_log
-            callback(args)
-          }, 1000)
-        }
-      }''', message)
+      var timeout = null
+      function onLog(event) {
+        if (!event.detail.join(' ').includes(search)) return
+        clearTimeout(timeout)
+        timeout = setTimeout(() => {
+          logEvents.removeEventListener('log', onLog)
+          callback(event.detail)
+        }, 1000)
+      }
+      logEvents.addEventListener('log', onLog)
+      ''', message)
 
   def wait_for_log(self, message, timeout_sec=10):
     self.driver.set_script_timeout(timeout_sec)
     return self.driver.execute_async_script('''
       var [search, callback] = arguments
-      _console_log = console.log
-      console.log = (...args) => {
-        _console_log(...args)
-        if (args.join(' ').includes(search)) {
-          console.log = _console_log
-          callback(args)
-        }
-      }''', message)
+      function onLog(event) {
+        if (!event.detail.join(' ').includes(search)) return
+        logEvents.removeEventListener('log', onLog)
+        callback(event.detail)
+      }
+      logEvents.addEventListener('log', onLog)
+      ''', message)
 
   def wait_for_state(self, player, state, timeout_sec=30):
+    return self.wait_for_states({player: state}, timeout_sec)[player]
+
+  # Waits until every player in targets (a map of player id -> state name, or list of acceptable state names) has reached its state.
+  # This resolves on the transition itself (via playerEvents in player.js), and returns how long each player took to get there.
+  def wait_for_states(self, targets, timeout_sec=30):
+    targets = {player: [state] if isinstance(state, str) else state for player, state in targets.items()}
     try:
       self.driver.set_script_timeout(timeout_sec)
-      return self.driver.execute_async_script('''
-        var [targetState, player, callback] = arguments
-        var interval = setInterval(() => {
-          var currentState = players.has(player) ? players.get(player).state : null
-          if (targetState.includes(String(currentState))) {
-            var playbackState = players.get(player)._player.getPlayerState().playback
-            if (playbackState === 'Buffering') {
-              console.log('WARNING', player, 'reached', String(targetState), 'but was still buffering')
-            } else {
-              clearInterval(interval)
-              console.log(player, 'reached state', String(targetState), 'final PlaybackState was', playbackState)
-              callback()
-            }
+      timings = self.driver.execute_async_script('''
+        var [targets, callback] = arguments
+        var start = performance.now()
+        var timings = {}
+        var pending = new Set(Object.keys(targets))
+
+        function check(playerId, previousStateDuration) {
+          if (!pending.has(playerId) || !players.has(playerId)) return
+          var player = players.get(playerId)
+          if (!targets[playerId].includes(String(player.state))) return
+
+          var playbackState = player._player != null ? player._player.getPlayerState().playback : null
+          if (playbackState === 'Buffering') {
+            // Buffering doesn't change our state, so there is no event to wait on. This is rare, so just check back shortly.
+            console.log('WARNING', playerId, 'reached', String(player.state), 'but was still buffering')
+            setTimeout(() => check(playerId, previousStateDuration), 100)
+            return
           }
-        }, 10)
-        ''', state, player)
-    except TimeoutException:
-      final_state = self.driver.execute_script(f'return players.get("{player}").state.toString()')
-      self.print(player, 'timed out while waiting for state', state, 'final state was', final_state)
 
-      with self.find_element_in_frame('div[data-a-target="player-controls"]', player) as controls:
-        if not controls:
-          self.print(f'Could not find player controls for {player}, marking test as skipped')
-          raise TwitchEmbedFailedToLoadException(player)
+          pending.delete(playerId)
+          timings[playerId] = {'state': String(player.state), 'waited': performance.now() - start, 'previousStateDuration': previousStateDuration}
+          console.log(playerId, 'reached state', String(player.state), 'final PlaybackState was', playbackState)
+          if (pending.size === 0) {
+            playerEvents.removeEventListener('statechange', onStateChange)
+            callback(timings)
+          }
+        }
+
+        function onStateChange(event) { check(event.detail.player, event.detail.duration) }
+        playerEvents.addEventListener('statechange', onStateChange)
+        for (var playerId of pending) check(playerId, null)
+        ''', targets)
+    except TimeoutException:
+      for player, state in targets.items():
+        final_state = self.driver.execute_script(f'return players.has("{player}") ? players.get("{player}").state.toString() : null')
+        if final_state in state:
+          continue
+        self.print(player, 'timed out while waiting for state', state, 'final state was', final_state)
+
+        with self.find_element_in_frame('div[data-a-target="player-controls"]', player) as controls:
+          if not controls:
+            self.print(f'Could not find player controls for {player}, marking test as skipped')
+            raise TwitchEmbedFailedToLoadException(player)
       raise
 
+    for player, timing in timings.items():
+      self.print(player, 'reached', timing['state'], f'after waiting {timing["waited"]:.0f}ms')
+    return timings
+
   def print(self, *args):
-    timestamp = datetime.now(timezone.utc).isoformat()
-    message = '\t'.join([timestamp, *map(str, args)])
-    self.print_log.append(message)
-    print(message)
+    now = datetime.now(timezone.utc)
+    # Same shape as the app's event log records, so that the two can be merged in teardown.
+    self.print_log.append({'time': now.timestamp() * 1000, 'player': None, 'event': 'test', 'state': None, 'details': list(map(str, args))})
+    print('\t'.join([now.isoformat(), *map(str, args)]))
+
+  # URL fragment which the app parses as a Twitch auth callback. It may also point the app's API calls at our server.
+  def auth_fragment(self, access_token=None):
+    fragment = f'#scope=&access_token={access_token or self.access_token}&client_id={self.client_id}'
+    if self.local_api:
+      fragment += f'&api_base={self.base_url}'
+    return fragment
 
   def run(self, script):
     print(script)
@@ -192,28 +359,24 @@ class UITests:
     self.print('Pausing', player)
     self.run(f'players.get("{player}")._player.pause()')
 
+  # One round trip for every player's state (see getSyncSnapshot in index.js). The latest one is attached to failure reports.
+  def get_sync_snapshot(self):
+    self.last_snapshot = self.driver.execute_script('return getSyncSnapshot()')
+    return {player['id']: player for player in self.last_snapshot['players']}
+
   def assert_players_synced_to(self, expected_timestamp):
-    players = self.run('return Array.from(players.keys())')
-    assert len(players) > 0
-    for player in players:
-      self.assert_player_position(player, expected_timestamp)
+    snapshot = self.get_sync_snapshot()
+    assert len(snapshot) > 0
+    for player in snapshot:
+      self.assert_player_position(player, expected_timestamp, snapshot)
     self.print('All players synced to within 1 second of', datetime.fromtimestamp(expected_timestamp))
 
-  def assert_player_position(self, player, expected_timestamp):
-    start_time = self.run(f'return players.get("{player}").startTime') / 1000
-    timestamp = 0
-
-    with self.find_element_in_frame('p[data-a-target="player-seekbar-current-time"]', player) as seekbar:
-      if seekbar:
-        duration = seekbar.text
-        timestamp = start_time
-        timestamp += int(duration[0:2]) * 3600 # Hours
-        timestamp += int(duration[3:5]) *   60 # Minutes
-        timestamp += int(duration[6:8]) *    1 # Seconds
-    if timestamp == 0:
-      # Sometimes this text is not visible (if the video is playing). Hovering seems to be hard so instead I'm doing this.
-      # Note: This is also used by the mock player path which doesn't have a timeline bar.
-      timestamp = self.run(f'return players.get("{player}").getCurrentTimestamp()') / 1000
+  def assert_player_position(self, player, expected_timestamp, snapshot=None):
+    if snapshot is None:
+      snapshot = self.get_sync_snapshot()
+    start_time = snapshot[player]['startTime'] / 1000
+    # This comes from the embed's own playback position (see getPlaybackState), so it is null until the embed has loaded.
+    timestamp = (snapshot[player]['currentTimestamp'] or 0) / 1000
 
     if abs(timestamp - expected_timestamp) > 1:
       raise AssertionError(f'''
@@ -245,59 +408,61 @@ startTime: {datetime.fromtimestamp(start_time)}
   def testLoadWithOffsetsAndSyncStart(self):
     player0offset = 30_000
     player1offset = 60_000
-    url = f'http://localhost:3000?player0={self.VIDEO_0}&offsetplayer0={player0offset}&player1={self.VIDEO_1}&offsetplayer1={player1offset}'
+    url = f'{self.base_url}?player0={self.VIDEO_0}&offsetplayer0={player0offset}&player1={self.VIDEO_1}&offsetplayer1={player1offset}'
     self.driver.get(url)
 
     # Wait for all players to load and reach the 'pause' state
-    for player in ['player0', 'player1']:
-      self.wait_for_state(player, 'PAUSED')
+    self.wait_for_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
 
     # player1 is later than player0, so we should align to that
     self.assert_players_synced_to((self.ASYNC_ALIGN + player1offset) / 1000)
 
   def testSeek(self):
-    url = f'http://localhost:3000?player0={self.VIDEO_0}&player1={self.VIDEO_1}#scope=&access_token={self.access_token}&client_id={self.client_id}'
+    url = f'{self.base_url}?player0={self.VIDEO_0}&player1={self.VIDEO_1}' + self.auth_fragment()
     self.driver.get(url)
 
     # Wait for all players to load and reach the 'pause' state
     # player1 is 2 minutes later than player2, so we should align to that
-    for player in ['player0', 'player1']:
-      self.wait_for_state(player, 'PAUSED')
+    self.wait_for_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
     self.assert_players_synced_to(self.VIDEO_1_START_TIME)
 
     # Test seeking while players are paused (they should stay paused)
     # player1 is 2 minutes later than player2, so we should align to that + the seek time
     self.simulate_seek('player1', 20.0)
-    for player in ['player0', 'player1']:
-      self.wait_for_state(player, 'PAUSED')
+    self.wait_for_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
     self.assert_players_synced_to(self.VIDEO_1_START_TIME + 20)
 
     # Resume the players, then test seeking while playing (they should stay playing)
     self.simulate_play('player0')
-    for player in ['player0', 'player1']:
-      self.wait_for_state(player, 'PLAYING')
+    self.wait_for_states({'player0': 'PLAYING', 'player1': 'PLAYING'})
 
     # Test a seek while playing which is beyond the buffer
     self.simulate_seek('player0', 240.0)
 
+    self.wait_for_states({'player0': 'PLAYING', 'player1': 'PLAYING'})
     for player in ['player0', 'player1']:
-      self.wait_for_state(player, 'PLAYING')
       self.assert_player_position(player, self.VIDEO_0_START_TIME + 240)
 
   def testSeekWhileSeeking(self):
     players = [f'player{i}' for i in range(9)]
-    url = f'http://localhost:3000?'
+    url = f'{self.base_url}?'
     for player in players:
       # All players have the same video, since we're just testing seek behavior.
       url += f'{player}={self.VIDEO_0}&'
-    url += f'#scope=&access_token={self.access_token}&client_id={self.client_id}'
+    url += self.auth_fragment()
     self.driver.get(url)
 
     # Wait for all players to load and reach the 'pause' state
     if 'CI' in os.environ:
       time.sleep(15) # CI is being oddly slow when loading all these players
+    self.wait_for_states({player: 'PAUSED' for player in players})
+
+    # The embeds are created a few at a time (see queueEmbed), so check that every player made it through the loader.
+    load_timings = self.run('return getEmbedLoadTimings()')
     for player in players:
-      self.wait_for_state(player, 'PAUSED')
+      timings = load_timings[player]
+      assert timings['total'] is not None, f'{player} never finished loading: {timings}'
+      self.print(player, 'waited', f'{timings["queued"]:.0f}ms for a slot,', f'{timings["embed"]:.0f}ms for the embed,', f'{timings["video"]:.0f}ms for the video')
 
     # Seek on all 10 players in quick succession, to generically stress-test the system.
     time.sleep(1)
@@ -319,16 +484,16 @@ startTime: {datetime.fromtimestamp(start_time)}
 
     # For a while, this caused a nasty thrashing bug, where the various seeks would keep getting hot-potatoed around between players.
     # We can verify that's not happening by waiting for all players to pause.
-    for player in players:
-      self.wait_for_state(player, 'PAUSED')
+    self.wait_for_states({player: 'PAUSED' for player in players})
 
     # The 'assert sync' function has a 1s grace period, so this timing should be ok.
     self.assert_players_synced_to(self.VIDEO_0_START_TIME + 61)
+    self.print('Seek counters:', json.dumps(self.run('return getSeekCounters()')))
 
   def testRaceInterrupt(self):
     # We need to get a fresh race on each run, so that the VODs haven't expired.
     # Fortunately, OOT randomizer is pretty active. If needed, we could query a few categories.
-    j = requests.get('https://racetime.gg/ootr/races/data').json()
+    j = requests.get(f'{self.racetime_base}/ootr/races/data').json()
     for race in j['races']:
       if race.get('streaming_required', True): # Streaming is required by default but some races override this
         race_id = race['url'][1:] # Starts with a '/' which breaks some of our code >.<
@@ -336,13 +501,13 @@ startTime: {datetime.fromtimestamp(start_time)}
     else:
       raise ValueError('None of the OOTR races were suitable for a test')
 
-    r = requests.get(f'https://racetime.gg/{race_id}/data')
+    r = requests.get(f'{self.racetime_base}/{race_id}/data')
     r.encoding = 'utf-8'
     j = r.json()
     expected_channel_names = [e['user']['twitch_display_name'] for e in j['entrants']]
     expected_timestamp = datetime.fromisoformat(j['started_at']).timestamp()
 
-    url = f'http://localhost:3000?race=https://racetime.gg/{race_id}#scope=&access_token=invalid'
+    url = f'{self.base_url}?race=https://racetime.gg/{race_id}' + self.auth_fragment(access_token='invalid')
     self.driver.get(url)
 
     # The app will try to load the race, but the token is invalid -- so it will show the twitch popup.
@@ -353,8 +518,8 @@ startTime: {datetime.fromtimestamp(start_time)}
 
     # This should now send us to twitch -- which we obviously shouldn't interact with :)
     # Instead, simulate the redirect by sending the driver back to the callback url with our known token.
-    assert self.driver.current_url.startswith('https://www.twitch.tv/login')
-    url = f'http://localhost:3000#scope=&access_token={self.access_token}&client_id={self.client_id}'
+    assert self.driver.current_url.startswith(self.twitch_login_url)
+    url = self.base_url + self.auth_fragment()
     self.driver.get(url)
 
     players = self.run('return Array.from(players.keys())')
@@ -372,7 +537,7 @@ startTime: {datetime.fromtimestamp(start_time)}
       assert player_name in expected_channel_names
 
   def testDiscontinuity(self):
-    url = f'http://localhost:3000?player0={self.VIDEO_2}#scope=&access_token={self.access_token}&client_id={self.client_id}'
+    url = f'{self.base_url}?player0={self.VIDEO_2}' + self.auth_fragment()
     self.driver.get(url)
 
     self.wait_for_state('player0', 'PAUSED')
@@ -380,7 +545,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     # Override the channel lookup function, since we need to test with highlights (for stability)
     # N.B.: getTwitchVideosDetails (the /videos?id= endpoint) does not guarantee order.
     # We deliberately return them oldest-first (backwards from what we need in getBestVideo) to prove we handle it.
-    self.run('window.getTwitchChannelVideos = function () { return window.getTwitchVideosDetails(["' + self.VIDEO_3 + '", "' + self.VIDEO_4 + '"]) }')
+    self.run('window.getTwitchChannelVideos = function () { return window.getTwitchVideosDetails(["' + self.VIDEO_3 + '", "' + self.VIDEO_4 + '"]).then(videos => new VideoIndex(videos)) }')
 
     # The two test videos are 60s apart, which is exactly the default SYNC_THRESHOLD.
     # Lower it slightly so the "loaded while videos are paused" branch fires for this test.
@@ -403,8 +568,7 @@ startTime: {datetime.fromtimestamp(start_time)}
 
     # Seek to the end of VIDEO_3 and confirm that we load the next video.
     self.simulate_seek('player1', 220.0)
-    for player in ['player0', 'player1']:
-      self.wait_for_state(player, 'PAUSED')
+    self.wait_for_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
     self.assert_players_synced_to(self.VIDEO_3_START_TIME + 220)
 
     assert self.run('return players.get("player1").videoId') == self.VIDEO_3
@@ -419,7 +583,94 @@ startTime: {datetime.fromtimestamp(start_time)}
     assert self.run('return players.get("player1").videoId') == self.VIDEO_4
     assert self.run('return players.get("player1").nextVideoDetails') == None
 
+    # VIDEO_4 should have been preloaded while VIDEO_3 played out, so switching to it only took a seek.
+    handoffs = self.run('return getHandoffTimings()')
+    self.print('Handoffs:', json.dumps(handoffs))
+    assert [handoff['to'] for handoff in handoffs] == [self.VIDEO_4], handoffs
+    assert handoffs[0]['prewarmed'] and handoffs[0]['latency'] is not None, handoffs
+
+  # Repeated and simultaneous twitch lookups should be shared, rather than each making their own requests.
+  def testTwitchApiCache(self):
+    self.driver.get(self.base_url + self.auth_fragment())
+    self.driver.set_script_timeout(10)
+    stats = self.driver.execute_async_script('''
+      var [video3, video4, callback] = arguments
+      clearTwitchCache()
+      // Both of these are requested in the same task, so they should be batched into one request.
+      Promise.all([getTwitchVideosDetails([video3]), getTwitchVideosDetails([video4])])
+      .then(videos => {
+        var channel = videos[0][0].channel
+        // The second lookup shares the first one's requests, and the third one is served from the cache.
+        return Promise.all([getTwitchChannelVideos(channel), getTwitchChannelVideos(channel)])
+        .then(() => getTwitchChannelVideos(channel))
+      })
+      .then(() => callback(getTwitchCacheStats()))
+      .catch(e => callback(String(e)))
+      ''', self.VIDEO_3, self.VIDEO_4)
+    self.print(stats)
+
+    assert stats['misses'] == 1
+    assert stats['hits'] == 2
+    assert stats['requests'] == 3 # One for both video ids, then one each for the channel's user id and videos
+
+  # A bad video id fails a batched request, but that should only fail the lookup which asked for it.
+  def testTwitchBadVideoId(self):
+    self.driver.get(self.base_url + self.auth_fragment())
+    self.driver.set_script_timeout(10)
+    results = self.driver.execute_async_script('''
+      var [video3, callback] = arguments
+      clearTwitchCache()
+      Promise.allSettled([getTwitchVideosDetails([video3]), getTwitchVideosDetails(['not_a_video'])])
+      .then(results => callback(results.map(result => result.status)))
+      ''', self.VIDEO_3)
+    assert results == ['fulfilled', 'rejected'], results
+
+  # Channel videos are kept sorted by start time, so these lookups are all binary searches.
+  def testVideoIndex(self):
+    self.driver.get(self.base_url)
+    results = self.run('''
+      // Deliberately out of order, with a duplicate (as can happen when a new video shifts the pages)
+      var index = new VideoIndex([
+        {'id': 'c', 'startTime': 5000, 'endTime': 6000},
+        {'id': 'a', 'startTime': 1000, 'endTime': 2000},
+        {'id': 'b', 'startTime': 3000, 'endTime': 4000},
+      ])
+      index.add([{'id': 'a', 'startTime': 1000, 'endTime': 2000}])
+      var id = (video) => video == null ? null : video.id
+      return {
+        'order': index.videos.map(video => video.id),
+        'newestFirst': index.newestFirst().map(video => video.id),
+        'overlapping': [500, 1000, 1500, 2000, 2500, 6000, 7000].map(time => id(index.overlapping(time))),
+        'nextAfter': [0, 1000, 2500, 5000].map(time => id(index.nextAfter(time))),
+      }
+    ''')
+    assert results['order'] == ['a', 'b', 'c']
+    assert results['newestFirst'] == ['c', 'b', 'a']
+    assert results['overlapping'] == [None, 'a', 'a', 'a', None, 'c', None]
+    assert results['nextAfter'] == ['a', 'b', 'c', None]
+
+  # Race entrants are looked up in one batch, and the race load times are reported in the event log.
+  def testRaceLoadTimes(self):
+    j = requests.get(f'{self.racetime_base}/ootr/races/data').json()
+    race_id = next(race['url'][1:] for race in j['races'] if race.get('streaming_required', True))
+    self.driver.get(f'{self.base_url}?race=https://racetime.gg/{race_id}' + self.auth_fragment())
+
+    def get_race_times(driver):
+      records = self.run('return exportEventLog().filter(record => record.event == "race")')
+      times = {record['details'][0]: record['details'] for record in records}
+      return times if 'time to all players' in times else None
+    times = WebDriverWait(self.driver, 30).until(get_race_times)
+    self.print(times)
+
+    first = int(times['time to first player'][1])
+    all_players = int(times['time to all players'][1])
+    assert 0 <= first <= all_players
+    assert int(times['time to all players'][2]) == self.run('return players.size')
+    # All of the entrants are resolved together, so there should only have been one users request.
+    assert self.run('return performance.getEntriesByType("resource").filter(e => e.name.includes("/helix/users")).length') == 1
+
   ### Mock tests ###
+  # These run on a manual clock (the clock=manual hash param, see useManualClock in index.js), so time only passes when the test advances it.
 
   def mockLoadVideo(self, wait=True, **kwargs):
     player_id = self.run('return players.size')
@@ -434,10 +685,13 @@ startTime: {datetime.fromtimestamp(start_time)}
     WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((By.ID, f'player{player_id}-form')))
     self.run(f'loadVideos("player{player_id}", [{json.dumps(kwargs)}], MOCK)')
     if wait:
-      time.sleep(1)
+      self.advance_clock(1000)
+
+  def advance_clock(self, millis):
+    self.run(f'advanceClock({millis})')
 
   def testMockLoadSameStart(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     # Load all 4 videos at once, to simulate a "load from URL"
     self.mockLoadVideo(startTime=5, wait=False)
     self.mockLoadVideo(startTime=5, wait=False)
@@ -446,7 +700,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(5)
 
   def testMockLoadAscending(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     self.mockLoadVideo(startTime=1)
     self.mockLoadVideo(startTime=2)
@@ -454,7 +708,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(3)
 
   def testMockLoadAscendingBatch(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0, wait=False)
     self.mockLoadVideo(startTime=1, wait=False)
     self.mockLoadVideo(startTime=2, wait=False)
@@ -462,7 +716,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(3)
 
   def testMockLoadDescending(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=3)
     self.mockLoadVideo(startTime=2)
     self.mockLoadVideo(startTime=1)
@@ -471,7 +725,7 @@ startTime: {datetime.fromtimestamp(start_time)}
 
 
   def testMockLoadWithTooEarlyInitial(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     # We only use initial offset times if they are > 1 minute
     self.mockLoadVideo(startTime=0, initial=20)
     self.mockLoadVideo(startTime=1)
@@ -480,7 +734,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(3)
 
   def testMockLoadWithInitialTime(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     # We only use initial offset times if they are > 1 minute
     self.mockLoadVideo(startTime=0, initial=70)
     self.mockLoadVideo(startTime=1)
@@ -489,7 +743,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(70)
 
   def testMockLoadWithMultipleInitialTimes(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0, initial=80)
     self.mockLoadVideo(startTime=1, initial=70)
     self.mockLoadVideo(startTime=2)
@@ -497,7 +751,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(80)
 
   def testMockLoadWithSameInitialTime(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0, initial=70, wait=False)
     self.mockLoadVideo(startTime=1, initial=70, wait=False)
     self.mockLoadVideo(startTime=2, initial=70, wait=False)
@@ -505,7 +759,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(70)
 
   def testMockLoadWithMixedInitialTimesBatch(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0, initial=80, wait=False)
     self.mockLoadVideo(startTime=1, initial=70, wait=False)
     self.mockLoadVideo(startTime=2, wait=False)
@@ -513,7 +767,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(3)
 
   def testMockLoadInAsync(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     self.run('players.get("player0").state = ASYNC')
     self.mockLoadVideo(startTime=1)
@@ -524,7 +778,7 @@ startTime: {datetime.fromtimestamp(start_time)}
       assert state == 'ASYNC', f'player{i} in state {state}, expected ASYNC'
 
   def testMockLoadWhilePlaying(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     self.run('players.get("player0").seekTo(30000, PLAYING)')
     self.mockLoadVideo(startTime=1)
@@ -536,7 +790,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(30)
 
   def testMockLoadWhileSeeked(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     self.run('players.get("player0").seekTo(70000, PAUSED)')
     self.mockLoadVideo(startTime=1)
@@ -545,7 +799,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(70)
 
   def testMockLoadRace(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.run('raceStartTime = 70000')
     self.mockLoadVideo(startTime=0, wait=False)
     self.mockLoadVideo(startTime=1, wait=False)
@@ -554,7 +808,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(70)
 
   def testMockLoadOneThenRace(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     self.run('raceStartTime = 70000')
     self.mockLoadVideo(startTime=1, wait=False)
@@ -563,7 +817,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(70)
 
   def testMockLoadOneSeekThenRace(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     # We only honor player times if they are significantly after the race start time
     self.run('players.get("player0").seekTo(80000, PAUSED)')
@@ -574,7 +828,7 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.assert_players_synced_to(80)
 
   def testMockLoadWithBeforeStart(self):
-    self.driver.get('http://localhost:3000#scope=&access_token=mock_token')
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
     self.mockLoadVideo(startTime=0)
     self.mockLoadVideo(startTime=1)
     self.mockLoadVideo(startTime=10, wait=False)
@@ -582,49 +836,846 @@ startTime: {datetime.fromtimestamp(start_time)}
     self.mockLoadVideo(startTime=11)
     self.assert_players_synced_to(10)
 
+  def testMockTimelineRows(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.mockLoadVideo(startTime=0)
+    self.mockLoadVideo(startTime=10)
+    self.mockLoadVideo(startTime=20)
+    self.run('window.originalTimeline = document.getElementById("timeline")')
+
+    # The timeline is updated in place, so removing a player should only remove its row.
+    self.run('removePlayer()')
+    assert self.run('return document.getElementById("timeline") === originalTimeline')
+    rows = self.run('return Array.from(document.querySelectorAll("#timeline rect:not(#timelineCursor)"), rect => rect.getAttribute("y"))')
+    assert rows == ['0%', '50%'], rows
+
+  # A player which loads while the others are still seeking to play should join them, rather than pausing everyone.
+  def testMockLoadWhileSeekingPlay(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.mockLoadVideo(startTime=0, seekLatency=2000)
+    self.mockLoadVideo(startTime=0, seekLatency=2000)
+    self.advance_clock(3000)
+    self.mockLoadVideo(startTime=0, readyDelay=500, wait=False)
+    self.run('seekPlayersTo(60000, PLAYING)')
+    self.advance_clock(500)
+    assert self.run('return String(players.get("player2").state)') == 'PLAYING'
+
+    self.advance_clock(2000)
+    states = self.run('return Array.from(players.values(), p => String(p.state))')
+    assert states == ['PLAYING'] * 3, states
+    self.assert_players_synced_to(60)
+
+  def testMockSeekCoalescing(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    for _ in range(4):
+      self.mockLoadVideo(startTime=0, seekLatency=1000, wait=False)
+    self.advance_clock(5000)
+    self.run('resetSeekScheduler()')
+
+    # A burst of seeks while the first one is in flight should only cost each player one more seek, to the last target.
+    self.run('for (var i = 0; i <= 10; i++) seekPlayersTo(60000 + i * 1000, PAUSED)')
+    self.advance_clock(5000)
+    self.assert_players_synced_to(70)
+    counters = self.run('return getSeekCounters()')
+    assert counters['issued'] == 8, counters
+    assert counters['coalesced'] == 40, counters
+
+    # Players which are already there aren't seeked again.
+    self.run('seekPlayersTo(70000, PAUSED)')
+    counters = self.run('return getSeekCounters()')
+    assert counters['issued'] == 8 and counters['skipped'] == 4, counters
+
+  # The follow-up seek for a coalesced burst shouldn't start until everyone has heard that the first one landed.
+  def testMockSeekTransitionsInOrder(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.mockLoadVideo(startTime=0, seekLatency=1000)
+    self.mockLoadVideo(startTime=0, seekLatency=1000)
+    self.run('''
+      window.outOfOrder = []
+      var lastState = new Map()
+      playerEvents.addEventListener('statechange', (event) => {
+        var last = lastState.get(event.detail.player)
+        if (last != null && last !== event.detail.from) outOfOrder.push([event.detail.player, String(last), String(event.detail.from)])
+        lastState.set(event.detail.player, event.detail.to)
+      })
+      for (var i = 0; i <= 10; i++) seekPlayersTo(60000 + i * 1000, PAUSED)
+    ''')
+    self.advance_clock(5000)
+    self.assert_players_synced_to(70)
+    out_of_order = self.run('return outOfOrder')
+    assert out_of_order == [], out_of_order
+
+  def testMockDriftResync(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.mockLoadVideo(startTime=0)
+    self.mockLoadVideo(startTime=0)
+    self.mockLoadVideo(startTime=0)
+    self.run('seekPlayersTo(30000, PLAYING)')
+    self.advance_clock(1000)
+
+    # A small stall is left alone, but once a player falls far enough behind, only that player is re-seeked.
+    self.run('players.get("player1").currentTimestamp -= 1000')
+    self.advance_clock(1000)
+    assert self.run('return players.get("player1").currentTimestamp') == 29000
+    self.run('players.get("player1").currentTimestamp -= 4000')
+    self.advance_clock(1000)
+    self.assert_players_synced_to(30)
+
+    histograms = self.run('return getDriftHistograms()')
+    resyncs = {player: histogram['resyncs'] for player, histogram in histograms['players'].items()}
+    assert resyncs == {'player0': 0, 'player1': 1, 'player2': 0}, resyncs
+    assert histograms['players']['player1']['maxDrift'] < -histograms['threshold']
+    assert sum(histograms['players']['player0']['counts']) == histograms['players']['player0']['samples']
+
+  def testMockQualityGovernor(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.mockLoadVideo(startTime=0)
+    self.mockLoadVideo(startTime=0, bufferAbove=720) # Buffers at 1080p, which should bring every player down to 720p
+    self.mockLoadVideo(startTime=0)
+    self.run('seekPlayersTo(30000, PLAYING)')
+    self.advance_clock(12_000)
+    qualities = self.run('return Array.from(players.values(), p => p.quality)')
+    assert qualities == ['720p60'] * 3, qualities
+
+    # Once the bandwidth recovers, and playback has been stable for a minute, we should step back up.
+    self.run('players.get("player1").bufferAbove = null')
+    self.advance_clock(61_000)
+    qualities = self.run('return Array.from(players.values(), p => p.quality)')
+    assert qualities == ['1080p60'] * 3, qualities
+
+    decisions = [record['details'][:5] for record in self.run('return exportEventLog()') if record['event'] == 'quality']
+    assert decisions == [
+      ['stepped down', 'from', 'no limit', 'to', '720p60'],
+      ['stepped up', 'from', '720p60', 'to', 'no limit'],
+    ], decisions
+
+  def testMockQualityIgnoresBufferingAfterSeek(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    # Every player buffers for a bit after a seek, which adds up to well over the budget with this many players.
+    for _ in range(6):
+      self.mockLoadVideo(startTime=0, seekBuffering=1500)
+    self.run('seekPlayersTo(30000, PLAYING)')
+    self.advance_clock(12_000)
+    qualities = self.run('return Array.from(players.values(), p => p.quality)')
+    assert qualities == ['1080p60'] * 6, qualities
+
+  def testMockTimelineRefreshesOnlyWhilePlaying(self):
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.mockLoadVideo(startTime=0)
+    self.mockLoadVideo(startTime=0)
+    count_refreshes = 'return getTraceCount("refreshTimeline")'
+
+    # Once the players are paused, nothing on the timeline can change until something happens, so it shouldn't refresh at all.
+    refreshes = self.run(count_refreshes)
+    self.advance_clock(60_000)
+    assert self.run(count_refreshes) == refreshes
+
+    # While they're playing, the cursor moves every 100ms.
+    self.run('seekPlayersTo(30000, PLAYING)')
+    self.advance_clock(1000)
+    refreshes = self.run(count_refreshes)
+    self.advance_clock(10_000)
+    assert 95 <= self.run(count_refreshes) - refreshes <= 105, self.run(count_refreshes) - refreshes
+
+  # Tests against the fake embed (run with --fake-embed), which puts the real TwitchPlayer through twitch's quirks on a manual clock.
+  def advance_clock_until_states(self, targets, timeout_ms=60_000, step_ms=100):
+    for _ in range(timeout_ms // step_ms):
+      states = self.driver.execute_script('return Object.fromEntries(Array.from(players.values(), p => [p.id, p.state.toString()]))')
+      if all(states.get(player) == state for player, state in targets.items()):
+        return
+      self.driver.execute_script(f'advanceClock({step_ms})')
+    raise AssertionError(f'Players did not reach {targets} within {timeout_ms}ms, they were {states}')
+
+  def testFakeEmbedQuirks(self):
+    quirks = {'spuriousSeekInterval': 3000, 'pauseInsteadOfEnded': True, 'liveDurationExtra': 30, 'bufferDelay': 500}
+    url = f'{self.base_url}?player0={self.VIDEO_2}&player1={self.VIDEO_3}' + self.auth_fragment() + '&clock=manual&fake_embed=' + quote(json.dumps(quirks))
+    self.driver.get(url)
+    assert self.run('return window.configureFakeTwitchEmbed != null'), 'The page did not load the fake embed, is the server running with --fake-embed?'
+
+    # The initial seeks (to 0.01) should be taken as the players loading, and the spurious seeks after that ignored.
+    self.advance_clock_until_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
+    self.advance_clock(10_000)
+    self.assert_players_synced_to(self.VIDEO_3_START_TIME)
+
+    # Once the video plays, its end time should follow the (now longer) duration of the live VOD.
+    self.run('players.get("player1")._player.play()')
+    self.advance_clock_until_states({'player0': 'PLAYING', 'player1': 'PLAYING'})
+    duration = self.run('return players.get("player1").endTime - players.get("player1").startTime')
+    assert duration == (242 + 30) * 1000, duration
+
+    # At the end, twitch sends a pause rather than 'ended', which should still park the player near the end while the other plays on.
+    self.advance_clock_until_states({'player0': 'PLAYING', 'player1': 'AFTER_END'}, timeout_ms=300_000, step_ms=1000)
+    self.assert_player_position('player1', self.VIDEO_3_START_TIME + 242 + 30 - 15)
+
+  def testFakeEmbedHandoff(self):
+    self.driver.get(f'{self.base_url}?player0={self.VIDEO_2}' + self.auth_fragment() + '&clock=manual')
+    assert self.run('return window.configureFakeTwitchEmbed != null'), 'The page did not load the fake embed, is the server running with --fake-embed?'
+    self.advance_clock_until_states({'player0': 'PAUSED'})
+
+    # player1 gets a playlist of VIDEO_3 and then VIDEO_4. There's a gap between the fixture VODs, so close it, to check that the switch is seamless.
+    video_3_start = self.VIDEO_3_START_TIME * 1000
+    self.run(f'''
+      loadVideos("player1", [
+        {{"id": "{self.VIDEO_3}", "startTime": {video_3_start}, "endTime": {video_3_start + 242_000}}},
+        {{"id": "{self.VIDEO_4}", "startTime": {video_3_start + 242_000}, "endTime": {video_3_start + 542_000}}},
+      ], TWITCH)''')
+    self.advance_clock_until_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
+    self.run(f'seekPlayersTo({video_3_start + 200_000}, PLAYING)')
+    self.advance_clock_until_states({'player0': 'PLAYING', 'player1': 'PLAYING'})
+
+    self.advance_clock(60_000)
+    assert self.run('return players.get("player1").videoId') == self.VIDEO_4
+    handoffs = self.run('return getHandoffTimings()')
+    assert len(handoffs) == 1 and handoffs[0]['prewarmed'], handoffs
+    assert handoffs[0]['latency'] < 1000, handoffs
+    self.assert_players_synced_to(self.run('return players.get("player0").getCurrentTimestamp()') / 1000)
+
+  def testFakeEmbedStartsOnTime(self):
+    url = f'{self.base_url}?player0={self.VIDEO_2}&player1={self.VIDEO_3}' + self.auth_fragment() + '&clock=manual'
+    self.driver.get(url)
+    assert self.run('return window.configureFakeTwitchEmbed != null'), 'The page did not load the fake embed, is the server running with --fake-embed?'
+    self.advance_clock_until_states({'player0': 'PAUSED', 'player1': 'PAUSED'})
+
+    # Play from 10 seconds before player1's video starts. It should start as the timeline reaches its start time, not on the next poll.
+    self.run(f'seekPlayersTo({(self.VIDEO_3_START_TIME - 10) * 1000}, PLAYING)')
+    self.advance_clock_until_states({'player0': 'PLAYING', 'player1': 'BEFORE_START'})
+    self.run('''
+      window.startedAt = null
+      playerEvents.addEventListener('statechange', (event) => {
+        if (event.detail.player == 'player1' && event.detail.to === PLAYING) startedAt = players.get('player0').getCurrentTimestamp()
+      })''')
+    self.advance_clock(15_000)
+    lateness = self.run('return startedAt') - self.VIDEO_3_START_TIME * 1000
+    assert 0 <= lateness < 10, lateness
+
+  ### Benchmarks ###
+  # Run with --benchmark. Each benchmark returns a list of result rows, which are saved as JSON to compare between commits.
+  # Like the mock tests, these run on a manual clock, so all durations are (deterministic) virtual milliseconds.
+
+  SETTLED_STATES = ['PAUSED', 'PLAYING', 'BEFORE_START', 'AFTER_END']
+
+  # Counts seeks per player, and tracks when each player last settled into a non-seeking state.
+  def install_convergence_probe(self):
+    self.run('''
+      window.seekCounts = {}
+      window.settledAt = {}
+      var seekTo = MockPlayer.prototype.seekTo
+      MockPlayer.prototype.seekTo = function(...args) {
+        seekCounts[this.id] = (seekCounts[this.id] || 0) + 1
+        return seekTo.apply(this, args)
+      }
+      playerEvents.addEventListener('statechange', (event) => {
+        if (''' + json.dumps(self.SETTLED_STATES) + '''.includes(String(event.detail.to))) settledAt[event.detail.player] = clock.now()
+        else delete settledAt[event.detail.player]
+      })
+    ''')
+
+  # Runs the action, then steps the clock until all player_count players have settled (or we give up).
+  def measure_convergence(self, phase, player_count, action, timeout_ms=60_000):
+    start = self.run('seekCounts = {}; settledAt = {}; return clock.now()')
+    self.run(action)
+    elapsed = self.driver.execute_script('''
+      var [playerCount, settledStates, start, timeout] = arguments
+      function isSettled() {
+        if (players.size < playerCount) return false
+        return Array.from(players.values()).every(player => settledStates.includes(String(player.state)))
+      }
+      while (!isSettled() && clock.now() - start < timeout) advanceClock(10)
+      return isSettled() ? clock.now() - start : null
+    ''', player_count, self.SETTLED_STATES, start, timeout_ms)
+    settled_at = self.run('return settledAt')
+    seek_counts = self.run('return seekCounts')
+    states = self.run('return Object.fromEntries(Array.from(players.values(), player => [player.id, String(player.state)]))')
+
+    # Players which never settled count as the whole timeout, so that they make the percentiles worse rather than disappearing from them.
+    # (Players which were already settled, and never had to move, took no time at all.)
+    latencies = []
+    unsettled = []
+    for player in (f'player{i}' for i in range(player_count)):
+      if player in settled_at:
+        latencies.append(settled_at[player] - start)
+      elif states.get(player) in self.SETTLED_STATES:
+        latencies.append(0)
+      else:
+        latencies.append(timeout_ms)
+        unsettled.append(player)
+    result = {
+      'phase': phase,
+      'players': player_count,
+      'time_to_settle_ms': elapsed,
+      'convergence_ms': {
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'max': max(latencies, default=None),
+      },
+      'unsettled': unsettled,
+      'seeks_per_player': {f'player{i}': seek_counts.get(f'player{i}', 0) for i in range(player_count)},
+    }
+    self.print(phase, 'with', player_count, 'players settled after', elapsed, 'ms:', json.dumps(result['convergence_ms']))
+    if unsettled:
+      self.print(len(unsettled), 'players never settled, counted as', timeout_ms, 'ms:', ', '.join(unsettled))
+    return result
+
+  # How long it takes for all players to agree on a position after loading, and after a seek.
+  def benchSyncConvergence(self):
+    rng = random.Random(0) # Fixed seed, so that results are comparable between runs
+    results = []
+    for player_count in [1, 2, 4, 8, 16]:
+      self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+      self.install_convergence_probe()
+
+      videos = []
+      for i in range(player_count):
+        start_time = rng.randint(0, 30) * 1000
+        videos.append({
+          'id': i,
+          'startTime': start_time,
+          'endTime': start_time + 600_000,
+          'readyDelay': rng.randint(500, 3000),
+          'seekLatency': rng.randint(50, 1500),
+        })
+      results.append(self.measure_convergence('load', player_count, f'''
+        while (document.getElementById('players').childElementCount < {player_count}) window.addPlayer()
+        for (var video of {json.dumps(videos)}) loadVideos('player' + video.id, [video], MOCK)
+      '''))
+
+      seek_target = max(video['startTime'] for video in videos) + 120_000
+      results.append(self.measure_convergence('seek', player_count, f'seekPlayersTo({seek_target}, PAUSED)'))
+    return results
+
+  # Main-thread cost of the timeline loops with many players in one page. Fails if the per-call cost grows worse than linearly.
+  def benchLargeGrid(self):
+    results = []
+    for player_count in [25, 50, 100]:
+      self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+      self.install_convergence_probe()
+      videos = [{'id': i, 'startTime': i * 1000, 'endTime': i * 1000 + 3_600_000, 'seekLatency': 200} for i in range(player_count)]
+      result = self.measure_convergence('load', player_count, f'''
+        while (document.getElementById('players').childElementCount < {player_count}) window.addPlayer()
+        for (var video of {json.dumps(videos)}) loadVideos('player' + video.id, [video], MOCK)
+      ''')
+
+      # Start everyone playing, since that's when refreshTimeline does the most work. Then time the loops directly,
+      # over enough calls that the timer resolution (as coarse as 0.1ms) doesn't matter.
+      self.run(f'seekPlayersTo({player_count * 1000 + 60_000}, PLAYING); advanceClock(1000)')
+      timings = self.run('''
+        function timeCalls(func, count) {
+          var start = performance.now()
+          for (var i = 0; i < count; i++) func()
+          return (performance.now() - start) / count
+        }
+        return {
+          'refreshTimeline': timeCalls(refreshTimeline, 500),
+          'reloadTimeline': timeCalls(reloadTimeline, 50),
+        }
+      ''')
+      result['refresh_timeline_ms'] = timings['refreshTimeline']
+      result['reload_timeline_ms'] = timings['reloadTimeline']
+      self.print(player_count, 'players: refreshTimeline', f'{timings["refreshTimeline"]:.3f}ms,', 'reloadTimeline', f'{timings["reloadTimeline"]:.3f}ms')
+      results.append(result)
+
+    # Compare per-player costs against the smallest grid. Allow 2x slack, since these are small, noisy numbers.
+    baseline = results[0]
+    for result in results[1:]:
+      for key in ['refresh_timeline_ms', 'reload_timeline_ms']:
+        baseline_per_player = baseline[key] / baseline['players']
+        per_player = result[key] / result['players']
+        assert per_player <= baseline_per_player * 2, f'{key} scaled worse than linearly: {baseline[key]:.3f}ms for {baseline["players"]} players vs {result[key]:.3f}ms for {result["players"]} players'
+    return results
+
+  ### Fuzzing ###
+  # Run with --fuzz N. Generates N random sequences of mock loads, seeks, async mode and race start times,
+  # and runs them in batches inside one page (on a manual clock), checking invariants after every step.
+
+  # The log line each branch of the onready handler (see loadVideos in index.js) prints, to tell which one was taken.
+  ONREADY_BRANCHES = {
+    'loaded while another video was async': 'async',
+    'loaded while another video was playing': 'playing',
+    'loaded while the other videos were seeking to play': 'seekingPlay',
+    'deferring seek until all videos have loaded': 'defer',
+    'loaded while another video is still loading': 'loading',
+    'was last to load while others were paused at an earlier position': 'pausedBeforeStart',
+    'was last to load from a race': 'race',
+    'syncing all videos to average': 'average',
+    'syncing all videos to cached position': 'initial',
+    'syncing all videos to earliest': 'earliest',
+  }
+
+  FUZZ_HARNESS = '''
+    function resetPlayers() {
+      // Let any leftover timers (e.g. a mock player becoming ready) fire before the players go away.
+      advanceClock(20000)
+      for (var div of Array.from(document.getElementById('players').children)) div.remove()
+      players.clear()
+      raceStartTime = null
+      pendingSeekTimestamp = 0
+      pendingSeekSource = null
+      resetSeekScheduler()
+      resetHandoffs()
+      reloadTimeline()
+      while (document.getElementById('players').childElementCount < MIN_PLAYERS) addPlayer()
+    }
+
+    function describePlayers() {
+      return Array.from(players.values(), p => p.id + ' ' + p.state + ' @ ' + p.getCurrentTimestamp()).join(', ')
+    }
+
+    // Players are only expected to be in sync once they've loaded (and their onready has decided where they should be).
+    var loadedPlayers = new Set()
+    function checkInvariants(settled) {
+      // Async mode deliberately lets the players drift apart.
+      var inAsync = Array.from(players.values()).some(p => p.state === ASYNC)
+      var synced = Array.from(players.values()).filter(p => !inAsync && loadedPlayers.has(p.id) && (p.state === PLAYING || p.state === PAUSED))
+      var timestamps = synced.map(p => p.getCurrentTimestamp())
+      if (Math.max(...timestamps) - Math.min(...timestamps) > 1000) return {'kind': 'sync', 'reason': 'Players are out of sync: ' + describePlayers()}
+      if (!settled) return null
+      for (var player of players.values()) {
+        if (SEEKING_STATES.includes(player.state) || player.state === LOADING) {
+          return {'kind': 'stuck', 'reason': player.id + ' never settled: ' + describePlayers()}
+        }
+      }
+      return null
+    }
+
+    function runFuzzSequence(steps) {
+      resetPlayers()
+      loadedPlayers.clear()
+      var onreadyEvents = []
+      var messages = null
+      var onLog = (event) => { if (messages != null) messages.push(event.detail.join(' ')) }
+      logEvents.addEventListener('log', onLog)
+      try {
+        for (let i = 0; i < steps.length; i++) {
+          var step = steps[i]
+          if (step.op == 'load') {
+            var playerId = 'player' + players.size
+            while (document.getElementById(playerId) == null) addPlayer()
+            var video = {'id': players.size, 'startTime': step.startTime, 'endTime': step.startTime + 100000, 'initial': step.initial,
+                         'seekLatency': step.seekLatency, 'readyDelay': step.readyDelay}
+            var player = loadVideos(playerId, [video], MOCK)
+            // Record what the onready handler could see, so that the test can check its decision against the model.
+            let onready = player.onready
+            player.onready = (thisPlayer, initialTimestamp) => {
+              var event = {
+                'step': i,
+                'player': thisPlayer.id,
+                'initial': initialTimestamp || 0,
+                'raceStartTime': raceStartTime,
+                'syncThreshold': SYNC_THRESHOLD,
+                'players': Array.from(players.values(), p => ({'id': p.id, 'state': String(p.state), 'startTime': p.startTime, 'timestamp': p.getCurrentTimestamp()})),
+              }
+              messages = []
+              try {
+                onready(thisPlayer, initialTimestamp)
+              } finally {
+                event.messages = messages
+                messages = null
+                loadedPlayers.add(thisPlayer.id)
+              }
+              onreadyEvents.push(event)
+            }
+          } else if (step.op == 'seek') {
+            seekPlayersTo(step.timestamp, step.state == 'PLAYING' ? PLAYING : PAUSED)
+          } else if (step.op == 'async') {
+            // Same as entering async mode with 'a' (minus the offset alignment, which the fuzzer doesn't look at).
+            for (var player of players.values()) player.state = ASYNC
+          } else if (step.op == 'race') {
+            raceStartTime = step.time
+          } else if (step.op == 'advance') {
+            advanceClock(step.millis)
+          }
+
+          var failure = checkInvariants(/*settled*/false)
+          if (failure != null) return {'failure': {...failure, 'step': i}, 'onready': onreadyEvents}
+        }
+
+        // Long enough for every player to load, and for seekPlayersTo to give up on (and retry) any stuck seeks.
+        advanceClock(15000)
+        var failure = checkInvariants(/*settled*/true)
+        if (failure != null) return {'failure': {...failure, 'step': steps.length}, 'onready': onreadyEvents}
+        return {'failure': null, 'onready': onreadyEvents}
+      } catch (ex) {
+        return {'failure': {'kind': 'exception', 'reason': String(ex.stack), 'step': null}, 'onready': onreadyEvents}
+      } finally {
+        logEvents.removeEventListener('log', onLog)
+      }
+    }
+
+    window.runFuzzBatch = function(sequences) { return sequences.map(runFuzzSequence) }
+  '''
+
+  # An independent model of the onready branch table in loadVideos, given what the handler could see when it ran.
+  def model_onready_branch(self, event):
+    states = {player['id']: player['state'] for player in event['players']}
+    states[event['player']] = 'READY' # The handler marks itself ready before looking at the other players
+    others = [state for player, state in states.items() if player != event['player']]
+    this_start = next(player['startTime'] for player in event['players'] if player['id'] == event['player'])
+    earliest_sync = max([0] + [player['startTime'] for player in event['players']])
+    synced = [player['timestamp'] for player in event['players'] if states[player['id']] in ['PLAYING', 'PAUSED']]
+    average = sum(synced) / len(synced) if synced else None
+    threshold = event['syncThreshold']
+
+    if 'ASYNC' in others:
+      return 'async'
+    if 'PLAYING' in others or 'SEEKING_PLAY' in others:
+      return 'playing' if average is not None else 'seekingPlay'
+    if 'LOADING' in others:
+      return 'defer' if average is None else 'loading'
+    if ('PAUSED' in others or 'SEEKING_PAUSE' in others) and average is not None and average + threshold < this_start:
+      return 'pausedBeforeStart'
+    if event['raceStartTime'] is not None and event['raceStartTime'] > earliest_sync + threshold:
+      return 'race'
+    if average is not None and average > earliest_sync + threshold:
+      return 'average'
+    if event['initial'] > earliest_sync + threshold:
+      return 'initial'
+    return 'earliest'
+
+  def random_fuzz_sequence(self, rng):
+    steps = [self.random_fuzz_load(rng)]
+    for _ in range(rng.randint(0, 12)):
+      op = rng.choice(['load', 'load', 'load', 'seek', 'async', 'race', 'advance', 'advance', 'advance'])
+      if op == 'load':
+        steps.append(self.random_fuzz_load(rng))
+      elif op == 'seek':
+        steps.append({'op': 'seek', 'timestamp': rng.choice([0, 5, 30, 70, 80, 200]) * 1000, 'state': rng.choice(['PAUSED', 'PLAYING'])})
+      elif op == 'async':
+        steps.append({'op': 'async'})
+      elif op == 'race':
+        steps.append({'op': 'race', 'time': rng.choice([5, 70, 200]) * 1000})
+      elif op == 'advance':
+        steps.append({'op': 'advance', 'millis': rng.choice([100, 1000, 1000, 5000])})
+    return steps
+
+  def random_fuzz_load(self, rng):
+    # Start times are clustered around the same values as the mock tests, so that the SYNC_THRESHOLD comparisons go both ways.
+    return {
+      'op': 'load',
+      'startTime': rng.choice([0, 1, 2, 3, 10, 11, 70, 150]) * 1000,
+      'initial': rng.choice([0, 0, 20, 70, 80]) * 1000,
+      'seekLatency': rng.choice([0, 0, 0, 500, 3000]),
+      'readyDelay': rng.choice([1000, 1000, 2500]),
+    }
+
+  # Returns a failure (or None) for each sequence.
+  def run_fuzz_batch(self, sequences):
+    results = self.driver.execute_script('return runFuzzBatch(arguments[0])', sequences)
+    failures = []
+    for result in results:
+      failure = result['failure']
+      for event in result['onready']:
+        if failure is not None and failure['step'] is not None and event['step'] > failure['step']:
+          break
+        taken = [branch for message, branch in self.ONREADY_BRANCHES.items() if any(message in line for line in event['messages'])]
+        expected = self.model_onready_branch(event)
+        if taken != [expected]:
+          failure = {'kind': 'onready', 'step': event['step'], 'reason': f'{event["player"]} took {taken} but the model expected {expected}', 'event': event}
+          break
+      failures.append(failure)
+    return failures
+
+  # Greedily removes chunks of steps (halving the chunk size when nothing can be removed), as long as the sequence still fails the same way.
+  def shrink_fuzz_sequence(self, steps, kind):
+    chunk = max(len(steps) // 2, 1)
+    while True:
+      candidates = [steps[:i] + steps[i + chunk:] for i in range(0, len(steps), chunk)]
+      candidates = [candidate for candidate in candidates if candidate]
+      failures = self.run_fuzz_batch(candidates) if candidates else []
+      smaller = next((candidate for candidate, failure in zip(candidates, failures) if failure and failure['kind'] == kind), None)
+      if smaller is not None:
+        steps = smaller
+        chunk = min(chunk, max(len(steps) // 2, 1))
+      elif chunk > 1:
+        chunk //= 2
+      else:
+        return steps
+
+  def fuzzLoadSeek(self, batch_size=100):
+    seed = self.fuzz_seed if self.fuzz_seed is not None else random.randrange(2**32)
+    self.print('Fuzzing', self.fuzz_count, 'sequences with seed', seed)
+    rng = random.Random(seed)
+    self.driver.get(self.base_url + '#scope=&access_token=mock_token&clock=manual')
+    self.driver.execute_script(self.FUZZ_HARNESS)
+
+    for start in range(0, self.fuzz_count, batch_size):
+      sequences = [self.random_fuzz_sequence(rng) for _ in range(min(batch_size, self.fuzz_count - start))]
+      for steps, failure in zip(sequences, self.run_fuzz_batch(sequences)):
+        if failure is None:
+          continue
+        self.print('Found a failing sequence:', failure['reason'])
+        minimal = self.shrink_fuzz_sequence(steps, failure['kind'])
+        failure = self.run_fuzz_batch([minimal])[0]
+        where = 'after settling' if failure['step'] == len(minimal) else f'at step {failure["step"]}'
+        raise AssertionError(f'{failure["reason"]}\nMinimal reproducer (seed {seed}), failing {where}:\n{json.dumps(minimal, indent=1)}')
+    self.print('All', self.fuzz_count, 'sequences passed')
+
+def start_http_server(port, stub=False, stub_latency=0, cached=False, cassette=None, record=False, fake_embed=False):
+  kwargs = {'port': port, 'stub': stub, 'latency_ms': stub_latency, 'cached': cached, 'cassette': cassette, 'record': record, 'fake_embed': fake_embed}
+  Thread(target=http_server.main, kwargs=kwargs, daemon=True).start()
+  # Wait until the server is accepting connections, since (in stub mode) UITests immediately requests a token from it.
+  for _ in range(100):
+    try:
+      socket.create_connection(('localhost', port), timeout=1).close()
+      return
+    except OSError:
+      time.sleep(0.1)
+  raise TimeoutError(f'http_server did not start on port {port}')
+
+def get_test_names(prefix='test'):
+  tests = inspect.getmembers(UITests, lambda method: inspect.isfunction(method) and method.__name__.startswith(prefix))
+  tests.sort(key=lambda func: func[1].__code__.co_firstlineno)
+  return [test[0] for test in tests]
+
+# Nearest-rank percentile
+def percentile(values, p):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def run_benchmarks(test_class, benchmarks, output_path):
+  commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+  results = {'commit': commit, 'timestamp': datetime.now(timezone.utc).isoformat(), 'benchmarks': {}}
+  num_failures = 0
+  for benchmark in benchmarks:
+    print('---', benchmark, 'started')
+    test_class.setup()
+    try:
+      results['benchmarks'][benchmark] = getattr(test_class, benchmark)()
+      print('===', benchmark, 'finished')
+      test_class.quit_driver() # Benchmark logs are long and not very interesting when nothing went wrong
+    except Exception:
+      test_class.screenshot()
+      print('!!!', benchmark, 'failed:')
+      traceback.print_exc()
+      num_failures += 1
+      test_class.teardown()
+
+  with open(output_path, 'w') as f:
+    json.dump(results, f, indent=2)
+  print('Saved benchmark results to', output_path)
+  return num_failures
+
+def run_attempt(test_class, test_name, attempt):
+  print('---', test_name, 'started, attempt', attempt)
+  start = time.time()
+  test_class.attempt_error = None
+  test_class.setup()
+  result = 'failed'
+  try:
+    getattr(test_class, test_name)()
+    print('===', test_name, 'attempt', attempt, 'passed')
+    result = 'passed'
+  except TwitchEmbedFailedToLoadException:
+    test_class.screenshot()
+    test_class.dump_network_logs()
+    print('???', test_name, 'attempt', attempt, 'skipped because a twitch embed failed to load')
+    test_class.attempt_error = 'A twitch embed failed to load'
+    result = 'skipped'
+  except Exception:
+    test_class.screenshot()
+    print('!!!', test_name, 'attempt', attempt, 'failed:')
+    traceback.print_exc()
+    test_class.attempt_error = traceback.format_exc()
+  finally:
+    test_class.teardown(passed=(result == 'passed'))
+    test_class.attempt_duration = time.time() - start
+  return result
+
+### Timing history ###
+# Every attempt's duration is saved to a history file, so that we can run the slowest tests first (which keeps parallel workers busy
+# until the end, instead of one worker picking up a 30 second test last), and notice when a test gets slower than it used to be.
+TIMING_HISTORY_SIZE = 100 # Attempts kept per test
+MIN_TIMING_HISTORY = 5 # Attempts needed before we trust a test's p95
+
+def load_timing_history(path):
+  if not path.exists():
+    return {}
+  with open(path, 'r') as f:
+    return json.load(f)
+
+def save_timing_history(path, history, records):
+  for record in records:
+    runs = history.setdefault(record['test'], [])
+    runs.append({'time': record['time'], 'attempt': record['attempt'], 'result': record['result'], 'duration': record['duration']})
+    del runs[:-TIMING_HISTORY_SIZE]
+  with open(path, 'w') as f:
+    json.dump(history, f, indent=2)
+  print('Saved test timings to', path)
+
+# Only passing attempts count, since failures often stop early (or hang until a timeout).
+def passed_durations(history, test):
+  return [run['duration'] for run in history.get(test, []) if run['result'] == 'passed']
+
+# Tests we haven't timed yet go first, since we don't know how long they'll take.
+def expected_duration(history, test):
+  return percentile(passed_durations(history, test), 50) or math.inf
+
+# Marks (and prints) passing attempts which took longer than that test's historical p95.
+def flag_slow_attempts(history, records):
+  for record in records:
+    durations = passed_durations(history, record['test'])
+    if record['result'] != 'passed' or len(durations) < MIN_TIMING_HISTORY:
+      continue
+    p95 = percentile(durations, 95)
+    if record['duration'] > p95:
+      record['p95'] = p95
+      print(f'SLOW {record["test"]} attempt {record["attempt"]} took {record["duration"]:.1f}s, above its p95 of {p95:.1f}s (over {len(durations)} runs)')
+
+def write_junit_xml(path, records):
+  suite = ET.Element('testsuite', {
+    'name': 'UITests',
+    'tests': str(len(records)),
+    'failures': str(sum(record['result'] == 'failed' for record in records)),
+    'skipped': str(sum(record['result'] == 'skipped' for record in records)),
+    'time': f'{sum(record["duration"] for record in records):.3f}',
+    'timestamp': datetime.now(timezone.utc).isoformat(),
+  })
+  for record in records:
+    case = ET.SubElement(suite, 'testcase', {'classname': 'UITests', 'name': f'{record["test"]} (attempt {record["attempt"]})', 'time': f'{record["duration"]:.3f}'})
+    if record.get('p95') is not None:
+      properties = ET.SubElement(case, 'properties')
+      ET.SubElement(properties, 'property', {'name': 'slower_than_p95', 'value': f'{record["p95"]:.3f}'})
+    if record['result'] == 'failed':
+      error = record['error'] or ''
+      failure = ET.SubElement(case, 'failure', {'message': error.strip().split('\n')[-1]})
+      failure.text = error
+    elif record['result'] == 'skipped':
+      ET.SubElement(case, 'skipped', {'message': record['error'] or ''})
+  ET.indent(suite)
+  ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+  print('Saved JUnit report to', path)
+
+# Each process in the --workers pool gets its own UITests (and thus its own webdriver) and its own http_server port.
+worker_tests = None
+def init_worker(ports, stub, stub_latency, cached_server, max_driver_uses, replay, save_traces, fake_embed):
+  global worker_tests
+  port = ports.get()
+  start_http_server(port, stub, stub_latency, cached_server, cassette=replay, fake_embed=fake_embed)
+  cassette_mode = 'replay' if replay else None
+  worker_tests = UITests(port=port, stub=stub, artifact_prefix=f'worker{port}_', max_driver_uses=max_driver_uses, cassette_mode=cassette_mode, save_traces=save_traces)
+  # Worker processes skip atexit handlers, so use multiprocessing's equivalent to close any browser we kept warm.
+  multiprocessing.util.Finalize(worker_tests, worker_tests.quit_driver, exitpriority=10)
+
+def run_worker_attempt(test_name, attempt):
+  # Capture the attempt's output so the parent process can print it as one block, instead of interleaving it with other workers.
+  output = io.StringIO()
+  with redirect_stdout(output), redirect_stderr(output):
+    result = run_attempt(worker_tests, test_name, attempt)
+  return result, worker_tests.setup_time_saved, worker_tests.attempt_duration, worker_tests.attempt_error, output.getvalue()
+
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('tests', nargs='*', help='Names of tests to run (default: all), optionally followed or preceded by an iteration count')
+  api_mode = parser.add_mutually_exclusive_group()
+  api_mode.add_argument('--stub', action='store_true', help='Serve the Twitch and racetime.gg APIs locally from fixtures/, so tests can run offline')
+  api_mode.add_argument('--record', type=Path, metavar='CASSETTE', help='Save every Twitch and racetime.gg API response from this (live) run into a cassette file')
+  api_mode.add_argument('--replay', type=Path, metavar='CASSETTE', help='Serve the Twitch and racetime.gg APIs from a recorded cassette file, instead of the live APIs')
+  parser.add_argument('--stub-latency', type=int, default=0, help='Milliseconds of latency to add to each stubbed API response')
+  parser.add_argument('--cached-server', action='store_true', help='Serve the app from memory with compression and keep-alive (see CachedStaticHTTPRequestHandler)')
+  parser.add_argument('--fake-embed', action='store_true', help='Replace the Twitch embed with a local fake (see fixtures/twitch_embed.js), usually along with --stub')
+  parser.add_argument('--benchmark', action='store_true', help='Run the benchmarks (or the named ones) instead of the tests')
+  parser.add_argument('--benchmark-output', type=Path, default=None, help='Where to save benchmark results (default: benchmarks.json in the temp folder)')
+  parser.add_argument('--fuzz', type=int, default=0, metavar='N', help='Run the fuzzers (or the named ones) over N random sequences each, instead of the tests')
+  parser.add_argument('--fuzz-seed', type=int, default=None, help='Seed for the fuzzers, to reproduce an earlier run (default: random)')
+  parser.add_argument('--workers', type=int, default=1, help='Number of browsers to run test attempts in parallel')
+  parser.add_argument('--reuse-browser', type=int, default=1, metavar='N', help='Run up to N attempts in each browser before relaunching it (it is always relaunched after a failure)')
+  parser.add_argument('--save-traces', action='store_true', help='Save a Chrome trace of every attempt, not just the failed ones')
+  parser.add_argument('--timing-history', type=Path, default=None, help='Where to keep per-test durations, used to run the slowest tests first (default: test_timings.json in the temp folder, which CI persists with actions/cache)')
+  parser.add_argument('--junit-xml', type=Path, default=None, help='Where to save a JUnit-style report of every attempt (default: junit.xml in the temp folder)')
+  args = parser.parse_args()
+  if args.record and args.workers > 1:
+    parser.error('--record only supports a single worker, since each worker has its own server')
+  if args.replay and not args.replay.exists():
+    parser.error(f'No cassette to replay at {args.replay} (make one with --record)')
+  cassette = args.record or args.replay
+  cassette_mode = 'record' if args.record else 'replay' if args.replay else None
+
   loop_count = 1
   if os.environ.get('GITHUB_EVENT_NAME', None) == 'schedule':
     loop_count = 20 # Require additional consistency for our nightly job vs ad-hoc pushes
-  elif len(sys.argv) > 1 and sys.argv[1].isdigit():
-    loop_count = int(sys.argv.pop(1))
-  elif len(sys.argv) > 2 and sys.argv[-1].isdigit():
-    loop_count = int(sys.argv.pop(-1))
-
-  test_class = UITests()
-  is_test = lambda method: inspect.ismethod(method) and method.__name__.startswith('test')
-  tests = list(inspect.getmembers(test_class, is_test))
-  tests.sort(key=lambda func: func[1].__code__.co_firstlineno)
-  if len(sys.argv) > 1: # Requested specific test(s)
-    tests = [test for test in tests if test[0] in sys.argv[1:]]
-
-  http_server = Thread(target=http_server.main, daemon=True)
-  http_server.start()
+  elif len(args.tests) > 0 and args.tests[0].isdigit():
+    loop_count = int(args.tests.pop(0))
+  elif len(args.tests) > 1 and args.tests[-1].isdigit():
+    loop_count = int(args.tests.pop(-1))
+
+  if args.benchmark:
+    benchmarks = get_test_names('bench')
+    if len(args.tests) > 0:
+      benchmarks = [benchmark for benchmark in benchmarks if benchmark in args.tests]
+    start_http_server(3000, args.stub, args.stub_latency, args.cached_server, cassette, args.record is not None, args.fake_embed)
+    test_class = UITests(stub=args.stub, cassette_mode=cassette_mode)
+    exit(run_benchmarks(test_class, benchmarks, args.benchmark_output or test_class.tmp_folder / 'benchmarks.json'))
+
+  if args.fuzz > 0:
+    fuzzers = get_test_names('fuzz')
+    if len(args.tests) > 0:
+      fuzzers = [fuzzer for fuzzer in fuzzers if fuzzer in args.tests]
+    start_http_server(3000, args.stub, args.stub_latency, args.cached_server, fake_embed=args.fake_embed)
+    test_class = UITests(stub=args.stub)
+    test_class.fuzz_count = args.fuzz
+    test_class.fuzz_seed = args.fuzz_seed
+    exit(sum(run_attempt(test_class, fuzzer, 1) == 'failed' for fuzzer in fuzzers))
+
+  tests = get_test_names()
+  if len(args.tests) > 0: # Requested specific test(s)
+    tests = [test for test in tests if test in args.tests]
+  if not args.fake_embed: # These drive the fake embed directly, so they can't run against the real one
+    tests = [test for test in tests if not test.startswith('testFakeEmbed')]
+  timing_history_path = args.timing_history or TMP_FOLDER / 'test_timings.json'
+  timing_history = load_timing_history(timing_history_path)
+  tests.sort(key=lambda test: expected_duration(timing_history, test), reverse=True) # Stable, so ties stay in file order
+  attempts = [(test, i) for test in tests for i in range(1, loop_count + 1)]
+
+  failures = {test: [] for test in tests}
+  time_saved = {test: 0 for test in tests}
+  records = []
+  def record_attempt(test, i, result, duration, error):
+    records.append({'test': test, 'attempt': i, 'result': result, 'duration': duration or 0, 'error': error, 'time': datetime.now(timezone.utc).isoformat()})
+    if result == 'failed':
+      failures[test].append(i)
+  if args.workers > 1:
+    ports = multiprocessing.Queue()
+    for i in range(1, args.workers + 1):
+      ports.put(3000 + i)
+    initargs = (ports, args.stub, args.stub_latency, args.cached_server, args.reuse_browser, args.replay, args.save_traces, args.fake_embed)
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=initargs) as pool:
+      futures = {pool.submit(run_worker_attempt, test, i): (test, i) for test, i in attempts}
+      for future in as_completed(futures):
+        test, i = futures[future]
+        try:
+          result, setup_time_saved, duration, error, output = future.result()
+          print(output, end='')
+          time_saved[test] += setup_time_saved
+        except Exception:
+          print('!!!', test, 'attempt', i, 'crashed its worker:')
+          traceback.print_exc()
+          result, duration, error = 'failed', None, traceback.format_exc()
+        record_attempt(test, i, result, duration, error)
+  else:
+    start_http_server(3000, args.stub, args.stub_latency, args.cached_server, cassette, args.record is not None, args.fake_embed)
+    test_class = UITests(stub=args.stub, max_driver_uses=args.reuse_browser, cassette_mode=cassette_mode, save_traces=args.save_traces)
+    for test, i in attempts:
+      result = run_attempt(test_class, test, i)
+      record_attempt(test, i, result, test_class.attempt_duration, test_class.attempt_error)
+      time_saved[test] += test_class.setup_time_saved
+    test_class.quit_driver()
+
+  if args.reuse_browser > 1:
+    for test in tests:
+      print(f'Reusing the browser saved {time_saved[test]:.1f} seconds in {test}')
+
+  # Attempts finish in any order with workers, so report them in the order they were scheduled.
+  records.sort(key=lambda record: attempts.index((record['test'], record['attempt'])))
+  flag_slow_attempts(timing_history, records)
+  save_timing_history(timing_history_path, timing_history, records)
+  write_junit_xml(args.junit_xml or TMP_FOLDER / 'junit.xml', records)
 
   num_failures = 0
   for test in tests:
-    failures = []
-    for i in range(1, loop_count + 1):
-      print('---', test[0], 'started, attempt', i)
-      test_class.setup()
-      try:
-        test[1]()
-        print('===', test[0], 'attempt', i, 'passed')
-      except TwitchEmbedFailedToLoadException:
-        test_class.screenshot()
-        test_class.dump_network_logs()
-        print('???', test[0], 'attempt', i, 'skipped because a twitch embed failed to load')
-      except Exception:
-        test_class.screenshot()
-        print('!!!', test[0], 'attempt', i, 'failed:')
-        traceback.print_exc()
-        failures.append(i)
-      finally:
-        test_class.teardown()
-
-    if failures:
-      print('Failed attempts:', failures, 'out of', loop_count, 'total')
-      num_failures += len(failures)
+    if failures[test]:
+      print('Failed attempts for', test + ':', sorted(failures[test]), 'out of', loop_count, 'total')
+      num_failures += len(failures[test])
   if num_failures > 0:
     print(f'\n{num_failures} test runs failed')
   else:
@@ -0,0 +1,102 @@
+import json
+import sys
+
+# Turns the app's structured event log (see exportEventLog in index.js) into per-player timing spans.
+
+SEEKING_STATES = ['SEEKING_PLAY', 'SEEKING_PAUSE', 'SEEKING_START', 'SEEKING_END']
+
+def compute_spans(records):
+  spans = []
+  open_spans = {} # (player, span name) -> span
+  last_state = {} # player -> state
+
+  def start(player, name, time):
+    span = {'player': player, 'span': name, 'start': time, 'end': None, 'outcome': None}
+    open_spans[(player, name)] = span
+    spans.append(span)
+
+  def finish(player, name, time, outcome):
+    span = open_spans.pop((player, name), None)
+    if span is not None:
+      span['end'] = time
+      span['outcome'] = outcome
+
+  for record in sorted(records, key=lambda record: record['time']):
+    if record['event'] != 'state':
+      continue
+    player, state, time = record['player'], record['state'], record['time']
+    previous = last_state.get(player)
+    last_state[player] = state
+
+    if state == 'LOADING':
+      # A new player (or the next video in an existing player) starts loading.
+      finish(player, 'load->READY', time, 'reloaded')
+      start(player, 'load->READY', time)
+    elif state == 'READY':
+      finish(player, 'load->READY', time, state)
+
+    # Back-to-back seeks (e.g. a re-seek before the first one lands) count as one span, until the player settles.
+    if state in SEEKING_STATES:
+      if (player, 'seek->settled') not in open_spans:
+        start(player, 'seek->settled', time)
+    else:
+      finish(player, 'seek->settled', time, state)
+
+    if previous == 'BEFORE_START' and state != 'BEFORE_START':
+      finish(player, 'BEFORE_START->PLAYING', time, state)
+    if state == 'BEFORE_START' and previous != 'BEFORE_START':
+      start(player, 'BEFORE_START->PLAYING', time)
+
+  for span in spans:
+    span['duration'] = span['end'] - span['start'] if span['end'] is not None else None
+  return spans
+
+def format_spans(spans):
+  if not spans:
+    return 'No player state transitions were logged'
+  first = min(span['start'] for span in spans)
+  lines = [f'{"player":10} {"span":24} {"start (s)":>10} {"duration (ms)":>14}  outcome']
+  for span in sorted(spans, key=lambda span: (span['player'] or '', span['start'])):
+    start = (span['start'] - first) / 1000
+    duration = f'{span["duration"]:.0f}' if span['duration'] is not None else 'unfinished'
+    lines.append(f'{span["player"] or "":10} {span["span"]:24} {start:>10.3f} {duration:>14}  {span["outcome"] or ""}')
+  return '\n'.join(lines)
+
+# Converts the app's performance timeline (see exportTrace in index.js) into Chrome's Trace Event format, with one track per player.
+# Open the result in chrome://tracing or https://ui.perfetto.dev
+TRACE_PREFIX = 'tvs:'
+
+def to_chrome_trace(trace):
+  events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'Twitch VOD Sync'}}]
+  tracks = {} # track name -> tid
+
+  def track(name):
+    if name not in tracks:
+      tracks[name] = len(tracks) + 1
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tracks[name], 'args': {'name': name}})
+    return tracks[name]
+
+  for entry in sorted(trace['entries'], key=lambda entry: entry['startTime']):
+    detail = entry['detail'] or {}
+    category = detail.get('category', 'app')
+    event = {
+      'name': entry['name'].removeprefix(TRACE_PREFIX),
+      'cat': category,
+      'pid': 1,
+      'tid': track(detail.get('player') or category), # Entries which aren't about a player go on an 'app' (or 'network') track
+      'ts': (trace['timeOrigin'] + entry['startTime']) * 1000, # Microseconds
+      'args': detail,
+    }
+    if entry['entryType'] == 'measure':
+      event['ph'] = 'X'
+      event['dur'] = entry['duration'] * 1000
+    else:
+      event['ph'] = 'i'
+      event['s'] = 't'
+    events.append(event)
+  return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+if __name__ == '__main__':
+  # Usage: python trace_analysis.py event_log.json
+  with open(sys.argv[1], 'r') as f:
+    print(format_spans(compute_spans(json.load(f))))
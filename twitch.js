@@ -9,6 +9,14 @@
 var CLIENT_ID = 'm0bgzop0z8m62bacx50hxh6v0rkiwe'
 window.overrideTwitchClientId = function(clientId) { CLIENT_ID = clientId }
 
+// Tests can point these at a local stand-in (see http_server.py) so that they don't depend on the real APIs.
+var TWITCH_API_BASE = 'https://api.twitch.tv'
+var TWITCH_ID_BASE = 'https://id.twitch.tv'
+window.overrideTwitchApiBase = function(apiBase) {
+  TWITCH_API_BASE = apiBase
+  TWITCH_ID_BASE = apiBase
+}
+
 function getHeaders() {
   return {
     'headers': {
@@ -61,7 +69,7 @@ window.doTwitchRedirect = function(event) {
 
   // Note that this encodes the current hostname so that we can return to where we came from (e.g. dev vs production)
   window.location.href =
-    'https://id.twitch.tv/oauth2/authorize' +
+    TWITCH_ID_BASE + '/oauth2/authorize' +
     '?client_id=' + CLIENT_ID +
     '&redirect_uri=' + encodeURIComponent(window.location.origin) +
     '&response_type=token' +
@@ -98,43 +106,260 @@ function parseVideo(videoDetails) {
   }
 }
 
-window.getTwitchVideosDetails = function(videoIds) {
+// Twitch API responses are cached and shared, since the same channel is often looked up several times
+// (e.g. once per race entrant, then again by refreshTimeline when each video nears its end).
+const HELIX_MAX_IDS = 100 // Helix accepts at most 100 ids per request
+const HELIX_PAGE_SIZE = 100 // ... and returns at most 100 results per page
+const CHANNEL_VIDEOS_TTL = 5 * 60 * 1000
+var userIds = new Map() // login -> Promise of user id. User ids never change, so these never expire.
+var channelVideos = new Map() // login -> {'fetchedAt', 'settled', 'promise', 'index', 'cursor', 'paging'}
+var inflightRequests = new Map() // url -> {'promise', 'controller', 'waiting'}
+var pendingVideoBatch = null // Video ids requested during the current task, which are fetched together
+var cacheStats = {'hits': 0, 'misses': 0, 'shared': 0, 'requests': 0}
+window.getTwitchCacheStats = function() { return {...cacheStats} }
+window.clearTwitchCache = function() {
+  userIds.clear()
+  channelVideos.clear()
+  for (var key in cacheStats) cacheStats[key] = 0
+}
+
+// Shared requests are only cancelled once every caller waiting on them has aborted. Callers without a signal never abort.
+function addWaiter(request, signal) {
+  if (signal == null) {
+    request.waiting = Infinity
+    return
+  }
+  request.waiting++
+  signal.addEventListener('abort', () => {
+    if (--request.waiting === 0) request.controller.abort()
+  }, {'once': true})
+}
+
+function helixGet(path, signal) {
+  if (signal != null && signal.aborted) return Promise.reject(signal.reason)
+  var url = TWITCH_API_BASE + path
+  // Simultaneous callers for the same url share one request.
+  var request = inflightRequests.get(url)
+  if (request != null) {
+    cacheStats.shared++
+  } else {
+    cacheStats.requests++
+    request = {'controller': new AbortController(), 'waiting': 0}
+    request.promise = fetch(url, {...getHeaders(), 'signal': request.controller.signal})
+    .then(r => {
+      if (r.status == 401) showTwitchRedirect()
+      if (r.status != 200) return Promise.reject('HTTP request failed: ' + r.status)
+      return r.json()
+    })
+    .finally(() => inflightRequests.delete(url))
+    inflightRequests.set(url, request)
+  }
+  addWaiter(request, signal)
+  return request.promise
+}
+
+// Resolves to whichever of these videos could be loaded. A single bad id (e.g. a deleted video) fails the whole request,
+// so if that happens we ask for each video on its own, and only the callers waiting on the bad id go without.
+function getVideosChunk(ids) {
   // See https://dev.twitch.tv/docs/api/reference/#get-videos
-  return fetch('https://api.twitch.tv/helix/videos?id=' + videoIds.join('&id='), getHeaders())
-  .then(r => {
-    if (r.status == 401) showTwitchRedirect()
-    if (r.status != 200) return Promise.reject('HTTP request failed: ' + r.status)
-    return r.json()
-  })
-  .then(r => {
-    if (r.data.length === 0) return Promise.reject('Could not load any of these twitch videos:' + videoIds.join(', '))
-    return r.data.map(video => parseVideo(video))
+  var request = helixGet('/helix/videos?id=' + ids.join('&id=')).then(r => r.data)
+  if (ids.length === 1) {
+    return request.catch(error => {
+      console.log('Could not load twitch video', ids[0], error)
+      return []
+    })
+  }
+  return request.catch(() => Promise.all(ids.map(id => getVideosChunk([id]))).then(chunks => chunks.flat()))
+}
+
+window.getTwitchVideosDetails = function(videoIds) {
+  // Calls made during the same task (e.g. one per player while parsing the URL) are merged into as few requests as possible.
+  if (pendingVideoBatch == null) {
+    var batch = {'ids': new Set()}
+    batch.promise = Promise.resolve().then(() => {
+      pendingVideoBatch = null
+      var ids = Array.from(batch.ids)
+      var requests = []
+      for (var i = 0; i < ids.length; i += HELIX_MAX_IDS) requests.push(getVideosChunk(ids.slice(i, i + HELIX_MAX_IDS)))
+      return Promise.all(requests).then(chunks => chunks.flat())
+    })
+    pendingVideoBatch = batch
+  }
+  for (var videoId of videoIds) pendingVideoBatch.ids.add(String(videoId))
+
+  return pendingVideoBatch.promise
+  .then(videos => {
+    videos = videos.filter(video => videoIds.some(videoId => String(videoId) == video.id))
+    if (videos.length === 0) return Promise.reject('Could not load any of these twitch videos:' + videoIds.join(', '))
+    return videos.map(video => parseVideo(video))
   })
 }
 
-window.getTwitchChannelVideos = function(channelName) {
+function getTwitchUserId(login) {
+  var promise = userIds.get(login)
+  if (promise != null) return promise
+
   // See https://dev.twitch.tv/docs/api/reference/#get-users
-  return fetch('https://api.twitch.tv/helix/users?login=' + channelName, getHeaders())
+  promise = helixGet('/helix/users?login=' + login)
   .then(r => {
-    if (r.status == 401) showTwitchRedirect()
-    if (r.status != 200) return Promise.reject('HTTP request failed: ' + r.status)
-    return r.json()
+    if (r.data.length === 0) return Promise.reject('Could not load twitch channel ' + login)
+    return r.data[0].id
   })
-  .then(r => {
-    if (r.data.length === 0) return Promise.reject('Could not load twitch channel ' + channelName)
-    var channelId = r.data[0].id
-    // See https://dev.twitch.tv/docs/api/reference/#get-videos
-    return fetch('https://api.twitch.tv/helix/videos?type=archive&sort=time&user_id=' + channelId, getHeaders())
+  promise.catch(() => userIds.delete(login)) // Don't cache failures, the user may have just mistyped.
+  userIds.set(login, promise)
+  return promise
+}
+
+// Looks up many channels at once (e.g. all of a race's entrants), filling the user id cache.
+// Returns a map of login -> user id, which omits any channels that twitch doesn't know about.
+window.getTwitchUserIds = function(channelNames) {
+  var logins = Array.from(new Set(channelNames.map(channelName => channelName.toLowerCase())))
+  var uncached = logins.filter(login => !userIds.has(login))
+  var requests = []
+  for (var i = 0; i < uncached.length; i += HELIX_MAX_IDS) {
+    // See https://dev.twitch.tv/docs/api/reference/#get-users
+    var request = helixGet('/helix/users?login=' + uncached.slice(i, i + HELIX_MAX_IDS).join('&login='))
+    .then(r => new Map(r.data.map(user => [user.login, user.id])))
+    for (let login of uncached.slice(i, i + HELIX_MAX_IDS)) {
+      let promise = request.then(found => found.get(login) ?? Promise.reject('Could not load twitch channel ' + login))
+      promise.catch(() => userIds.delete(login))
+      userIds.set(login, promise)
+    }
+    requests.push(request)
+  }
+
+  return Promise.allSettled(logins.map(login => userIds.get(login)))
+  .then(results => {
+    if (requests.length > 0 && results.every(result => result.status == 'rejected')) {
+      return Promise.all(requests) // Surface any request failures (e.g. auth), rather than just 'not found'
+      .then(() => new Map())
+    }
+    var found = new Map()
+    for (var i = 0; i < logins.length; i++) {
+      if (results[i].status == 'fulfilled') found.set(logins[i], results[i].value)
+    }
+    return found
   })
+}
+
+// A channel's videos, sorted by startTime (earliest first), so that time-based lookups are a binary search.
+// Indices returned by getTwitchChannelVideos are shared between callers, so treat them (and their videos) as read-only.
+class VideoIndex {
+  constructor(videos=[]) {
+    this.videos = []
+    this.add(videos)
+  }
+
+  add(videos) {
+    var ids = new Set(this.videos.map(video => video.id))
+    for (var video of videos) {
+      if (!ids.has(video.id)) this.videos.push(video) // Pages can overlap if new videos were added while paging
+    }
+    this.videos.sort((a, b) => a.startTime - b.startTime)
+  }
+
+  // Returns the number of videos which start before time (or at time, if inclusive)
+  bisect(time, inclusive=false) {
+    var lo = 0
+    var hi = this.videos.length
+    while (lo < hi) {
+      var mid = (lo + hi) >>> 1
+      var startTime = this.videos[mid].startTime
+      if (startTime < time || (inclusive && startTime === time)) lo = mid + 1
+      else hi = mid
+    }
+    return lo
+  }
+
+  // The video which was live at time, if any. (A channel can only stream one video at a time.)
+  overlapping(time) {
+    var video = this.videos[this.bisect(time, /*inclusive*/true) - 1]
+    return (video != null && time <= video.endTime) ? video : null
+  }
+
+  // The earliest video which starts after time, if any
+  nextAfter(time) {
+    return this.videos[this.bisect(time, /*inclusive*/true)] ?? null
+  }
+
+  find(videoId) {
+    return this.videos.find(video => video.id == videoId) ?? null
+  }
+
+  newestFirst() {
+    return this.videos.toReversed()
+  }
+}
+window.VideoIndex = VideoIndex
+
+function fetchVideoPage(cached, signal) {
+  // See https://dev.twitch.tv/docs/api/reference/#get-videos
+  var path = '/helix/videos?type=archive&sort=time&first=' + HELIX_PAGE_SIZE + '&user_id=' + cached.userId
+  if (cached.cursor) path += '&after=' + cached.cursor
+  return helixGet(path, signal)
   .then(r => {
-    if (r.status == 401) showTwitchRedirect()
-    if (r.status != 200) return Promise.reject('HTTP request failed: ' + r.status)
-    return r.json()
+    cached.index.add(r.data.map(video => parseVideo(video)))
+    cached.cursor = r.pagination.cursor ?? null // Twitch omits the cursor on the last page
   })
-  .then(r => {
-    if (r.data.length === 0) return Promise.reject('Succesfully loaded channel ' + channelName + ' but could not find any past broadcasts')
-    // Twitch APIs state that they return newest first, sort just to be sure.
-    return r.data.map(video => parseVideo(video)).sort((a, b) => b.startTime - a.startTime)
+}
+
+// Videos are returned newest first, so older pages are only fetched (one at a time, since each needs the previous page's cursor)
+// until the index reaches back to coverTime.
+async function fetchPagesUntil(cached, coverTime, signal) {
+  while (coverTime != null && cached.cursor != null && cached.index.videos[0].startTime > coverTime) {
+    await fetchVideoPage(cached, signal)
+  }
+}
+
+// Returns a Promise of the channel's VideoIndex. Options:
+// - maxAge: How old (in millis) a cached index may be. A request which is still in flight is always shared, though.
+// - coverTime: Fetch older pages of videos until the index includes this timestamp (or the channel's oldest video).
+// - signal: Aborting this cancels the lookup (unless another caller is still waiting on it).
+window.getTwitchChannelVideos = function(channelName, options={}) {
+  var {maxAge=CHANNEL_VIDEOS_TTL, coverTime=null, signal=null} = options
+  // e.g. mock players, which refreshTimeline still checks for a next video
+  if (channelName == null) return Promise.reject('No channel to load videos from')
+  var login = channelName.toLowerCase()
+  var cached = channelVideos.get(login)
+  if (cached != null && (!cached.settled || Date.now() - cached.fetchedAt <= maxAge)) {
+    cacheStats.hits++
+  } else {
+    cacheStats.misses++
+    cached = {
+      'fetchedAt': Date.now(),
+      'settled': false,
+      'controller': new AbortController(),
+      'waiting': 0,
+      'index': new VideoIndex(),
+      'cursor': '', // Empty for the first page, null once there are no more pages
+      'paging': Promise.resolve(),
+    }
+    cached.promise = getTwitchUserId(login)
+    .then(userId => {
+      cached.userId = userId
+      return fetchVideoPage(cached, cached.controller.signal)
+    })
+    .then(() => {
+      if (cached.index.videos.length === 0) return Promise.reject('Succesfully loaded channel ' + channelName + ' but could not find any past broadcasts')
+      return cached.index
+    })
+    .finally(() => {
+      cached.settled = true
+      cached.fetchedAt = Date.now()
+    })
+    cached.promise.catch(() => {
+      if (channelVideos.get(login) === cached) channelVideos.delete(login)
+    })
+    channelVideos.set(login, cached)
+  }
+  addWaiter(cached, signal)
+
+  return cached.promise
+  .then(index => {
+    // A failed (or aborted) page fetch shouldn't stop the next caller from trying again.
+    var paging = cached.paging.catch(() => {}).then(() => fetchPagesUntil(cached, coverTime, signal))
+    cached.paging = paging
+    return paging.then(() => index)
   })
 }
 })()